@@ -8,20 +8,14 @@ version = extra.get_llvm_version()
 del extra
 
 class Wrapper(object):
+    # Subclasses declare `__slots__ = ()` unless they need more attributes,
+    # so that wrapper objects have no instance __dict__.  Deleting `_ptr` releases the
+    # wrapped object; accessing it afterwards raises AttributeError.
+    __slots__ = '_ptr', '__weakref__'
+
     def __init__(self, ptr):
         assert ptr
-        self.__ptr = ptr
-
-    @property
-    def _ptr(self):
-        try:
-            return self.__ptr
-        except AttributeError:
-            raise AttributeError("_ptr resource has been removed")
-
-    @_ptr.deleter
-    def _ptr(self):
-        del self.__ptr
+        self._ptr = ptr
 
 
 def _extract_ptrs(objs):
@@ -31,6 +25,62 @@ def _extract_ptrs(objs):
 class LLVMException(Exception):
     pass
 
+#===----------------------------------------------------------------------===
+# Targets
+#===----------------------------------------------------------------------===
+
+# Entry points of the optional targets, in the order they are called.
+_TARGET_INITIALIZERS = {
+    'ptx': ('LLVMInitializePTXTarget',
+            'LLVMInitializePTXTargetInfo',
+            'LLVMInitializePTXTargetMC',
+            'LLVMInitializePTXAsmPrinter'),
+    'nvptx': ('LLVMInitializeNVPTXTarget',
+              'LLVMInitializeNVPTXTargetInfo',
+              'LLVMInitializeNVPTXTargetMC',
+              'LLVMInitializeNVPTXAsmPrinter'),
+}
+
+_initialized_targets = set()
+
+def initialize_targets(targets=('native',)):
+    """Initialize the code generators of `targets`.
+
+    targets -- a name or a sequence of names among 'native', 'ptx',
+    'nvptx' and 'all' (the native target and every optional target that
+    the binding was built with).
+
+    llvm.ee initializes the targets it needs on first use.  Call this to
+    initialize them upfront, or before using the targets through the
+    llvmpy.api layer.  Raises LLVMException if a target is not available.
+    """
+    if isinstance(targets, str):
+        targets = [targets]
+    for name in targets:
+        if name in _initialized_targets:
+            continue
+        from llvmpy import api
+        if name == 'all':
+            initialize_targets(['native'] +
+                               [target for target, entries
+                                in sorted(_TARGET_INITIALIZERS.items())
+                                if hasattr(api, entries[0])])
+            continue
+        elif name == 'native':
+            if api.llvm.InitializeNativeTarget():
+                raise LLVMException("No native target!?")
+            if api.llvm.InitializeNativeTargetAsmPrinter():
+                raise LLVMException("No native asm printer!?")
+        elif name in _TARGET_INITIALIZERS:
+            entries = _TARGET_INITIALIZERS[name]
+            if not hasattr(api, entries[0]):
+                raise LLVMException("Target %r is not available" % name)
+            for entry in entries:
+                getattr(api, entry)()
+        else:
+            raise ValueError("Unknown target %r" % name)
+        _initialized_targets.add(name)
+
 def test(verbosity=1):
     """test(verbosity=1) -> TextTestResult
 
@@ -0,0 +1,398 @@
+"""
+Caches for generated machine code.
+
+ObjectCache keeps the native object code produced by
+TargetMachine.emit_object in a directory on disk, so that a process
+that builds the same module again can skip code generation.  Entries
+are content-addressed: the key covers the module bitcode, the LLVM
+version and every TargetMachine setting that affects the output.
+
+Only ObjectCache.emit_object uses the cache.  The JIT does not:
+EngineBuilder.create() and ExecutionEngine.get_pointer_to_function still
+generate code for every process, so JIT warm starts do not benefit.
+
+The cache is bounded by size.  When it grows beyond ``max_size`` bytes,
+the least recently used entries are removed.
+
+FunctionPointerCache memoizes JIT-compiled functions within a process:
+functions with the same code share the native code of the first one.
+"""
+
+import os
+import re
+import errno
+import hashlib
+import tempfile
+import weakref
+
+import llvm
+from llvm import core
+
+
+class ObjectCache(object):
+    '''On-disk cache of native object code.
+
+    Usage:
+
+        cache = ObjectCache('/path/to/cachedir', max_size=64 * 2**20)
+        objcode = cache.emit_object(tm, module)
+
+    ``hits`` and ``misses`` count the lookups made through this instance.
+    '''
+
+    suffix = '.o'
+
+    def __init__(self, directory, max_size=256 * 2**20):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Upper bound of the size of the directory, or None if unknown.
+        # Only the entries written by this instance are added to it, so
+        # the directory is scanned again when it passes the limit.
+        self._size = None
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def key_for(tm, module):
+        '''Return the cache key of the object code for `module` as
+        generated by the TargetMachine `tm`.
+
+        The TargetOptions of `tm` are not part of the key: the
+        TargetMachines of llvm.ee always use the default options.
+        '''
+        h = hashlib.sha1()
+        h.update(module.to_bitcode())
+        for part in ('.'.join(map(str, llvm.version)),
+                     tm.triple, tm.cpu, tm.feature_string,
+                     str(tm._ptr.getOptLevel()),
+                     str(tm._ptr.getRelocationModel()),
+                     str(tm._ptr.getCodeModel()),
+                     str(tm._ptr.hasMCUseDwarfDirectory())):
+            h.update(b'\0')
+            h.update(part.encode('utf8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        '''Return the cached bytes for `key` or None.
+        '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fin:
+                data = fin.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(path, None)        # mark as recently used
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        '''Store `data` under `key` and evict old entries if the cache
+        may exceed its size limit.
+
+        The entry is written to a temporary file first, and then renamed,
+        so that concurrent readers never see a partial entry.
+        '''
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(data)
+            if os.name == 'nt' and os.path.exists(self._path(key)):
+                os.unlink(self._path(key))
+            os.rename(tmppath, self._path(key))
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+        if self._size is not None:
+            self._size += len(data)
+        if self._size is None or self._size > self.max_size:
+            self.evict()
+
+    def emit_object(self, tm, module):
+        '''Same as tm.emit_object(module) but reuse the cached object
+        code if the same module was compiled with the same settings
+        before.
+        '''
+        key = self.key_for(tm, module)
+        data = self.get(key)
+        if data is None:
+            data = tm.emit_object(module)
+            self.put(key, data)
+        return data
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue        # removed by another process
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    @property
+    def size(self):
+        '''Total number of bytes held by the cache.
+        '''
+        return sum(size for _, size, _ in self._entries())
+
+    def __len__(self):
+        return len(self._entries())
+
+    def evict(self, max_size=None):
+        '''Remove least recently used entries until the cache holds at
+        most `max_size` bytes (default to the limit of the cache).
+        '''
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        '''Remove all entries.
+        '''
+        self.evict(max_size=0)
+
+
+#===----------------------------------------------------------------------===
+# Function pointer memoization
+#===----------------------------------------------------------------------===
+
+_IDENT = r'(?:[-a-zA-Z$._0-9]+|"[^"]*")'
+_RE_LOCAL_DEF = re.compile(r'^\s*(%' + _IDENT + r')\s*=', re.M)
+_RE_LABEL_DEF = re.compile(r'^(' + _IDENT + r'):', re.M)
+_RE_LOCAL = re.compile(r'%' + _IDENT)
+_RE_GLOBAL = re.compile(r'@' + _IDENT)
+_RE_COMMENT = re.compile(r'\s*;[^"\n]*$', re.M)
+_RE_SIMPLE_NAME = re.compile(r'^[-a-zA-Z$._][-a-zA-Z$._0-9]*$')
+
+
+def _local_token(name):
+    if _RE_SIMPLE_NAME.match(name):
+        return '%' + name
+    return '%"' + name + '"'
+
+def _unquote(token):
+    name = token[1:]
+    if name.startswith('"'):
+        name = name[1:-1]
+    return name
+
+def _normalized_ir(fn, selfname=None):
+    '''Return the IR of `fn` with all local names (arguments, basic blocks
+    and instructions) renamed in order of appearance.  If `selfname` is
+    given, references to the function itself are replaced by it.
+
+    Also return the set of names of the global symbols and named types
+    that the function refers to.
+    '''
+    text = _RE_COMMENT.sub('', str(fn))
+    # let block labels look like the references to them
+    text = _RE_LABEL_DEF.sub(lambda m: '%' + m.group(1) + ':', text)
+
+    localnames = set(_RE_LOCAL_DEF.findall(text))
+    localnames.update(_local_token(bb.name) for bb in fn.basic_blocks)
+    localnames.update(_local_token(arg.name) for arg in fn.args)
+
+    renamed = {}
+    typenames = set()
+    def rename_local(m):
+        token = m.group(0)
+        if token in localnames or token[1:].isdigit():
+            if token not in renamed:
+                renamed[token] = '%%%d' % len(renamed)
+            return renamed[token]
+        typenames.add(_unquote(token))
+        return token
+
+    text = _RE_LOCAL.sub(rename_local, text)
+
+    globalnames = set()
+    def rename_global(m):
+        token = m.group(0)
+        if selfname is not None and _unquote(token) == fn.name:
+            return selfname
+        globalnames.add(_unquote(token))
+        return token
+
+    text = _RE_GLOBAL.sub(rename_global, text)
+    return text, globalnames, typenames
+
+def fingerprint(fn):
+    '''Return a hash (a hex string) that identifies the code of function
+    `fn` independently of the names of the function and of its local
+    values, or None if the function cannot be shared across execution
+    engines.
+
+    Functions defined in the same module and called by `fn` are part of
+    the fingerprint.  A reference to a mutable global variable makes the
+    function unshareable, because each engine has its own storage for
+    it.
+    '''
+    module = fn.module
+    # The same IR compiles differently for other targets and layouts.
+    parts = ['target triple = "%s"' % module.target,
+             'target datalayout = "%s"' % module.data_layout]
+    seen_globals = set()
+    seen_types = set()
+    pending = [(fn, '@.self')]
+    while pending:
+        cur, selfname = pending.pop()
+        text, globalnames, typenames = _normalized_ir(cur, selfname)
+        parts.append(text)
+
+        for name in sorted(typenames - seen_types):
+            seen_types.add(name)
+            ty = module.get_type_named(name)
+            if ty is not None:
+                parts.append('%%%s = type %s' % (name,
+                             ', '.join(str(e) for e in ty.elements)))
+
+        for name in sorted(globalnames - seen_globals):
+            seen_globals.add(name)
+            if name == fn.name:
+                continue
+            callee = module._ptr.getFunction(name)
+            if callee is not None:
+                if not callee.isDeclaration():
+                    pending.append((core._make_value(callee), None))
+                continue
+            gvar = module._ptr.getNamedGlobal(name)
+            if gvar is None:
+                return None     # alias or unnamed global
+            gvar = core._make_value(gvar)
+            if not gvar.global_constant or gvar.initializer is None:
+                return None
+            parts.append(str(gvar))
+    h = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode('utf8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class FunctionPointerCache(object):
+    '''Process-wide memoization of JIT-compiled functions.
+
+    Maps the fingerprint of a function (see `fingerprint`) to the native
+    address of an identical function that has been compiled by a live
+    ExecutionEngine.  The cache only holds weak references to the engines;
+    when an engine is freed, all addresses it provided are dropped.
+
+    Note: The address stays valid only as long as its engine is alive and
+    the machine code has not been freed with free_machine_code_for().
+    get_function_pointer() and lookup() return the engine that owns the
+    code, to be kept alive by the caller.
+    '''
+
+    def __init__(self):
+        self._entries = {}      # fingerprint -> (weakref(engine), addr)
+        self._engines = {}      # id(engine) -> (weakref(engine), set(fps))
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _engine_died(self, ref):
+        for key, (eref, fps) in list(self._engines.items()):
+            if eref is ref:
+                del self._engines[key]
+                for fp in fps:
+                    entry = self._entries.get(fp)
+                    if entry is not None and entry[0] is ref:
+                        del self._entries[fp]
+                break
+
+    def lookup(self, fn):
+        '''Return (address, owner) of a compiled function identical to
+        `fn`, or None.  See get_function_pointer().
+        '''
+        fp = fingerprint(fn)
+        if fp is None:
+            return None
+        return self._get(fp)
+
+    def _get(self, fp):
+        entry = self._entries.get(fp)
+        if entry is None:
+            return None
+        owner = entry[0]()
+        if owner is None:
+            return None
+        return entry[1], owner
+
+    def add(self, engine, fn, addr):
+        '''Record that `engine` compiled `fn` at `addr`.
+        '''
+        fp = fingerprint(fn)
+        if fp is not None:
+            self._add(engine, fp, addr)
+
+    def _add(self, engine, fp, addr):
+        # Weakly reference the native engine object, not the
+        # llvm.ee.ExecutionEngine, which may be recreated for the same
+        # engine.
+        target = engine._ptr
+        key = id(target)
+        if key not in self._engines or self._engines[key][0]() is None:
+            self._engines[key] = (weakref.ref(target, self._engine_died),
+                                  set())
+        eref, fps = self._engines[key]
+        fps.add(fp)
+        self._entries[fp] = (eref, addr)
+
+    def get_function_pointer(self, engine, fn):
+        '''Like engine.get_pointer_to_function(fn), but return the
+        address of an identical function that has been compiled before,
+        if any.
+
+        Returns (address, owner).  The native code belongs to `owner`,
+        which may be another engine than `engine`: keep a reference to
+        `owner` for as long as the address is used.
+        '''
+        fp = fingerprint(fn)
+        if fp is not None:
+            found = self._get(fp)
+            if found is not None:
+                self.hits += 1
+                return found
+        self.misses += 1
+        addr = engine.get_pointer_to_function(fn)
+        if fp is not None:
+            self._add(engine, fp, addr)
+        return addr, engine._ptr
+
+    def clear(self):
+        self._entries.clear()
+        self._engines.clear()
+
+
+# The process-wide instance.
+function_pointer_cache = FunctionPointerCache()
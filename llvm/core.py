@@ -29,20 +29,18 @@
 #
 
 from io import BytesIO
-try:
-    from StringIO import StringIO
-except ImportError:
-    try:
-        from cStringIO import StringIO
-    except ImportError:
-        from io import StringIO
 
-import contextlib, weakref
+import os, contextlib, hashlib
+
+try:
+    _string_types = (basestring,)
+except NameError:
+    _string_types = (str, bytes)
 
 import llvm
 from llvm._intrinsic_ids import *
 
-from llvmpy import api
+from llvmpy import api, capsule
 
 #===----------------------------------------------------------------------===
 # Enumerations
@@ -296,6 +294,176 @@ ATTR_INLINE_HINT        = api.llvm.Attributes.AttrVal.InlineHint
 ATTR_STACK_ALIGNMENT    = api.llvm.Attributes.AttrVal.StackAlignment
 
 
+class _NativeOutput(object):
+    """A raw_ostream that writes straight to a file descriptor, a path or
+    a writable buffer, without going through Python objects.
+
+    Use _NativeOutput.open(target); it returns None if `target` can
+    only be written with its write() method.
+    """
+
+    def __init__(self, stream, fileobj=None, capacity=None, close=False):
+        self.stream = stream
+        self.fileobj = fileobj
+        self.capacity = capacity
+        self.close_stream = close
+
+    @classmethod
+    def open(cls, target):
+        if isinstance(target, int):
+            return cls(api.llvm.raw_fd_ostream.new(target, False))
+        if isinstance(target, _string_types):
+            flags = (os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                     getattr(os, 'O_BINARY', 0))
+            fd = os.open(target, flags, 438)  # 0666
+            return cls(api.llvm.raw_fd_ostream.new(fd, True), close=True)
+        if hasattr(target, 'write'):
+            try:
+                fd = target.fileno()
+            except Exception:
+                return None     # e.g. BytesIO
+            target.flush()
+            return cls(api.llvm.raw_fd_ostream.new(fd, False), fileobj=target)
+        # a writable buffer
+        from llvmpy import extra
+        return cls(extra.make_raw_buffer_ostream(target),
+                   capacity=_buffer_size(target))
+
+    def finish(self):
+        """Flush the stream and check for errors.
+
+        Returns the number of bytes written into a buffer target, or None.
+        The size of the output is only known once it is written: a buffer
+        that is too small receives the first bytes of the output before
+        ValueError is raised.
+        """
+        self.stream.flush()
+        if self.capacity is not None:
+            written = self.stream.tell()
+            if written > self.capacity:
+                raise ValueError("output buffer too small: %d bytes needed"
+                                 % written)
+            return written
+        if self.close_stream:
+            self.stream.close()
+        if self.stream.has_error():
+            self.stream.clear_error()
+            raise IOError("failed to write output")
+        if self.fileobj is not None:
+            # let the file object see the new position of the descriptor
+            try:
+                fd = self.fileobj.fileno()
+                self.fileobj.seek(os.lseek(fd, 0, os.SEEK_CUR))
+            except (IOError, OSError, ValueError):
+                pass    # not seekable
+
+def _buffer_size(obj):
+    try:
+        view = memoryview(obj)
+    except NameError:   # Python 2.6
+        return len(obj)
+    if view.readonly:
+        raise TypeError("output buffer is not writable")
+    return len(view) * view.itemsize
+
+def _mmap_file(fileobj):
+    """Map the content of a regular file opened for reading, if it is
+    read from its beginning, or return None.
+    """
+    import mmap
+    try:
+        if fileobj.tell() != 0:
+            return None
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+        # not a real file, an empty file, a pipe...
+        return None
+
+def _address_of(obj):
+    "Address of the LLVM object wrapped by `obj`."
+    return obj._ptr._capsule.pointer
+
+class _LRUCache(object):
+    """Mapping that drops its least recently used entries.  The entries
+    are kept in a circular doubly linked list, most recently used last
+    (collections.OrderedDict is not available on Python 2.6).
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._links = {}    # key -> [prev, next, key, value]
+        root = self._root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def get(self, key):
+        link = self._links.get(key)
+        if link is None:
+            return None
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def put(self, key, value, size):
+        "Add a new entry, keeping at most `size` entries."
+        while self._links and len(self._links) >= size:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._links[oldest[2]]
+        link = [None, None, key, value]
+        self._links[key] = link
+        self._append(link)
+
+# Parsed assembly, keyed by the hash of the text and the address of the
+# context.  The modules in this cache are never handed out; callers get a
+# clone or link them in preserving the source.
+_assembly_cache = _LRUCache()
+ASSEMBLY_CACHE_SIZE = 64
+
+def clear_assembly_cache():
+    "Forget all modules parsed by Module.from_assembly(..., cache=True)."
+    _assembly_cache.clear()
+
+def _parse_assembly(ir, context):
+    diag = api.llvm.SMDiagnostic.new()
+    m = api.llvm.ParseAssemblyString(ir, None, diag, context)
+    if not m:
+        raise llvm.LLVMException("%d:%d: %s" % (diag.getLineNo(),
+                                                diag.getColumnNo(),
+                                                diag.getMessage()))
+    return Module(m)
+
+def _parse_assembly_cached(ir, context):
+    data = ir if isinstance(ir, bytes) else ir.encode('utf8')
+    key = (hashlib.sha1(data).hexdigest(), context._capsule.pointer)
+    master = _assembly_cache.get(key)
+    if master is None:
+        master = _parse_assembly(ir, context)
+        _assembly_cache.put(key, master, ASSEMBLY_CACHE_SIZE)
+    return master
+
+def _read_assembly(fileobj_or_str):
+    if isinstance(fileobj_or_str, str):
+        return fileobj_or_str
+    return fileobj_or_str.read()
+
+
 class Module(llvm.Wrapper):
     """A Module instance stores all the information related to an LLVM module.
 
@@ -310,14 +478,14 @@ class Module(llvm.Wrapper):
 
     module_obj = Module.new('my_module')
     """
-    __cache = weakref.WeakValueDictionary()
+    __slots__ = ()
 
     def __new__(cls, ptr):
-        cached = cls.__cache.get(ptr)
-        if cached:
+        cached = capsule.getCached(ptr._ptr, cls)
+        if cached is not None:
             return cached
         obj = object.__new__(cls)
-        cls.__cache[ptr] = obj
+        capsule.setCached(ptr._ptr, cls, obj)
         return obj
 
     @staticmethod
@@ -331,45 +499,88 @@ class Module(llvm.Wrapper):
         return Module(m)
 
     @staticmethod
-    def from_bitcode(fileobj_or_str):
+    def from_bitcode(fileobj_or_str, lazy=False):
         """Create a Module instance from the contents of a bitcode
         file.
 
-        fileobj_or_str -- takes a file-like object or string that contains
-        a module represented in bitcode.
+        fileobj_or_str -- takes a file-like object or an object that
+        supports the buffer protocol (bytes, bytearray, memoryview,
+        mmap, ...) that contains a module represented in bitcode.
+        Buffers are parsed in place without being copied.  Regular files
+        are memory-mapped instead of read.
+
+        lazy -- If True, only read the module header and the global
+        declarations.  The functions are deserialized when they are used
+        (see GlobalValue.materialize() and Module.materialize_all()).
+        The module keeps a reference to the buffer, which must not be
+        modified while the module exists.
         """
-        if isinstance(fileobj_or_str, str):
-            bc = fileobj_or_str
-        else:
-            bc = fileobj_or_str.read()
-        errbuf = BytesIO()
-        context = api.llvm.getGlobalContext()
-        m = api.llvm.ParseBitCodeFile(bc, context, errbuf)
-        if not m:
-            raise Exception(errbuf.getvalue())
-        errbuf.close()
+        data = fileobj_or_str
+        mapping = None
+        if hasattr(fileobj_or_str, 'read'):
+            mapping = _mmap_file(fileobj_or_str)
+            if mapping is None:
+                data = fileobj_or_str.read()
+            else:
+                data = mapping
+        try:
+            with contextlib.closing(BytesIO()) as errbuf:
+                context = api.llvm.getGlobalContext()
+                m = api.llvm.ParseBitCodeBuffer(data, context, errbuf, lazy)
+                if not m:
+                    raise Exception(errbuf.getvalue())
+        finally:
+            # A lazy module reads the mapping until it is destroyed.
+            if mapping is not None and not lazy:
+                mapping.close()
         return Module(m)
 
 
     @staticmethod
-    def from_assembly(fileobj_or_str):
+    def from_assembly(fileobj_or_str, cache=False):
         """Create a Module instance from the contents of an LLVM
         assembly (.ll) file.
 
 
         fileobj_or_str -- takes a file-like object or string that contains
         a module represented in llvm-ir assembly.
+
+        cache -- If True, keep the parsed module and return a clone of it
+        when the same text is parsed again in the same context.  The
+        ASSEMBLY_CACHE_SIZE most recently used modules are kept.  See
+        clear_assembly_cache().
+
+        Raises llvm.LLVMException with the parser's message if the
+        assembly is invalid.
         """
-        if isinstance(fileobj_or_str, str):
-            ir = fileobj_or_str
-        else:
-            ir = fileobj_or_str.read()
-        errbuf = BytesIO()
+        ir = _read_assembly(fileobj_or_str)
         context = api.llvm.getGlobalContext()
-        m = api.llvm.ParseAssemblyString(ir, None, api.llvm.SMDiagnostic.new(),
-                                         context)
-        errbuf.close()
-        return Module(m)
+        if cache:
+            return _parse_assembly_cached(ir, context).clone()
+        return _parse_assembly(ir, context)
+
+    @staticmethod
+    def from_assemblies(sources, id='', cache=True):
+        """Create a Module instance from several LLVM assembly snippets,
+        linked together in order.
+
+        sources -- a sequence of file-like objects or strings, each one
+        a module represented in llvm-ir assembly.
+
+        cache -- If True (the default), each snippet is parsed once per
+        process and linked in from the cached module, which is left
+        untouched.
+        """
+        context = api.llvm.getGlobalContext()
+        module = Module.new(id)
+        for src in sources:
+            ir = _read_assembly(src)
+            if cache:
+                module.link_in(_parse_assembly_cached(ir, context),
+                               preserve=True)
+            else:
+                module.link_in(_parse_assembly(ir, context))
+        return module
 
     def __str__(self):
         """Text representation of a module.
@@ -383,15 +594,25 @@ class Module(llvm.Wrapper):
         return str(self._ptr)
 
     def __eq__(self, rhs):
-        assert isinstance(rhs, Module), type(rhs)
         if isinstance(rhs, Module):
-            return str(self) == str(rhs)
+            return _address_of(self) == _address_of(rhs)
         else:
             return False
 
     def __ne__(self, rhs):
         return not (self == rhs)
 
+    def __hash__(self):
+        return hash(_address_of(self))
+
+    def structurally_equal(self, rhs):
+        """Compare the textual representation of two modules.
+
+        Unlike `==`, which tells whether two objects refer to the same
+        module, this renders both modules as LLVM assembly.
+        """
+        return str(self) == str(rhs)
+
 
     def _get_target(self):
         return self._ptr.getTargetTriple()
@@ -478,6 +699,15 @@ class Module(llvm.Wrapper):
     def global_variables(self):
         return list(map(_make_value, self._ptr.list_globals()))
 
+    @property
+    def global_variable_count(self):
+        return self._ptr.global_size()
+
+    def iter_global_variables(self):
+        """Iterate over the global variables of this module without
+        building a list."""
+        return _iter_values(self._ptr.getFirstGlobal(), 'getNextGlobal')
+
     def add_function(self, ty, name):
         """Add a function of given type with given name."""
         return Function.new(self, ty, name)
@@ -511,6 +741,15 @@ class Module(llvm.Wrapper):
         """All functions in this module."""
         return list(map(_make_value, self._ptr.list_functions()))
 
+    @property
+    def function_count(self):
+        return self._ptr.size()
+
+    def iter_functions(self):
+        """Iterate over the functions of this module without building a
+        list."""
+        return _iter_values(self._ptr.getFirstFunction(), 'getNextFunction')
+
     def verify(self):
         """Verify module.
 
@@ -526,19 +765,27 @@ class Module(llvm.Wrapper):
         """Write bitcode representation of module to given file-like
         object.
 
-        fileobj -- A file-like object to where the bitcode is written.
-        If it is None, the bitcode is returned.
+        fileobj -- Where the bitcode is written.  It can be a file-like
+        object, a file descriptor, a path, or a writable object that
+        supports the buffer protocol (e.g. bytearray).  Files, descriptors
+        and paths are written directly by LLVM, in a single pass.
+        If it is None, the bitcode is returned.  ValueError is raised if
+        a buffer is too small; it then holds the beginning of the bitcode.
 
-        Return value -- Returns None if fileobj is not None.
-        Otherwise, return the bitcode as a bytestring.
+        Return value -- Returns the bitcode as a bytestring if fileobj is
+        None; the number of bytes written if fileobj is a buffer;
+        otherwise None.
         """
-        ret = False
         if fileobj is None:
-            ret = True
-            fileobj = BytesIO
-        api.llvm.WriteBitcodeToFile(self._ptr, fileobj)
-        if ret:
-            return fileobj.getvalue()
+            with contextlib.closing(BytesIO()) as buf:
+                api.llvm.WriteBitcodeToFile(self._ptr, buf)
+                return buf.getvalue()
+        out = _NativeOutput.open(fileobj)
+        if out is None:
+            api.llvm.WriteBitcodeToFile(self._ptr, fileobj)
+        else:
+            api.llvm.WriteBitcodeToStream(self._ptr, out.stream)
+            return out.finish()
 
     def _get_id(self):
         return self._ptr.getModuleIdentifier()
@@ -548,59 +795,37 @@ class Module(llvm.Wrapper):
 
     id = property(_get_id, _set_id)
 
-    def _to_native_something(self, fileobj, cgft):
-
-        cgft = api.llvm.TargetMachine.CodeGenFileType.CGFT_AssemblyFile
-        cgft = api.llvm.TargetMachine.CodeGenFileType.CGFT_ObjectFile
-
-        from llvm.ee import TargetMachine
-        from llvm.passes import PassManager
-        from llvmpy import extra
-        tm = TargetMachine.new()._ptr
-        pm = PassManager.new()._ptr
-        formatted
-        failed = tm.addPassesToEmitFile(pm, fileobj, cgft, False)
-
-        if failed:
-            raise llvm.LLVMException("Failed to write native object file")
-        if ret:
-            return fileobj.getvalue()
-
-
     def to_native_object(self, fileobj=None):
         '''Outputs the byte string of the module as native object code
 
-        If a fileobj is given, the output is written to it;
+        If a fileobj is given, the output is written to it (see
+        to_bitcode() for the kinds of output supported);
         Otherwise, the output is returned
         '''
-        ret = False
-        if fileobj is None:
-            ret = True
-            fileobj = BytesIO()
         from llvm.ee import TargetMachine
         tm = TargetMachine.new()
-        fileobj.write(tm.emit_object(self))
-        if ret:
-            return fileobj.getvalue()
+        return tm.emit_object(self, fileobj)
 
 
     def to_native_assembly(self, fileobj=None):
         '''Outputs the byte string of the module as native assembly code
 
-        If a fileobj is given, the output is written to it;
+        If a fileobj is given, the output is written to it (see
+        to_bitcode() for the kinds of output supported);
         Otherwise, the output is returned
         '''
-        ret = False
-        if fileobj is None:
-            ret = True
-            fileobj = StringIO()
         from llvm.ee import TargetMachine
         tm = TargetMachine.new()
-        asm = tm.emit_assembly(self)
-        fileobj.write(asm)
-        if ret:
-            return fileobj.getvalue()
+        return tm.emit_assembly(self, fileobj)
+
 
+    def materialize_all(self):
+        """Deserialize all functions of a module loaded lazily with
+        Module.from_bitcode(..., lazy=True).
+        """
+        with contextlib.closing(BytesIO()) as errbuf:
+            if not self._ptr.MaterializeAll(errbuf):
+                raise llvm.LLVMException(errbuf.getvalue())
 
     def get_or_insert_named_metadata(self, name):
         return NamedMetaData(self._ptr.getOrInsertNamedMetadata(name))
@@ -619,6 +844,7 @@ class Type(llvm.Wrapper):
     Use one of the static methods to create an instance. Example:
     ty = Type.double()
     """
+    __slots__ = ()
     _type_ = api.llvm.Type
 
     def __init__(self, ptr):
@@ -806,8 +1032,12 @@ class Type(llvm.Wrapper):
     def __ne__(self, rhs):
         return not (self == rhs)
 
+    def __hash__(self):
+        return hash(_address_of(self))
+
 class IntegerType(Type):
     """Represents an integer type."""
+    __slots__ = ()
     _type_ = api.llvm.IntegerType
 
     @property
@@ -817,6 +1047,7 @@ class IntegerType(Type):
 
 class FunctionType(Type):
     """Represents a function type."""
+    __slots__ = ()
     _type_ = api.llvm.FunctionType
 
     @property
@@ -845,6 +1076,7 @@ class FunctionType(Type):
 
 class StructType(Type):
     """Represents a structure type."""
+    __slots__ = ()
     _type_ = api.llvm.StructType
 
     @property
@@ -901,6 +1133,7 @@ class StructType(Type):
 
 class ArrayType(Type):
     """Represents an array type."""
+    __slots__ = ()
     _type_ = api.llvm.ArrayType
 
     @property
@@ -912,6 +1145,7 @@ class ArrayType(Type):
         return self._ptr.getNumElements()
 
 class PointerType(Type):
+    __slots__ = ()
     _type_ = api.llvm.PointerType
 
     @property
@@ -923,6 +1157,7 @@ class PointerType(Type):
         return self._ptr.getAddressSpace()
 
 class VectorType(Type):
+    __slots__ = ()
     _type_ = api.llvm.VectorType
 
     @property
@@ -934,16 +1169,16 @@ class VectorType(Type):
         return self._ptr.getNumElements()
 
 class Value(llvm.Wrapper):
+    __slots__ = ()
     _type_ = api.llvm.Value
 
     def __init__(self, builder, ptr):
         assert builder is _ValueFactory
 
-        if type(self._type_) is type:
-            if isinstance(ptr, self._type_): # is not downcast
-                casted = ptr
-            else:
-                casted = ptr._downcast(self._type_)
+        if isinstance(ptr, self._type_): # is not downcast
+            casted = ptr
+        elif type(self._type_) is type:
+            casted = ptr._downcast(self._type_)
         else:
             try:
                 for ty in self._type_:
@@ -967,13 +1202,24 @@ class Value(llvm.Wrapper):
 
     def __eq__(self, rhs):
         if isinstance(rhs, Value):
-            return str(self) == str(rhs)
+            return _address_of(self) == _address_of(rhs)
         else:
             return False
 
     def __ne__(self, rhs):
         return not self == rhs
 
+    def __hash__(self):
+        return hash(_address_of(self))
+
+    def structurally_equal(self, rhs):
+        """Compare the textual representation of two values.
+
+        Unlike `==`, which tells whether two objects refer to the same
+        value, this renders both values as LLVM assembly.
+        """
+        return isinstance(rhs, Value) and str(self) == str(rhs)
+
     def _get_name(self):
         return self._ptr.getName()
 
@@ -998,7 +1244,17 @@ class Value(llvm.Wrapper):
     def uses(self):
         return list(map(_make_value, self._ptr.list_use()))
 
+    def iter_uses(self):
+        """Iterate over the users of this value without building a list.
+        Yields the same objects as `uses`."""
+        use = self._ptr.getFirstUse()
+        while use is not None:
+            user = use.getUser()
+            use = use.getNext()
+            yield _make_value(user)
+
 class User(Value):
+    __slots__ = ()
     _type_ = api.llvm.User
 
     @property
@@ -1011,8 +1267,14 @@ class User(Value):
         return [_make_value(self._ptr.getOperand(i))
                 for i in range(self.operand_count)]
 
+    def iter_operands(self):
+        """Iterate over the operands without building a list."""
+        for i in range(self._ptr.getNumOperands()):
+            yield _make_value(self._ptr.getOperand(i))
+
 
 class Constant(User):
+    __slots__ = ()
     _type_ = api.llvm.Constant
 
     @staticmethod
@@ -1198,6 +1460,7 @@ class Constant(User):
                                                        mask._ptr))
 
 class ConstantExpr(Constant):
+    __slots__ = ()
     _type_ = api.llvm.ConstantExpr
 
     @property
@@ -1209,18 +1472,19 @@ class ConstantExpr(Constant):
         return self._ptr.getOpcodeName()
 
 class ConstantAggregateZero(Constant):
-    pass
+    __slots__ = ()
 
 
 class ConstantDataArray(Constant):
-    pass
+    __slots__ = ()
 
 
 class ConstantDataVector(Constant):
-    pass
+    __slots__ = ()
 
 
 class ConstantInt(Constant):
+    __slots__ = ()
     _type_ = api.llvm.ConstantInt
 
     @property
@@ -1237,29 +1501,30 @@ class ConstantInt(Constant):
 
 
 class ConstantFP(Constant):
-    pass
+    __slots__ = ()
 
 
 class ConstantArray(Constant):
-    pass
+    __slots__ = ()
 
 
 class ConstantStruct(Constant):
-    pass
+    __slots__ = ()
 
 
 class ConstantVector(Constant):
-    pass
+    __slots__ = ()
 
 
 class ConstantPointerNull(Constant):
-    pass
+    __slots__ = ()
 
 
 class UndefValue(Constant):
-    pass
+    __slots__ = ()
 
 class GlobalValue(Constant):
+    __slots__ = ()
     _type_ = api.llvm.GlobalValue
 
     def _get_linkage(self):
@@ -1298,6 +1563,20 @@ class GlobalValue(Constant):
     def is_declaration(self):
         return self._ptr.isDeclaration()
 
+    @property
+    def is_materializable(self):
+        """True if the body of this global has not been read from a
+        lazily loaded bitcode file yet.
+        """
+        return self._ptr.isMaterializable()
+
+    def materialize(self):
+        """Read the body of this global from a lazily loaded bitcode file.
+        """
+        with contextlib.closing(BytesIO()) as errbuf:
+            if not self._ptr.Materialize(errbuf):
+                raise llvm.LLVMException(errbuf.getvalue())
+
     @property
     def module(self):
         return Module(self._ptr.getParent())
@@ -1305,6 +1584,7 @@ class GlobalValue(Constant):
 
 
 class GlobalVariable(GlobalValue):
+    __slots__ = ()
     _type_ = api.llvm.GlobalVariable
 
     @staticmethod
@@ -1346,7 +1626,8 @@ class GlobalVariable(GlobalValue):
     def _del_initializer(self):
         self._ptr.setInitializer(None)
 
-    initializer = property(_get_initializer, _set_initializer)
+    initializer = property(_get_initializer, _set_initializer,
+                           _del_initializer)
 
     def _get_is_global_constant(self):
         return self._ptr.isConstant()
@@ -1366,6 +1647,7 @@ class GlobalVariable(GlobalValue):
     thread_local = property(_get_thread_local, _set_thread_local)
 
 class Argument(Value):
+    __slots__ = ()
     _type_ = api.llvm.Argument
 
     def add_attribute(self, attr):
@@ -1396,6 +1678,7 @@ class Argument(Value):
                          _set_alignment)
 
 class Function(GlobalValue):
+    __slots__ = ()
     _type_ = api.llvm.Function
 
     @staticmethod
@@ -1475,7 +1758,7 @@ class Function(GlobalValue):
 
     @property
     def basic_block_count(self):
-        return len(self.basic_blocks)
+        return self._ptr.size()
 
     @property
     def entry_basic_block(self):
@@ -1495,6 +1778,10 @@ class Function(GlobalValue):
     def basic_blocks(self):
         return list(map(_make_value, self._ptr.getBasicBlockList()))
 
+    def iter_basic_blocks(self):
+        """Iterate over the basic blocks without building a list."""
+        return _iter_values(self._ptr.getFirstBlock(), 'getNextBlock')
+
     def viewCFG(self):
         return self._ptr.viewCFG()
 
@@ -1531,6 +1818,7 @@ class Function(GlobalValue):
 #===----------------------------------------------------------------------===
 
 class InlineAsm(Value):
+    __slots__ = ()
     _type_ = api.llvm.InlineAsm
 
     @staticmethod
@@ -1545,6 +1833,7 @@ class InlineAsm(Value):
 #===----------------------------------------------------------------------===
 
 class MetaData(Value):
+    __slots__ = ()
     _type_ = api.llvm.MDNode
 
     @staticmethod
@@ -1586,6 +1875,7 @@ class MetaData(Value):
         return res
 
 class MetaDataString(Value):
+    __slots__ = ()
     _type_ = api.llvm.MDString
 
     @staticmethod
@@ -1601,6 +1891,7 @@ class MetaDataString(Value):
 
 
 class NamedMetaData(llvm.Wrapper):
+    __slots__ = ()
 
     @staticmethod
     def get_or_insert(mod, name):
@@ -1630,6 +1921,7 @@ class NamedMetaData(llvm.Wrapper):
 #===----------------------------------------------------------------------===
 
 class Instruction(User):
+    __slots__ = ()
     _type_ = api.llvm.Instruction
 
     @property
@@ -1702,6 +1994,7 @@ class Instruction(User):
 
 
 class CallOrInvokeInstruction(Instruction):
+    __slots__ = ()
     _type_ = api.llvm.CallInst, api.llvm.InvokeInst
 
     def _get_cc(self):
@@ -1745,6 +2038,7 @@ class CallOrInvokeInstruction(Instruction):
 
 
 class PHINode(Instruction):
+    __slots__ = ()
     _type_ = api.llvm.PHINode
 
     @property
@@ -1762,12 +2056,14 @@ class PHINode(Instruction):
 
 
 class SwitchInstruction(Instruction):
+    __slots__ = ()
 
     def add_case(self, const, bblk):
         self._ptr.addCase(const._ptr, bblk._ptr)
 
 
 class CompareInstruction(Instruction):
+    __slots__ = ()
 
     @property
     def predicate(self):
@@ -1777,6 +2073,7 @@ class CompareInstruction(Instruction):
 #===----------------------------------------------------------------------===
 
 class BasicBlock(Value):
+    __slots__ = ()
     _type_ = api.llvm.BasicBlock
 
     def insert_before(self, name):
@@ -1797,14 +2094,29 @@ class BasicBlock(Value):
     def instructions(self):
         return list(map(_make_value, self._ptr.getInstList()))
 
+    @property
+    def instruction_count(self):
+        return self._ptr.size()
+
+    def iter_instructions(self):
+        """Iterate over the instructions without building a list."""
+        return _iter_values(self._ptr.getFirstInstruction(),
+                            'getNextInstruction')
+
+    @property
+    def terminator(self):
+        """The terminator instruction of this block or None."""
+        term = self._ptr.getTerminator()
+        if term is None:
+            return None
+        return _make_value(term)
+
 #===----------------------------------------------------------------------===
 # Value factory method
 #===----------------------------------------------------------------------===
 
 
 class _ValueFactory(object):
-    cache = weakref.WeakValueDictionary()
-
     # value ID -> class map
     class_for_valueid = {
         VALUE_ARGUMENT                        : Argument,
@@ -1834,36 +2146,51 @@ class _ValueFactory(object):
         VALUE_INSTRUCTION + OPCODE_FCMP       : CompareInstruction
     }
 
+    # value ID -> (class, value ID), the key of the identity table.  The
+    # wrapped capsule is downcast to the concrete class of the value, so
+    # a wrapper is only reused for a value of the same value ID, even if
+    # the address of a deleted value is reused.
+    cache_key_for_valueid = {}
+
     @classmethod
     def build(cls, ptr):
-        # try to look in the cache
-        addr = ptr._capsule.pointer
-        id = ptr.getValueID()
-        key = id, addr
-        try:
-            obj = cls.cache[key]
-            return obj
-        except KeyError:
-            pass
         # find class by value id
-        ctorcls = cls.class_for_valueid.get(id)
-        if not ctorcls:
-            if id > VALUE_INSTRUCTION: # "generic" instruction
-                ctorcls = Instruction
-            else: # "generic" value
-                ctorcls = Value
-        # cache the obj
-        obj = ctorcls(_ValueFactory, ptr)
-        cls.cache[key] = obj
+        id = ptr.getValueID()
+        key = cls.cache_key_for_valueid.get(id)
+        if key is None:
+            ctorcls = cls.class_for_valueid.get(id)
+            if not ctorcls:
+                if id > VALUE_INSTRUCTION: # "generic" instruction
+                    ctorcls = Instruction
+                else: # "generic" value
+                    ctorcls = Value
+            key = cls.cache_key_for_valueid[id] = (ctorcls, id)
+        # try to look in the cache
+        obj = capsule.getCached(ptr._ptr, key)
+        if obj is None:
+            obj = key[0](_ValueFactory, capsule.concrete(ptr))
+            capsule.setCached(ptr._ptr, key, obj)
         return obj
 
     @classmethod
     def delete(cls, ptr):
-        del cls.cache[(ptr.getValueID(), ptr._capsule.pointer)]
+        capsule.dropCached(ptr._ptr)
 
 def _make_value(ptr):
     return _ValueFactory.build(ptr)
 
+def _iter_values(ptr, nextname):
+    '''Walk a list of values starting at `ptr` by calling the method
+    `nextname` of each element.
+
+    The next element is fetched before the current one is yielded, so the
+    consumer may erase the current element.
+    '''
+    while ptr is not None:
+        nextptr = getattr(ptr, nextname)()
+        yield _make_value(ptr)
+        ptr = nextptr
+
 #===----------------------------------------------------------------------===
 # Builder
 #===----------------------------------------------------------------------===
@@ -1878,6 +2205,7 @@ _atomic_orderings = {
 }
 
 class Builder(llvm.Wrapper):
+    __slots__ = ()
 
     @staticmethod
     def new(basic_block):
@@ -1891,11 +2219,9 @@ class Builder(llvm.Wrapper):
 
         Next instruction inserted will be first one in the block."""
 
-        # Instruction list won't be long anyway,
-        # Does not matter much to build a list of all instructions
-        instrs = bblk.instructions
-        if instrs:
-            self.position_before(instrs[0])
+        first = bblk._ptr.getFirstInstruction()
+        if first is not None:
+            self._ptr.SetInsertPoint(first)
         else:
             self.position_at_end(bblk)
 
@@ -1922,9 +2248,8 @@ class Builder(llvm.Wrapper):
     def _guard_terminators(self):
         if __debug__:
             import warnings
-            for instr in self.basic_block.instructions:
-                if instr.is_terminator:
-                    warnings.warn("BasicBlock can only have one terminator")
+            if self._ptr.GetInsertBlock().getTerminator() is not None:
+                warnings.warn("BasicBlock can only have one terminator")
 
     def ret_void(self):
         self._guard_terminators()
@@ -2197,6 +2522,37 @@ class Builder(llvm.Wrapper):
                                                          vecB._ptr,
                                                          mask._ptr,
                                                          name))
+
+    def emit_batch(self, code, values=(), types=(), results=()):
+        """Emit a sequence of instructions in a single call.
+
+        `code` is a sequence of instructions, each one a tuple of int:
+        the opcode followed by the operands.  Value operands are indices
+        in a table that starts with `values` and grows by the result of
+        each emitted instruction; type operands are indices in `types`.
+        Negative indices count from the end of the table.
+
+            (OPCODE_ADD, lhs, rhs)              binary operators
+            (OPCODE_ZEXT, value, type)          casts
+            (OPCODE_ICMP, ICMP_EQ, lhs, rhs)    icmp and fcmp
+            (OPCODE_SELECT, cond, lhs, rhs)
+            (OPCODE_ALLOCA, type)
+            (OPCODE_LOAD, ptr)
+            (OPCODE_STORE, value, ptr)
+            (OPCODE_GETELEMENTPTR, ptr, index...)
+            (OPCODE_CALL, callee, arg...)
+
+        Returns the values at the indices in `results`.  Only the
+        requested values are wrapped.  Raises IndexError for an index
+        out of range, TypeError for operands of the wrong types and
+        ValueError for any other malformed instruction; the instructions
+        before it remain in the block.
+        """
+        ptrs = self._ptr.CreateBatch(llvm._extract_ptrs(values),
+                                     llvm._extract_ptrs(types),
+                                     list(code), list(results))
+        return [_make_value(p) for p in ptrs]
+
     # atomics
 
     def atomic_cmpxchg(self, ptr, old, new, ordering, crossthread=True):
@@ -2292,35 +2648,11 @@ def inline_function(call):
 def parse_environment_options(progname, envname):
     api.llvm.cl.ParseEnvironmentOptions(progname, envname)
 
-if api.llvm.InitializeNativeTarget():
-    raise llvm.LLVMException("No native target!?")
-if api.llvm.InitializeNativeTargetAsmPrinter():
-    # should this be an optional feature?
-    # should user trigger the initialization?
-    raise llvm.LLVMException("No native asm printer!?")
-
 #===----------------------------------------------------------------------===
 # Initialization
 #===----------------------------------------------------------------------===
 
-HAS_PTX = HAS_NVPTX = False
-
-if True: # use PTX?
-    try:
-        api.LLVMInitializePTXTarget()
-        api.LLVMInitializePTXTargetInfo()
-        api.LLVMInitializePTXTargetMC()
-        api.LLVMInitializePTXAsmPrinter()
-        HAS_PTX = True
-    except AttributeError:
-        try:
-            api.LLVMInitializeNVPTXTarget()
-            api.LLVMInitializeNVPTXTargetInfo()
-            api.LLVMInitializeNVPTXTargetMC()
-            api.LLVMInitializeNVPTXAsmPrinter()
-            HAS_NVPTX = True
-        except AttributeError:
-            pass
-
-
-
+# Targets are initialized on first use; see llvm.initialize_targets().
+# These tell whether the binding was built with a PTX or NVPTX backend.
+HAS_PTX = hasattr(api, 'LLVMInitializePTXTarget')
+HAS_NVPTX = not HAS_PTX and hasattr(api, 'LLVMInitializeNVPTXTarget')
@@ -33,6 +33,11 @@
 from io import BytesIO
 import contextlib
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
 import llvm
 from llvm import core
 from llvm.passes import TargetData, TargetTransformInfo
@@ -148,6 +153,7 @@ class EngineBuilder(llvm.Wrapper):
         tm --- Optional. Provide a TargetMachine.  Ownership is transfered
         to the returned execution engine.
         '''
+        llvm.initialize_targets()
         if tm is not None:
             engine = self._ptr.create(tm._ptr)
         else:
@@ -159,6 +165,7 @@ class EngineBuilder(llvm.Wrapper):
 
         Accept no arguments or (triple, march, mcpu, mattrs)
         '''
+        llvm.initialize_targets()
         if args:
             triple, march, mcpu, mattrs = args
             ptr = self._ptr.selectTarget(triple, march, mcpu,
@@ -191,6 +198,15 @@ class ExecutionEngine(llvm.Wrapper):
     def get_pointer_to_function(self, fn):
         return self._ptr.getPointerToFunction(fn._ptr)
 
+    def get_callable(self, fn):
+        '''Return a builtin function object that calls `fn` with Python
+        arguments, converting ints, floats and addresses to and from the
+        native types.  Much faster than run_function().
+        See llvm.fastcall.
+        '''
+        from llvm.fastcall import make_callable
+        return make_callable(self, fn)
+
     def get_pointer_to_global(self, val):
         return self._ptr.getPointerToGlobal(val._ptr)
 
@@ -218,6 +234,82 @@ class ExecutionEngine(llvm.Wrapper):
         ptr = self._ptr.getDataLayout()
         return TargetData(ptr)
 
+#===----------------------------------------------------------------------===
+# Background compilation
+#===----------------------------------------------------------------------===
+
+class BackgroundCompiler(object):
+    '''Compile functions and modules on a pool of worker threads.
+
+    Every submit_* method returns a concurrent.futures.Future.  Use
+    asyncio.wrap_future() to await it from a coroutine.
+
+    The compilations run one at a time on a single worker thread.  The
+    GIL is released during native code generation, so Python threads that
+    do not use LLVM keep running while the worker compiles.  But native
+    code generation holds the LLVM context lock, as every LLVM call does:
+    a thread that uses LLVM meanwhile, even to read a property, waits at
+    its next LLVM call until the function or object being compiled is
+    done.  More workers would give no speedup, since all LLVM work is
+    serialized.  The lock does not make a module consistent across calls,
+    so do not modify a module until the futures of its functions or
+    objects are resolved.
+
+    Usage:
+
+        with BackgroundCompiler(engine) as bc:
+            future = bc.submit_function(fn)
+            ...
+            addr = future.result()
+    '''
+
+    def __init__(self, engine):
+        if ThreadPoolExecutor is None:
+            raise ImportError("BackgroundCompiler requires "
+                              "concurrent.futures (the 'futures' package "
+                              "on Python 2)")
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit_function(self, fn):
+        '''Compile a function of a module owned by the engine.
+
+        Return a future of the address of the function.
+        '''
+        return self.executor.submit(self.engine.get_pointer_to_function, fn)
+
+    def submit_module(self, module):
+        '''Add the module to the engine and compile all the functions it
+        defines.
+
+        Return a future of a dictionary mapping function names to
+        addresses.  The module is added on the calling thread, which waits
+        for the function or object being compiled, if any.
+        '''
+        self.engine.add_module(module)
+        functions = [f for f in module.functions if not f.is_declaration]
+        return self.executor.submit(self._compile_functions, functions)
+
+    def _compile_functions(self, functions):
+        return dict((f.name, self.engine.get_pointer_to_function(f))
+                    for f in functions)
+
+    def submit_object(self, tm, module):
+        '''Emit native object code for the module with the TargetMachine.
+
+        Return a future of the object code as a byte string.
+        '''
+        return self.executor.submit(tm.emit_object, module)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
 #===----------------------------------------------------------------------===
 # Target machine
 #===----------------------------------------------------------------------===
@@ -226,8 +318,19 @@ def print_registered_targets():
     '''
     Note: print directly to stdout
     '''
+    llvm.initialize_targets('all')
     api.llvm.TargetRegistry.printRegisteredTargetsForVersion()
 
+def _initialize_target_for(name):
+    '''Initialize the target for a triple or an architecture name.
+    '''
+    if 'nvptx' in name:
+        llvm.initialize_targets('nvptx')
+    elif 'ptx' in name:
+        llvm.initialize_targets('ptx')
+    else:
+        llvm.initialize_targets('native')
+
 def get_host_cpu_name():
     '''return the string name of the host CPU
     '''
@@ -248,6 +351,7 @@ class TargetMachine(llvm.Wrapper):
             triple = get_default_triple()
         if not cpu:
             cpu = get_host_cpu_name()
+        _initialize_target_for(triple)
         with contextlib.closing(BytesIO()) as error:
             target = api.llvm.TargetRegistry.lookupTarget(triple, error)
             if not target:
@@ -276,6 +380,7 @@ class TargetMachine(llvm.Wrapper):
             For a list of available attributes (features),
             use: `llvm-as < /dev/null | llc -march=xyz -mattr=help`
             '''
+        _initialize_target_for(arch)
         triple = api.llvm.Triple.new()
         with contextlib.closing(BytesIO()) as error:
             target = api.llvm.TargetRegistry.lookupTarget(arch, triple, error)
@@ -291,31 +396,55 @@ class TargetMachine(llvm.Wrapper):
                 raise llvm.LLVMException("Cannot create target machine")
             return TargetMachine(tm)
 
-    def _emit_file(self, module, cgft):
+    def _emit_file(self, module, cgft, fileobj=None):
         pm = api.llvm.PassManager.new()
-        os = extra.make_raw_ostream_for_printing()
         pm.add(api.llvm.DataLayout.new(str(self.target_data)))
-        failed = self._ptr.addPassesToEmitFile(pm, os, cgft)
+        out = None
+        if fileobj is not None:
+            out = core._NativeOutput.open(fileobj)
+        if out is None:
+            os = extra.make_raw_ostream_for_printing()
+        else:
+            os = out.stream
+        fos = api.llvm.formatted_raw_ostream.new(os, False)
+        failed = self._ptr.addPassesToEmitFile(pm, fos, cgft)
+        if failed:
+            raise llvm.LLVMException("Target does not support this kind "
+                                     "of output file")
         pm.run(module)
+        del pm          # the passes write to `fos`
+        fos.flush()
+        del fos
 
+        if out is not None:
+            return out.finish()
 
         CGFT = api.llvm.TargetMachine.CodeGenFileType
         if cgft == CGFT.CGFT_ObjectFile:
-            return os.bytes()
+            output = os.bytes()
         else:
-            return os.str()
+            output = os.str()
+        if fileobj is None:
+            return output
+        fileobj.write(output)
 
-    def emit_assembly(self, module):
+    def emit_assembly(self, module, fileobj=None):
         '''returns byte string of the module as assembly code of the target machine
+
+        If a fileobj is given, the output is written to it directly (see
+        Module.to_bitcode() for the kinds of output supported).
         '''
         CGFT = api.llvm.TargetMachine.CodeGenFileType
-        return self._emit_file(module._ptr, CGFT.CGFT_AssemblyFile)
+        return self._emit_file(module._ptr, CGFT.CGFT_AssemblyFile, fileobj)
 
-    def emit_object(self, module):
+    def emit_object(self, module, fileobj=None):
         '''returns byte string of the module as native code of the target machine
+
+        If a fileobj is given, the output is written to it directly (see
+        Module.to_bitcode() for the kinds of output supported).
         '''
         CGFT = api.llvm.TargetMachine.CodeGenFileType
-        return self._emit_file(module._ptr, CGFT.CGFT_ObjectFile)
+        return self._emit_file(module._ptr, CGFT.CGFT_ObjectFile, fileobj)
 
     @property
     def target_data(self):
@@ -0,0 +1,269 @@
+"""
+Fast calls into JIT-compiled functions.
+
+ExecutionEngine.run_function boxes every argument in a GenericValue, and
+ctypes function pointers convert every argument in Python.  A trampoline
+is a native function with the CPython calling convention (METH_FASTCALL,
+or METH_VARARGS before Python 3.7) that unboxes the arguments with the C
+API, calls the JIT-compiled function and boxes the result.  Calling it
+costs about as much as calling a builtin function.
+
+Trampolines are compiled once per signature and shared by all the
+functions with that signature.  Supported types are integers of up to 64
+bits (signed), float, double and pointers (as int addresses); the return
+type can also be void.
+
+This module requires CPython.
+"""
+
+import sys
+import ctypes
+
+from llvm import core
+from llvm.core import Type, Constant, Builder
+
+METH_VARARGS = 0x0001
+METH_FASTCALL = 0x0080
+
+_USE_FASTCALL = sys.version_info >= (3, 7)
+
+class _PyMethodDef(ctypes.Structure):
+    _fields_ = [('ml_name', ctypes.c_char_p),
+                ('ml_meth', ctypes.c_void_p),
+                ('ml_flags', ctypes.c_int),
+                ('ml_doc', ctypes.c_char_p)]
+
+_PyCFunction_NewEx = ctypes.pythonapi.PyCFunction_NewEx
+_PyCFunction_NewEx.restype = ctypes.py_object
+_PyCFunction_NewEx.argtypes = [ctypes.POINTER(_PyMethodDef),
+                               ctypes.py_object, ctypes.py_object]
+
+
+def _capi_address(name):
+    return ctypes.cast(getattr(ctypes.pythonapi, name), ctypes.c_void_p).value
+
+def _type_code(ty, allow_void=False):
+    kind = ty.kind
+    if kind == core.TYPE_INTEGER and ty.width <= 64:
+        return 'i%d' % ty.width
+    elif kind == core.TYPE_FLOAT:
+        return 'f'
+    elif kind == core.TYPE_DOUBLE:
+        return 'd'
+    elif kind == core.TYPE_POINTER:
+        return 'p'
+    elif kind == core.TYPE_VOID and allow_void:
+        return 'v'
+    raise TypeError("type %s is not supported by fast calls" % ty)
+
+def signature_of(fnty):
+    '''Return the signature key of the FunctionType `fnty`, for example
+    "d(i32,d)".  Raises TypeError if the signature is not supported.
+    '''
+    if fnty.vararg:
+        raise TypeError("variadic functions are not supported by fast calls")
+    return '%s(%s)' % (_type_code(fnty.return_type, allow_void=True),
+                       ','.join(_type_code(ty) for ty in fnty.args))
+
+
+class _TrampolineBuilder(object):
+    '''Emit the IR of a trampoline for a function type.
+    '''
+
+    def __init__(self, module, fnty):
+        self.module = module
+        self.fnty = fnty
+        self.pyobj = Type.pointer(Type.int(8))
+        self.ssize = Type.int(ctypes.sizeof(ctypes.c_ssize_t) * 8)
+        self.intptr = Type.int(ctypes.sizeof(ctypes.c_void_p) * 8)
+
+    def capi(self, name, retty, argtys):
+        fnty = Type.function(retty, argtys)
+        addr = Constant.int(self.intptr, _capi_address(name))
+        return addr.inttoptr(Type.pointer(fnty))
+
+    def object_constant(self, addr):
+        return Constant.int(self.intptr, addr).inttoptr(self.pyobj)
+
+    def string_constant(self, text):
+        init = Constant.stringz(text)
+        gv = self.module.add_global_variable(init.type, '.str')
+        gv.initializer = init
+        gv.global_constant = True
+        gv.linkage = core.LINKAGE_INTERNAL
+        zero = Constant.int(Type.int(), 0)
+        return gv.gep([zero, zero])
+
+    def build(self):
+        pyobj, ssize = self.pyobj, self.ssize
+        nparams = len(self.fnty.args)
+        if _USE_FASTCALL:
+            params = [pyobj, Type.pointer(pyobj), ssize]
+        else:
+            params = [pyobj, pyobj]
+        fn = self.module.add_function(Type.function(pyobj, params),
+                                      'trampoline')
+        entry = fn.append_basic_block('entry')
+        convert = fn.append_basic_block('convert')
+        call = fn.append_basic_block('call')
+        fail = fn.append_basic_block('fail')
+        error = fn.append_basic_block('error')
+
+        b = Builder.new(entry)
+        get_item = self.capi('PyTuple_GetItem', pyobj, [pyobj, ssize])
+        if _USE_FASTCALL:
+            self_, argv, nargs = fn.args
+        else:
+            self_, argtuple = fn.args
+            nargs = b.call(self.capi('PyTuple_Size', ssize, [pyobj]),
+                           [argtuple])
+        expected = Constant.int(ssize, nparams)
+        b.cbranch(b.icmp(core.ICMP_EQ, nargs, expected), convert, fail)
+
+        # wrong number of arguments
+        b.position_at_end(fail)
+        message = "function takes exactly %d argument%s" % (
+                  nparams, '' if nparams == 1 else 's')
+        set_string = self.capi('PyErr_SetString', Type.void(),
+                               [pyobj, Type.pointer(Type.int(8))])
+        type_error = ctypes.c_void_p.in_dll(ctypes.pythonapi,
+                                            'PyExc_TypeError').value
+        b.call(set_string, [self.object_constant(type_error),
+                            self.string_constant(message)])
+        b.ret(Constant.null(pyobj))
+
+        # an exception is set
+        b.position_at_end(error)
+        b.ret(Constant.null(pyobj))
+
+        # unbox the arguments, stopping at the first that fails
+        b.position_at_end(convert)
+        occurred = self.capi('PyErr_Occurred', pyobj, [])
+        args = []
+        for i, ty in enumerate(self.fnty.args):
+            index = Constant.int(ssize, i)
+            if _USE_FASTCALL:
+                obj = b.load(b.gep(argv, [index]))
+            else:
+                obj = b.call(get_item, [argtuple, index])
+                self.check_null(b, obj, error)
+            args.append(self.unbox(b, obj, ty))
+            self.check_null(b, b.call(occurred, []), error, expect_null=True)
+        b.branch(call)
+
+        # call the function, whose address is the first item of `self`
+        b.position_at_end(call)
+        addrobj = b.call(get_item, [self_, Constant.int(ssize, 0)])
+        self.check_null(b, addrobj, error)
+        as_voidptr = self.capi('PyLong_AsVoidPtr', pyobj, [pyobj])
+        addr = b.call(as_voidptr, [addrobj])
+        self.check_null(b, addr, error)
+        callee = b.bitcast(addr, Type.pointer(self.fnty))
+        result = b.call(callee, args)
+        b.ret(self.box(b, result, self.fnty.return_type))
+        return fn
+
+    def check_null(self, b, ptr, error, expect_null=False):
+        '''Branch to `error` if `ptr` is NULL (or is not NULL if
+        `expect_null`), and continue in a new block otherwise.
+        '''
+        pred = core.ICMP_NE if expect_null else core.ICMP_EQ
+        failed = b.icmp(pred, ptr, Constant.null(ptr.type))
+        ok = b.basic_block.function.append_basic_block('ok')
+        b.cbranch(failed, error, ok)
+        b.position_at_end(ok)
+
+    def unbox(self, b, obj, ty):
+        pyobj = self.pyobj
+        kind = ty.kind
+        if kind == core.TYPE_INTEGER:
+            as_long = self.capi('PyLong_AsLongLong', Type.int(64), [pyobj])
+            val = b.call(as_long, [obj])
+            if ty.width == 1:
+                return b.icmp(core.ICMP_NE, val, Constant.int(val.type, 0))
+            elif ty.width < 64:
+                return b.trunc(val, ty)
+            return val
+        elif kind in (core.TYPE_FLOAT, core.TYPE_DOUBLE):
+            as_double = self.capi('PyFloat_AsDouble', Type.double(), [pyobj])
+            val = b.call(as_double, [obj])
+            if kind == core.TYPE_FLOAT:
+                return b.fptrunc(val, ty)
+            return val
+        else:
+            as_voidptr = self.capi('PyLong_AsVoidPtr', pyobj, [pyobj])
+            return b.bitcast(b.call(as_voidptr, [obj]), ty)
+
+    def box(self, b, val, ty):
+        pyobj = self.pyobj
+        kind = ty.kind
+        if kind == core.TYPE_VOID:
+            none = self.object_constant(id(None))
+            b.call(self.capi('Py_IncRef', Type.void(), [pyobj]), [none])
+            return none
+        elif kind == core.TYPE_INTEGER:
+            if ty.width == 1:
+                from_long = self.capi('PyBool_FromLong', pyobj,
+                                      [Type.int(64)])
+                return b.call(from_long, [b.zext(val, Type.int(64))])
+            if ty.width < 64:
+                val = b.sext(val, Type.int(64))
+            from_long = self.capi('PyLong_FromLongLong', pyobj,
+                                  [Type.int(64)])
+            return b.call(from_long, [val])
+        elif kind in (core.TYPE_FLOAT, core.TYPE_DOUBLE):
+            if kind == core.TYPE_FLOAT:
+                val = b.fpext(val, Type.double())
+            from_double = self.capi('PyFloat_FromDouble', pyobj,
+                                    [Type.double()])
+            return b.call(from_double, [val])
+        else:
+            from_voidptr = self.capi('PyLong_FromVoidPtr', pyobj, [pyobj])
+            return b.call(from_voidptr, [b.bitcast(val, pyobj)])
+
+
+class _Trampoline(object):
+    def __init__(self, fnty):
+        from llvm import ee
+        self.module = core.Module.new('trampoline')
+        fn = _TrampolineBuilder(self.module, fnty).build()
+        fn.verify()
+        self.engine = ee.EngineBuilder.new(self.module).opt(2).create()
+        self.address = self.engine.get_pointer_to_function(fn)
+
+# signature -> _Trampoline
+_trampolines = {}
+
+def trampoline_for(fnty):
+    '''Return the address of the trampoline for the FunctionType `fnty`.
+    '''
+    sig = signature_of(fnty)
+    tramp = _trampolines.get(sig)
+    if tramp is None:
+        tramp = _trampolines[sig] = _Trampoline(fnty)
+    return tramp.address
+
+def make_callable(engine, fn, addr=None, owner=None):
+    '''Return a builtin function object that calls the function `fn`
+    compiled by `engine`.
+
+    addr --- The address of the native code of `fn`.  Default to
+    engine.get_pointer_to_function(fn).
+    owner --- The object that owns the code at `addr`, if it is not
+    `engine`; e.g. the owner returned by
+    FunctionPointerCache.get_function_pointer().
+
+    The callable keeps a reference to `engine` and `owner`.
+    '''
+    fnty = fn.type.pointee
+    tramp = trampoline_for(fnty)
+    if addr is None:
+        addr = engine.get_pointer_to_function(fn)
+    name = fn.name.encode('utf8')
+    methdef = _PyMethodDef(name, tramp,
+                           METH_FASTCALL if _USE_FASTCALL else METH_VARARGS,
+                           None)
+    # `self` of the builtin function: the trampoline reads the address of
+    # the function from the first item; the others are kept alive.
+    state = (addr, engine, methdef, name, owner)
+    return _PyCFunction_NewEx(ctypes.byref(methdef), state, None)
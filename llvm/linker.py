@@ -0,0 +1,204 @@
+"""
+Incremental linking of a runtime library.
+
+Module.link_in copies the whole source module, even when the destination
+only calls a handful of its functions.  LinkSession indexes the global
+symbols of a runtime module once, and then links into a module only the
+functions and global variables that the module refers to, together with
+everything they refer to in turn.
+
+The partial runtimes are kept, keyed by the set of symbols they define,
+so that modules that refer to the same symbols are linked without
+extracting the symbols again.
+"""
+
+from llvm import core, passes
+
+_LOCAL_LINKAGES = frozenset([core.LINKAGE_INTERNAL,
+                             core.LINKAGE_PRIVATE,
+                             core.LINKAGE_LINKER_PRIVATE,
+                             core.LINKAGE_LINKER_PRIVATE_WEAK])
+
+
+def _collect_refs(user, refs, seen):
+    '''Add the names of the global values used by the operands of `user`
+    to `refs`, looking through constant expressions and unnamed globals.
+    '''
+    for op in user.iter_operands():
+        if op in seen:
+            continue
+        if isinstance(op, core.GlobalValue):
+            if op.name:
+                refs.add(op.name)
+                continue
+            # unnamed globals cannot be referred to by name;
+            # depend on whatever they refer to instead.
+            seen.add(op)
+            if isinstance(op, core.Function):
+                _collect_function_refs(op, refs, seen)
+            elif isinstance(op, core.GlobalVariable):
+                if op.initializer is not None:
+                    _collect_refs_in_constant(op.initializer, refs, seen)
+        elif isinstance(op, core.Constant):
+            seen.add(op)
+            _collect_refs(op, refs, seen)
+
+def _collect_refs_in_constant(const, refs, seen):
+    if isinstance(const, core.GlobalValue):
+        if const.name:
+            refs.add(const.name)
+    else:
+        _collect_refs(const, refs, seen)
+
+def _collect_function_refs(fn, refs, seen):
+    for bb in fn.iter_basic_blocks():
+        for inst in bb.iter_instructions():
+            _collect_refs(inst, refs, seen)
+
+
+class LinkSession(object):
+    '''Link the parts of a runtime module that are used by other modules.
+
+    Usage:
+
+        session = LinkSession(runtime)
+        for module in generated_modules:
+            session.link_into(module)
+
+    The session keeps a reference to `runtime` and never modifies it.
+    Call `reindex()` after changing the runtime.
+
+    Special globals, such as llvm.global_ctors, are not linked.
+
+    ``hits`` and ``misses`` count the partial runtimes that were found
+    in, or added to, the cache of this instance.
+    '''
+
+    def __init__(self, runtime, max_cached=32):
+        self.runtime = runtime
+        self.max_cached = max_cached
+        self.hits = 0
+        self.misses = 0
+        self.reindex()
+
+    def reindex(self):
+        '''Rebuild the symbol index and drop the cached partial runtimes.
+        '''
+        self._deps = {}         # name -> set of names used by the symbol
+        self._defined = set()   # names of the symbols defined
+        self._local = set()     # names of the symbols with local linkage
+        self._cache = {}        # frozenset of names -> partial runtime
+        self._order = []
+
+        for fn in self.runtime.iter_functions():
+            if not fn.name or fn.name.startswith('llvm.'):
+                continue
+            refs = set()
+            _collect_function_refs(fn, refs, set())
+            self._add_symbol(fn, refs)
+
+        for gv in self.runtime.iter_global_variables():
+            if not gv.name or gv.name.startswith('llvm.'):
+                continue
+            refs = set()
+            if gv.initializer is not None:
+                _collect_refs_in_constant(gv.initializer, refs, set())
+            self._add_symbol(gv, refs)
+
+    def _add_symbol(self, gval, refs):
+        refs.discard(gval.name)
+        self._deps[gval.name] = refs
+        if not gval.is_declaration:
+            self._defined.add(gval.name)
+        if gval.linkage in _LOCAL_LINKAGES:
+            self._local.add(gval.name)
+
+    @property
+    def symbols(self):
+        '''Names of the symbols defined by the runtime.
+        '''
+        return frozenset(self._defined - self._local)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def missing_symbols(self, module):
+        '''Return the set of names that `module` declares and the runtime
+        defines.
+        '''
+        names = set()
+        for gval in module.iter_functions():
+            if gval.is_declaration:
+                names.add(gval.name)
+        for gval in module.iter_global_variables():
+            if gval.is_declaration:
+                names.add(gval.name)
+        return (names & self._defined) - self._local
+
+    def closure(self, names, exclude=()):
+        '''Return the set of runtime symbols that are needed to define the
+        symbols in `names`.  Symbols in `exclude` are assumed to be
+        defined elsewhere, so their dependencies are not followed.
+        '''
+        exclude = set(exclude) - self._local
+        needed = set()
+        pending = [name for name in names if name not in exclude]
+        while pending:
+            name = pending.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            for dep in self._deps.get(name, ()):
+                if dep not in needed and dep not in exclude:
+                    pending.append(dep)
+        return needed
+
+    def partial_runtime(self, names):
+        '''Return a module that contains the definitions of the runtime
+        symbols in `names` and declarations of the symbols they use.
+
+        The module is owned by the session and must not be modified.
+        '''
+        key = frozenset(names)
+        partial = self._cache.get(key)
+        if partial is not None:
+            self.hits += 1
+            return partial
+        self.misses += 1
+        partial = self._extract(key)
+        if len(self._order) >= self.max_cached:
+            del self._cache[self._order.pop(0)]
+        self._cache[key] = partial
+        self._order.append(key)
+        return partial
+
+    def _extract(self, needed):
+        module = self.runtime.clone()
+        # Turn the symbols that are not needed into declarations, and
+        # let globaldce remove those that are no longer used.
+        for fn in module.functions:
+            if fn.name and fn.name not in needed and not fn.is_declaration:
+                fn._ptr.deleteBody()
+        for gv in module.global_variables:
+            if gv.name and gv.name not in needed:
+                del gv.initializer
+                gv.linkage = core.LINKAGE_EXTERNAL
+        pm = passes.PassManager.new()
+        pm.add('globaldce')
+        pm.run(module)
+        return module
+
+    def link_into(self, module):
+        '''Link the runtime symbols that `module` needs into `module`.
+        Return the set of names of the symbols that were linked.
+        '''
+        roots = self.missing_symbols(module)
+        if not roots:
+            return roots
+        defined = set(gval.name for gval in module.iter_functions()
+                      if not gval.is_declaration)
+        defined.update(gval.name for gval in module.iter_global_variables()
+                       if not gval.is_declaration)
+        needed = self.closure(roots, exclude=defined)
+        module.link_in(self.partial_runtime(needed), preserve=True)
+        return needed
@@ -35,9 +35,15 @@ All transformation passes listed at http://www.llvm.org/docs/Passes.html
 are available.
 """
 
+import re
+import sys
+import timeit
+import weakref
+from collections import namedtuple
+
 import llvm                 # top-level, for common stuff
 import llvm.core as core    # module, function etc.
-from llvmpy import api
+from llvmpy import api, extra
 
 #===----------------------------------------------------------------------===
 # Pass manager builder
@@ -128,7 +134,14 @@ class PassManagerBuilder(llvm.Wrapper):
 class PassManager(llvm.Wrapper):
 
     @staticmethod
-    def new():
+    def new(profile=False):
+        '''Create an empty pass manager.
+
+        profile --- If True, the pass manager can profile its passes.  See
+        run().
+        '''
+        if profile:
+            return PassManager(api.llvm.PassManager.newProfiling())
         return PassManager(api.llvm.PassManager.new())
 
     def add(self, pass_obj):
@@ -142,21 +155,40 @@ class PassManager(llvm.Wrapper):
             self._add_pass(str(pass_obj))
 
     def _add_pass(self, pass_name):
+        passes = _registered_passes()
         passreg = api.llvm.PassRegistry.getPassRegistry()
         a_pass = passreg.getPassInfo(pass_name).createPass()
         if not a_pass:
-            assert pass_name not in PASSES, "Registered but not found?"
+            assert pass_name not in passes, "Registered but not found?"
             raise llvm.LLVMException('Invalid pass name "%s"' % pass_name)
         self._ptr.add(a_pass)
 
-    def run(self, module):
+    def run(self, module, profile=False, statistics=False):
+        '''Run the passes on `module`.  Returns True if the module was
+        modified.
+
+        profile --- If True, time the passes and count the instructions
+        that they add or remove, and return a PassProfile instead.  The
+        pass manager must have been created with new(profile=True).
+        statistics --- If True, the profile also collects the LLVM
+        statistics (like -stats).  This enables the statistics for the
+        rest of the process, since LLVM cannot disable them again, and
+        LLVM builds with assertions then print them at exit.
+        '''
+        if profile:
+            return _profiled_run(self, module, statistics)
+        elif statistics:
+            raise ValueError("statistics requires profile=True")
         return self._ptr.run(module._ptr)
 
 class FunctionPassManager(PassManager):
 
     @staticmethod
-    def new(module):
-        ptr = api.llvm.FunctionPassManager.new(module._ptr)
+    def new(module, profile=False):
+        if profile:
+            ptr = api.llvm.FunctionPassManager.newProfiling(module._ptr)
+        else:
+            ptr = api.llvm.FunctionPassManager.new(module._ptr)
         return FunctionPassManager(ptr)
 
     def __init__(self, ptr):
@@ -165,12 +197,94 @@ class FunctionPassManager(PassManager):
     def initialize(self):
         self._ptr.doInitialization()
 
-    def run(self, fn):
+    def run(self, fn, profile=False, statistics=False):
+        '''Run the passes on `fn`.  See PassManager.run().
+        '''
+        if profile:
+            return _profiled_run(self, fn, statistics)
+        elif statistics:
+            raise ValueError("statistics requires profile=True")
         return self._ptr.run(fn._ptr)
 
     def finalize(self):
         self._ptr.doFinalization()
 
+#===----------------------------------------------------------------------===
+# Profiling
+#===----------------------------------------------------------------------===
+
+PassTiming = namedtuple('PassTiming', ['name', 'wall_time', 'user_time',
+                                       'system_time', 'instruction_delta'])
+
+class PassProfile(namedtuple('PassProfile', ['changed', 'wall_time',
+                                             'passes', 'statistics',
+                                             'instructions'])):
+    '''Result of PassManager.run(..., profile=True).
+
+        changed --- Whether the passes modified the IR.
+        wall_time --- Duration of the run in seconds.
+        passes --- A list of PassTiming, one per pass, in the order of the
+        pipeline.  Times are in seconds and include the analyses that LLVM
+        scheduled for the pass.  instruction_delta is the number of
+        instructions that the pass added, minus those it removed.
+        statistics --- A dict that maps (pass name, description) of each
+        LLVM statistic to its increase during the run, or None if the
+        statistics were not requested.  LLVM only keeps statistics in
+        builds with assertions enabled; otherwise, the dict is empty.
+        instructions --- Number of instructions before and after the run.
+    '''
+    __slots__ = ()
+
+    @property
+    def instruction_delta(self):
+        before, after = self.instructions
+        return after - before
+
+def _instruction_count(unit):
+    if isinstance(unit, core.Module):
+        return sum(_instruction_count(fn) for fn in unit.iter_functions())
+    return sum(bb.instruction_count for bb in unit.iter_basic_blocks())
+
+def _print_statistics():
+    os = extra.make_raw_ostream_for_printing()
+    api.llvm.PrintStatistics(os)
+    return os.str()
+
+_RE_STATISTIC = re.compile(r'^\s*(\d+)\s+(\S+)\s+- (.*?)\s*$')
+
+def _parse_statistics(text):
+    stats = {}
+    for line in text.splitlines():
+        m = _RE_STATISTIC.match(line)
+        if m:
+            stats[m.group(2), m.group(3)] = int(m.group(1))
+    return stats
+
+def _profiled_run(pm, unit, collect_statistics):
+    if collect_statistics:
+        api.llvm.EnableStatistics()
+        stats_before = _parse_statistics(_print_statistics())
+    instructions_before = _instruction_count(unit)
+
+    if not pm._ptr.startProfile(unit._ptr):
+        raise ValueError("pass manager was not created with profile=True")
+    start = timeit.default_timer()
+    try:
+        changed = pm._ptr.run(unit._ptr)
+    finally:
+        wall_time = timeit.default_timer() - start
+        timings = [PassTiming(*t) for t in pm._ptr.finishProfile()]
+
+    statistics = None
+    if collect_statistics:
+        statistics = {}
+        for key, value in _parse_statistics(_print_statistics()).items():
+            delta = value - stats_before.get(key, 0)
+            if delta:
+                statistics[key] = delta
+    instructions = (instructions_before, _instruction_count(unit))
+    return PassProfile(changed, wall_time, timings, statistics, instructions)
+
 #===----------------------------------------------------------------------===
 # Passes
 #===----------------------------------------------------------------------===
@@ -187,6 +301,7 @@ class Pass(llvm.Wrapper):
             the process if an the pass requires arguments to construct.
             The error cannot be caught.
             '''
+        _registered_passes()
         passreg = api.llvm.PassRegistry.getPassRegistry()
         a_pass = passreg.getPassInfo(name).createPass()
         p = Pass(a_pass)
@@ -300,7 +415,8 @@ class TargetTransformInfo(Pass):
 #===----------------------------------------------------------------------===
 
 def build_pass_managers(tm, opt=2, loop_vectorize=False, vectorize=False,
-                        inline_threshold=2000, pm=True, fpm=True, mod=None):
+                        inline_threshold=2000, pm=True, fpm=True, mod=None,
+                        cache=False, profile=False):
     '''
         tm --- The TargetMachine for which the passes are optimizing for.
         The TargetMachine must stay alive until the pass managers
@@ -313,13 +429,32 @@ def build_pass_managers(tm, opt=2, loop_vectorize=False, vectorize=False,
         pm --- [boolean] Whether to build a module-level pass-manager.
         fpm --- [boolean] Whether to build a function-level pass-manager.
         mod --- [Module] The module object for the FunctionPassManager.
+        cache --- [boolean] Whether to return the pass managers built with
+        the same arguments before.  See build_pipeline().
+        profile --- [boolean] Whether the pass managers can profile their
+        passes.  See PassManager.run().
         '''
+    if cache:
+        key = (('build_pass_managers', opt, loop_vectorize, vectorize,
+                inline_threshold, bool(pm), bool(fpm), bool(profile)),
+               _pipeline_ref(tm), _pipeline_ref(mod if fpm else None))
+        pms = _pipeline_cache.get(key)
+        if pms is None:
+            pms = build_pass_managers(tm, opt=opt,
+                                      loop_vectorize=loop_vectorize,
+                                      vectorize=vectorize,
+                                      inline_threshold=inline_threshold,
+                                      pm=pm, fpm=fpm, mod=mod,
+                                      profile=profile)
+            _pipeline_cache[key] = pms
+        return pms
+
     if pm:
-        pm = PassManager.new()
+        pm = PassManager.new(profile=profile)
     if fpm:
         if not mod:
             raise TypeError("Keyword 'mod' must be defined")
-        fpm = FunctionPassManager.new(mod)
+        fpm = FunctionPassManager.new(mod, profile=profile)
 
     # Populate PassManagers with target specific passes
     pmb = PassManagerBuilder.new()
@@ -329,35 +464,245 @@ def build_pass_managers(tm, opt=2, loop_vectorize=False, vectorize=False,
     if inline_threshold:
         pmb.use_inliner_with_threshold(inline_threshold)
     if pm:
-        pm.add(tm.target_data.clone())
-        pm.add(TargetLibraryInfo.new(tm.triple))
-        if llvm.version >= (3, 2):
-            pm.add(TargetTransformInfo.new(tm))
+        _add_target_passes(pm, tm)
         pmb.populate(pm)
 
     if fpm:
-        fpm.add(tm.target_data.clone())
-        fpm.add(TargetLibraryInfo.new(tm.triple))
-        if llvm.version >= (3, 2):
-            fpm.add(TargetTransformInfo.new(tm))
+        _add_target_passes(fpm, tm)
         pmb.populate(fpm)
         fpm.initialize()
 
-    from collections import namedtuple
     return namedtuple('passmanagers', ['pm', 'fpm'])(pm=pm, fpm=fpm)
 
+def _add_target_passes(pm, tm):
+    pm.add(tm.target_data.clone())
+    pm.add(TargetLibraryInfo.new(tm.triple))
+    if llvm.version >= (3, 2):
+        pm.add(TargetTransformInfo.new(tm))
+
+#===----------------------------------------------------------------------===
+# Pipelines
+#===----------------------------------------------------------------------===
+
+_PIPELINE_GROUPS = ('module', 'cgscc', 'function', 'loop')
+_RE_PIPELINE_TOKEN = re.compile(r'\s*(?:([-\w.]+)|([(),]))')
+
+def _tokenize_pipeline(spec):
+    pos = 0
+    spec = spec.rstrip()
+    while pos < len(spec):
+        m = _RE_PIPELINE_TOKEN.match(spec, pos)
+        if not m:
+            raise ValueError("invalid pipeline %r at offset %d" % (spec, pos))
+        yield m.group(1) or m.group(2)
+        pos = m.end()
+
+def _resolve_pass_name(name, group):
+    passes = _registered_passes()
+    if name in passes:
+        return name
+    if group is not None and '%s-%s' % (group, name) in passes:
+        return '%s-%s' % (group, name)
+    raise llvm.LLVMException('Invalid pass name "%s"' % name)
+
+def parse_pipeline(spec):
+    '''Parse a pipeline description into a list of pass names.
+
+    The description is a comma-separated list of the names of the
+    passes, as in PASSES, for example:
+
+        "mem2reg,instcombine,gvn,loop(licm,unroll)"
+
+    Passes can be grouped with module(...), cgscc(...), function(...) and
+    loop(...).  Within a group, a pass name can omit the prefix of the
+    group: loop(unroll) is "loop-unroll".  Groups do not change the
+    pipeline; the pass managers nest passes by their scope on their own.
+    '''
+    tokens = list(_tokenize_pipeline(spec))
+    names = []
+    pos = _parse_pipeline_list(spec, tokens, 0, None, names)
+    if pos < len(tokens):
+        raise ValueError("unexpected %r in pipeline %r" % (tokens[pos], spec))
+    return names
+
+def _parse_pipeline_list(spec, tokens, pos, group, names):
+    while True:
+        if pos >= len(tokens) or tokens[pos] in ('(', ')', ','):
+            raise ValueError("expected a pass name in pipeline %r" % spec)
+        name = tokens[pos]
+        pos += 1
+        if pos < len(tokens) and tokens[pos] == '(':
+            if name not in _PIPELINE_GROUPS:
+                raise ValueError("unknown pass group %r in pipeline %r"
+                                 % (name, spec))
+            pos = _parse_pipeline_list(spec, tokens, pos + 1, name, names)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise ValueError("missing ')' in pipeline %r" % spec)
+            pos += 1
+        else:
+            names.append(_resolve_pass_name(name, group))
+        if pos < len(tokens) and tokens[pos] == ',':
+            pos += 1
+        else:
+            return pos
+
+# Pass managers built by build_pipeline() and friends, keyed by the pass
+# names (or the build arguments) and weak references to the TargetMachine
+# and the Module.
+_pipeline_cache = {}
+
+def _drop_pipelines(ref):
+    for key in [k for k in _pipeline_cache if ref in k[1:]]:
+        del _pipeline_cache[key]
+
+def _pipeline_ref(obj):
+    if obj is None:
+        return None
+    return weakref.ref(obj, _drop_pipelines)
+
+def clear_pipeline_cache():
+    '''Forget the pass managers built by build_pipeline(),
+    function_pass_manager() and build_pass_managers(cache=True).
+    '''
+    _pipeline_cache.clear()
+
+def build_pipeline(spec, tm=None, mod=None, cache=True):
+    '''Build a pass manager for a pipeline description (see
+    parse_pipeline).
+
+        tm --- [TargetMachine] If given, the target data, library info
+        and transform info passes of the TargetMachine are added first.
+        mod --- [Module] If given, build an initialized
+        FunctionPassManager for the module; otherwise, build a
+        PassManager.
+        cache --- [boolean] Whether to return the pass manager built
+        for the same pipeline, TargetMachine and Module before.  Cached
+        pass managers are shared and must not be modified.  They are
+        dropped when the TargetMachine or the Module is freed.
+    '''
+    names = parse_pipeline(spec)
+    if cache:
+        key = (','.join(names), _pipeline_ref(tm), _pipeline_ref(mod))
+        pm = _pipeline_cache.get(key)
+        if pm is not None:
+            return pm
+
+    if mod is None:
+        pm = PassManager.new()
+    else:
+        pm = FunctionPassManager.new(mod)
+    if tm is not None:
+        _add_target_passes(pm, tm)
+    for name in names:
+        pm.add(name)
+    if mod is not None:
+        pm.initialize()
+
+    if cache:
+        _pipeline_cache[key] = pm
+    return pm
+
+def function_pass_manager(mod, opt=2, tm=None):
+    '''Return an initialized FunctionPassManager for `mod`, populated by
+    a PassManagerBuilder at optimization level `opt`, after the target
+    passes of `tm` if given.
+
+    The pass managers are pooled per module, optimization level and
+    TargetMachine, and are shared by all callers: run them, but do not
+    add passes to them.
+    '''
+    key = (('function_pass_manager', opt), _pipeline_ref(tm),
+           _pipeline_ref(mod))
+    fpm = _pipeline_cache.get(key)
+    if fpm is None:
+        fpm = FunctionPassManager.new(mod)
+        if tm is not None:
+            _add_target_passes(fpm, tm)
+        pmb = PassManagerBuilder.new()
+        pmb.opt_level = opt
+        pmb.populate(fpm)
+        fpm.initialize()
+        _pipeline_cache[key] = fpm
+    return fpm
+
+
+def _optimize_bitcode(args):
+    '''Worker of optimize_parallel.  Runs in the child processes.
+    '''
+    from io import BytesIO
+    from llvm.ee import TargetMachine
+    bitcode, options, output = args
+    module = core.Module.from_bitcode(BytesIO(bitcode))
+    tm = TargetMachine.new(options['triple'], options['cpu'],
+                           options['features'], options['opt'])
+    pms = build_pass_managers(tm, opt=options['opt'],
+                              loop_vectorize=options['loop_vectorize'],
+                              vectorize=options['vectorize'],
+                              inline_threshold=options['inline_threshold'],
+                              fpm=False)
+    pms.pm.run(module)
+    if output == 'object':
+        return tm.emit_object(module)
+    return module.to_bitcode()
+
+def optimize_parallel(modules, opt=2, loop_vectorize=False, vectorize=False,
+                      inline_threshold=2000, triple='', cpu='', features='',
+                      output='bitcode', processes=None):
+    '''Optimize independent modules on a pool of processes.
+
+    Each module is sent to a worker process as bitcode.  The worker builds
+    the pass managers with build_pass_managers() and the given settings,
+    for a TargetMachine created from triple, cpu and features (default to
+    the host), and runs them on the module.
+
+        modules --- A sequence of Module or of bitcode byte strings.
+        output --- 'bitcode' to get the optimized modules as bitcode, or
+        'object' to get native object code.
+        processes --- Number of worker processes.  Default to the number
+        of CPUs.
+
+    Returns a list of byte strings in the order of `modules`.  Use
+    Module.from_bitcode() to load optimized bitcode.
+    '''
+    import multiprocessing
+    if output not in ('bitcode', 'object'):
+        raise ValueError("output must be 'bitcode' or 'object'")
+    options = dict(opt=opt, loop_vectorize=loop_vectorize,
+                   vectorize=vectorize, inline_threshold=inline_threshold,
+                   triple=triple, cpu=cpu, features=features)
+    jobs = []
+    for m in modules:
+        bitcode = m.to_bitcode() if isinstance(m, core.Module) else m
+        jobs.append((bitcode, options, output))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_optimize_bitcode, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
 #===----------------------------------------------------------------------===
 # Misc.
 #===----------------------------------------------------------------------===
 
-# Intialize passes
-PASSES = None
+# The pass registry is initialized on first use: by PassManager.add() and
+# Pass.new(), or when PASSES or one of the PASS_* names is looked up.
+# PASS_* are the names of the registered passes: PASS_LOOP_UNROLL is
+# "loop-unroll".
 
 def _dump_all_passes():
     passreg = api.llvm.PassRegistry.getPassRegistry()
     for name, desc in passreg.enumerate():
         yield name, desc
 
+def _registered_passes():
+    try:
+        return PASSES
+    except NameError:
+        _initialize_passes()
+        return PASSES
+
 def _initialize_passes():
     global PASSES
 
@@ -374,16 +719,36 @@ def _initialize_passes():
     api.llvm.initializeInstrumentation(passreg)
     api.llvm.initializeTarget(passreg)
 
-    PASSES = dict(_dump_all_passes())
+    passes = dict(_dump_all_passes())
 
     # build globals
     def transform(name):
         return "PASS_%s" % (name.upper().replace('-', '_'))
 
     global_symbols = globals()
-    for i in PASSES:
+    for i in passes:
         assert i not in global_symbols
         global_symbols[transform(i)] = i
-
-_initialize_passes()
-
+    PASSES = passes
+
+# `import *` does not export PASSES and the PASS_* names, so that it does
+# not initialize the registry.  Import them by name, or use the module.
+__all__ = ['llvm', 'core', 'api', 'PassManagerBuilder', 'PassManager',
+           'FunctionPassManager', 'Pass', 'TargetData', 'TargetLibraryInfo',
+           'TargetTransformInfo', 'build_pass_managers']
+
+def __getattr__(name):
+    # Module attribute hook (PEP 562)
+    if name == 'PASSES' or name.startswith('PASS_'):
+        _registered_passes()
+        if name in globals():
+            return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    _registered_passes()
+    return sorted(globals())
+
+if sys.version_info < (3, 7):
+    # No module __getattr__ before Python 3.7
+    _initialize_passes()
@@ -9,6 +9,7 @@ import unittest
 import subprocess
 import tempfile
 import contextlib
+from io import BytesIO
 from distutils.spawn import find_executable
 
 is_py3k = sys.version_info[0] >= 3
@@ -111,10 +112,189 @@ class TestAsm(TestCase):
 
         self.assertEqual(str(m2).strip(), asm.strip())
 
+    def test_bitcode_buffers(self):
+        m = Module.new('module1')
+        m.add_global_variable(Type.int(), 'i')
+        bc = m.to_bitcode()
+        for buf in [bc, bytearray(bc), memoryview(bc), BytesIO(bc)]:
+            m2 = Module.from_bitcode(buf)
+            m2.id = m.id
+            self.assertEqual(str(m2).strip(), str(m).strip())
+
+    def test_bitcode_outputs(self):
+        m = Module.new('module1')
+        m.add_global_variable(Type.int(), 'i')
+        bc = m.to_bitcode()
+
+        # path
+        path = os.path.join(self.tmpdir, 'out.bc')
+        self.assertTrue(m.to_bitcode(path) is None)
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), bc)
+
+        # file descriptor
+        fd = os.open(path, os.O_WRONLY | os.O_TRUNC)
+        try:
+            m.to_bitcode(fd)
+        finally:
+            os.close(fd)
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), bc)
+
+        # file object, keeps track of its position
+        with open(path, 'wb') as fout:
+            fout.write(b'head')
+            m.to_bitcode(fout)
+            self.assertEqual(fout.tell(), len(bc) + 4)
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), b'head' + bc)
+
+        # writable buffer
+        buf = bytearray(len(bc) + 10)
+        self.assertEqual(m.to_bitcode(buf), len(bc))
+        self.assertEqual(bytes(buf[:len(bc)]), bc)
+        with self.assertRaises(ValueError):
+            m.to_bitcode(bytearray(len(bc) - 1))
+
+    def test_object_outputs(self):
+        m = Module.new('module1')
+        m.add_global_variable(Type.int(), 'i')
+        tm = le.TargetMachine.new()
+        obj = tm.emit_object(m)
+
+        path = os.path.join(self.tmpdir, 'out.o')
+        tm.emit_object(m, path)
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), obj)
+
+        buf = bytearray(len(obj))
+        self.assertEqual(m.to_native_object(buf), len(obj))
+
+        fout = BytesIO()
+        tm.emit_object(m, fout)
+        self.assertEqual(fout.getvalue(), obj)
+
+    def test_lazy_bitcode(self):
+        m = Module.new('module1')
+        for name in ['foo', 'bar']:
+            fn = m.add_function(Type.function(Type.int(), []), name)
+            bldr = Builder.new(fn.append_basic_block('entry'))
+            bldr.ret(Constant.int(Type.int(), 1))
+
+        m2 = Module.from_bitcode(m.to_bitcode(), lazy=True)
+        foo = m2.get_function_named('foo')
+        bar = m2.get_function_named('bar')
+        self.assertTrue(foo.is_materializable)
+        self.assertFalse(foo.is_declaration)
+
+        foo.materialize()
+        self.assertFalse(foo.is_materializable)
+        self.assertTrue(bar.is_materializable)
+        self.assertIn('ret i32 1', str(foo))
+
+        m2.materialize_all()
+        self.assertFalse(bar.is_materializable)
+
+    def test_lazy_bitcode_keeps_buffer(self):
+        m = Module.new('module1')
+        fn = m.add_function(Type.function(Type.int(), []), 'foo')
+        bldr = Builder.new(fn.append_basic_block('entry'))
+        bldr.ret(Constant.int(Type.int(), 1))
+
+        data = bytearray(m.to_bitcode())
+        m2 = Module.from_bitcode(data, lazy=True)
+        # the module reads the function bodies from the buffer in place
+        self.assertRaises(BufferError, data.extend, b'\0')
+        del data
+        m2.materialize_all()
+        self.assertIn('ret i32 1', str(m2.get_function_named('foo')))
+
 tests.append(TestAsm)
 
 # ---------------------------------------------------------------------------
 
+class TestAssemblyCache(TestCase):
+    runtime = """
+define i32 @twice(i32 %x) {
+  %y = add i32 %x, %x
+  ret i32 %y
+}
+"""
+    user = """
+declare i32 @twice(i32)
+
+define i32 @quad(i32 %x) {
+  %y = call i32 @twice(i32 %x)
+  %z = call i32 @twice(i32 %y)
+  ret i32 %z
+}
+"""
+
+    def setUp(self):
+        lc.clear_assembly_cache()
+
+    def tearDown(self):
+        lc.clear_assembly_cache()
+
+    def test_cached_clone(self):
+        m1 = Module.from_assembly(self.runtime, cache=True)
+        m2 = Module.from_assembly(StringIO(self.runtime), cache=True)
+        self.assertEqual(len(lc._assembly_cache), 1)
+        self.assertNotEqual(m1, m2)
+        self.assertTrue(m1.structurally_equal(m2))
+
+        # modifying a clone does not affect the cached module
+        m1.get_function_named('twice').name = 'renamed'
+        m3 = Module.from_assembly(self.runtime, cache=True)
+        self.assertTrue(m3.structurally_equal(m2))
+
+    def test_uncached(self):
+        Module.from_assembly(self.runtime)
+        self.assertEqual(len(lc._assembly_cache), 0)
+
+    def test_from_assemblies(self):
+        for cache in (True, False):
+            m = Module.from_assemblies([self.runtime, StringIO(self.user)],
+                                       id='combined', cache=cache)
+            m.verify()
+            self.assertEqual(m.id, 'combined')
+            twice = m.get_function_named('twice')
+            self.assertFalse(twice.is_declaration)
+            self.assertEqual(len(m.functions), 2)
+        self.assertEqual(len(lc._assembly_cache), 2)
+
+    def test_least_recently_used(self):
+        size = lc.ASSEMBLY_CACHE_SIZE
+        lc.ASSEMBLY_CACHE_SIZE = 2
+        try:
+            a, b, c = [self.runtime.replace('twice', name)
+                       for name in ['a', 'b', 'c']]
+            context = lc.api.llvm.getGlobalContext()
+            ma = lc._parse_assembly_cached(a, context)
+            lc._parse_assembly_cached(b, context)
+            lc._parse_assembly_cached(a, context)  # b is now the oldest
+            lc._parse_assembly_cached(c, context)
+            self.assertEqual(len(lc._assembly_cache), 2)
+            self.assertTrue(lc._parse_assembly_cached(a, context) is ma)
+            self.assertEqual(len(lc._assembly_cache), 2)
+        finally:
+            lc.ASSEMBLY_CACHE_SIZE = size
+
+    def test_parse_error(self):
+        for cache in (True, False):
+            try:
+                Module.from_assembly('define i32 @f() {\n  ret i64 0\n}',
+                                     cache=cache)
+            except llvm.LLVMException as e:
+                self.assertIn('2:', str(e))
+            else:
+                self.fail('LLVMException not raised')
+        self.assertEqual(len(lc._assembly_cache), 0)
+
+tests.append(TestAssemblyCache)
+
+# ---------------------------------------------------------------------------
+
 class TestAttr(TestCase):
     def make_module(self):
         test_module = """
@@ -417,10 +597,186 @@ entry:
     def test_dump_passes(self):
         self.assertTrue(len(lp.PASSES)>0, msg="Cannot have no passes")
 
+    def test_optimize_parallel(self):
+        modules = [Module.from_assembly(StringIO(self.asm)) for _ in range(3)]
+        results = lp.optimize_parallel(modules, processes=2)
+        self.assertEqual(len(results), len(modules))
+        for bitcode in results:
+            m = Module.from_bitcode(BytesIO(bitcode))
+            fn_test2 = m.get_function_named('test2')
+            # test() is inlined
+            self.assertNotIn('call', str(fn_test2))
+
+        objects = lp.optimize_parallel(modules[:1], output='object',
+                                       processes=1)
+        self.assertEqual(len(objects), 1)
+        self.assertTrue(objects[0])
+
+    def test_profile(self):
+        m = Module.from_assembly(StringIO(self.asm))
+        pm = lp.PassManager.new(profile=True)
+        pm.add(le.TargetData.new(''))
+        pm.add(lp.PASS_INLINE)
+        pm.add(lp.PASS_ADCE)
+        prof = pm.run(m, profile=True)
+        self.assertTrue(prof.changed)
+        self.assertTrue(prof.wall_time >= 0)
+        self.assertEqual(prof.instructions[0], 10)
+        self.assertTrue(prof.instruction_delta < 0)
+        # one timing per pass, in order; TargetData does not run
+        self.assertEqual(len(prof.passes), 2)
+        inline, adce = prof.passes
+        self.assertEqual(inline.name, 'Function Integration/Inlining')
+        self.assertEqual(adce.name, 'Aggressive Dead Code Elimination')
+        for timing in prof.passes:
+            self.assertTrue(timing.wall_time >= 0)
+            self.assertTrue(timing.instruction_delta < 0)
+        self.assertEqual(inline.instruction_delta + adce.instruction_delta,
+                         prof.instruction_delta)
+        self.assertTrue(prof.statistics is None)
+        prof = pm.run(Module.from_assembly(StringIO(self.asm)),
+                      profile=True, statistics=True)
+        self.assertTrue(isinstance(prof.statistics, dict))
+        self.assertRaises(ValueError, pm.run, m, statistics=True)
+
+        # a normal run still returns a bool, and is not profiled
+        self.assertTrue(isinstance(pm.run(m), bool))
+        self.assertEqual(pm.run(m, profile=True).passes[1].instruction_delta,
+                         0)
+
+        m = Module.from_assembly(StringIO(self.asm))
+        fpm = lp.FunctionPassManager.new(m, profile=True)
+        fpm.add(lp.PASS_ADCE)
+        prof = fpm.run(m.get_function_named('test2'), profile=True)
+        self.assertEqual(prof.instructions, (2, 2))
+        self.assertFalse(prof.changed)
+        self.assertEqual([t.instruction_delta for t in prof.passes], [0])
+
+        self.assertRaises(ValueError, lp.PassManager.new().run, m,
+                          profile=True)
+
+    def test_parse_statistics(self):
+        stats = """\
+===-------------------------------------------------------------------------===
+                          ... Statistics Collected ...
+===-------------------------------------------------------------------------===
+
+  3 inline      - Number of functions inlined
+ 12 mem2reg     - Number of alloca's promoted
+"""
+        self.assertEqual(lp._parse_statistics(stats),
+                         {('inline', 'Number of functions inlined'): 3,
+                          ('mem2reg', "Number of alloca's promoted"): 12})
+
+    def test_parse_pipeline(self):
+        self.assertEqual(lp.parse_pipeline("mem2reg,instcombine,gvn,"
+                                           "loop(licm,unroll)"),
+                         ['mem2reg', 'instcombine', 'gvn', 'licm',
+                          'loop-unroll'])
+        self.assertEqual(lp.parse_pipeline(" function(adce, loop(rotate)) "),
+                         ['adce', 'loop-rotate'])
+        for spec in ['', 'gvn,', 'loop(licm', 'gvn)', 'gvn adce',
+                     'nosuchgroup(gvn)']:
+            self.assertRaises(ValueError, lp.parse_pipeline, spec)
+        self.assertRaises(llvm.LLVMException, lp.parse_pipeline,
+                          'nosuchpass')
+
+    def test_build_pipeline(self):
+        tm = le.TargetMachine.new()
+        pm = lp.build_pipeline('inline,adce', tm=tm)
+        self.assertTrue(isinstance(pm, lp.PassManager))
+        self.assertTrue(lp.build_pipeline(' inline , adce ', tm=tm) is pm)
+        self.assertFalse(lp.build_pipeline('inline,adce') is pm)
+        self.assertFalse(lp.build_pipeline('inline,adce', tm=tm,
+                                           cache=False) is pm)
+
+        m = Module.from_assembly(StringIO(self.asm))
+        pm.run(m)
+        self.assertNotIn('call', str(m.get_function_named('test2')))
+
+        fpm = lp.build_pipeline('function(adce)', mod=m)
+        self.assertTrue(isinstance(fpm, lp.FunctionPassManager))
+        self.assertTrue(lp.build_pipeline('adce', mod=m) is fpm)
+        fpm.run(m.get_function_named('test1'))
+
+        ncached = len(lp._pipeline_cache)
+        del tm
+        self.assertEqual(len(lp._pipeline_cache), ncached - 1)
+
+    def test_function_pass_manager_pool(self):
+        m = Module.from_assembly(StringIO(self.asm))
+        fpm = lp.function_pass_manager(m)
+        self.assertTrue(isinstance(fpm, lp.FunctionPassManager))
+        self.assertTrue(lp.function_pass_manager(m, opt=2) is fpm)
+        self.assertFalse(lp.function_pass_manager(m, opt=1) is fpm)
+        other = Module.from_assembly(StringIO(self.asm))
+        self.assertFalse(lp.function_pass_manager(other) is fpm)
+
+        fn_test1 = m.get_function_named('test1')
+        original = str(fn_test1)
+        fpm.run(fn_test1)
+        self.assertNotEqual(str(fn_test1), original)
+
+        tm = le.TargetMachine.new()
+        pms = lp.build_pass_managers(tm, mod=m, cache=True)
+        self.assertTrue(lp.build_pass_managers(tm, mod=m, cache=True) is pms)
+        self.assertFalse(lp.build_pass_managers(tm, mod=m) is pms)
+
+        ncached = len(lp._pipeline_cache)
+        del fpm, fn_test1, pms, m
+        self.assertEqual(len(lp._pipeline_cache), ncached - 3)
+
 tests.append(TestPasses)
 
 # ---------------------------------------------------------------------------
 
+class TestLazyInitialization(TestCase):
+
+    def run_python(self, code):
+        out = subprocess.check_output([sys.executable, '-c', code])
+        return out.decode('ascii').split()
+
+    def test_pass_registry(self):
+        if sys.version_info < (3, 7):
+            return # skip: no module __getattr__
+        out = self.run_python("import llvm.passes as lp;"
+                              "print('PASSES' in vars(lp));"
+                              "print(lp.PASS_INLINE);"
+                              "print('PASSES' in vars(lp))")
+        self.assertEqual(out, ['False', 'inline', 'True'])
+
+    def test_star_import(self):
+        out = self.run_python("import sys;"
+                              "from llvm.passes import *;"
+                              "from llvm.passes import PASS_INLINE;"
+                              "print(PASS_INLINE);"
+                              "print('PassManager' in dir());"
+                              "print('build_pipeline' in dir());"
+                              "print('PASS_ADCE' in dir())")
+        self.assertEqual(out, ['inline', 'True', 'False', 'False'])
+        if sys.version_info >= (3, 7):
+            # import * does not initialize the registry
+            out = self.run_python("from llvm.passes import *;"
+                                  "import llvm.passes as lp;"
+                                  "print('PASSES' in vars(lp))")
+            self.assertEqual(out, ['False'])
+
+    def test_targets(self):
+        out = self.run_python("import llvm, llvm.core, llvm.ee;"
+                              "print(len(llvm._initialized_targets));"
+                              "llvm.ee.TargetMachine.new();"
+                              "print(sorted(llvm._initialized_targets))")
+        self.assertEqual(out, ['0', "['native']"])
+
+    def test_initialize_targets(self):
+        llvm.initialize_targets()
+        self.assertIn('native', llvm._initialized_targets)
+        self.assertRaises(ValueError, llvm.initialize_targets, 'nosuch')
+
+tests.append(TestLazyInitialization)
+
+# ---------------------------------------------------------------------------
+
 class TestEngineBuilder(TestCase):
 
     def make_test_module(self):
@@ -455,6 +811,15 @@ class TestEngineBuilder(TestCase):
         self.assertFalse(llvmpy.capsule.has_ownership(module._ptr._ptr))
         self.run_foo(ee, module)
 
+    def test_remove_module_ownership(self):
+        module = self.make_test_module()
+        ee = EngineBuilder.new(Module.new('empty')).create()
+        ee.add_module(module)
+        self.assertFalse(llvmpy.capsule.has_ownership(module._ptr._ptr))
+        self.assertTrue(ee.remove_module(module))
+        self.assertTrue(llvmpy.capsule.has_ownership(module._ptr._ptr))
+        self.assertTrue(llvmpy.capsule.getRefCount(module._ptr._ptr) > 0)
+
     def test_enginebuilder_force_jit(self):
         module = self.make_test_module()
         ee = EngineBuilder.new(module).force_jit().create()
@@ -512,6 +877,76 @@ class TestExecutionEngine(TestCase):
         foo_callable = prototype(foo_addr)
         self.assertEqual(foo_callable(), value)
 
+    def test_background_compiler(self):
+        if le.ThreadPoolExecutor is None:
+            return # skip this test
+
+        from ctypes import c_int, CFUNCTYPE
+        module = lc.Module.new(str(self))
+        fnty = lc.Type.function(Type.int(), [])
+        foo = module.add_function(fnty, name='foo')
+        bldr = lc.Builder.new(foo.append_basic_block('entry'))
+        bldr.ret(lc.Constant.int(Type.int(), 42))
+
+        other = lc.Module.new(str(self) + '.other')
+        bar = other.add_function(fnty, name='bar')
+        bldr = lc.Builder.new(bar.append_basic_block('entry'))
+        bldr.ret(lc.Constant.int(Type.int(), 24))
+
+        ee = le.ExecutionEngine.new(module)
+        with le.BackgroundCompiler(ee) as bc:
+            foo_future = bc.submit_function(foo)
+            other_future = bc.submit_module(other)
+            obj_future = bc.submit_object(le.TargetMachine.new(), module)
+
+            prototype = CFUNCTYPE(c_int)
+            self.assertEqual(prototype(foo_future.result())(), 42)
+            addrs = other_future.result()
+            self.assertEqual(list(addrs.keys()), ['bar'])
+            self.assertEqual(prototype(addrs['bar'])(), 24)
+            self.assertTrue(obj_future.result())
+
+    def test_get_callable(self):
+        from llvm import fastcall
+        module = lc.Module.new(str(self))
+        ti, td, tf = Type.int(), Type.double(), Type.float()
+
+        add = module.add_function(Type.function(ti, [ti, ti]), 'add')
+        bldr = lc.Builder.new(add.append_basic_block('entry'))
+        bldr.ret(bldr.add(*add.args))
+
+        scale = module.add_function(Type.function(td, [tf, td]), 'scale')
+        bldr = lc.Builder.new(scale.append_basic_block('entry'))
+        bldr.ret(bldr.fmul(bldr.fpext(scale.args[0], td), scale.args[1]))
+
+        noop = module.add_function(Type.function(Type.void(), []), 'noop')
+        lc.Builder.new(noop.append_basic_block('entry')).ret_void()
+
+        ee = le.ExecutionEngine.new(module)
+        fast_add = ee.get_callable(add)
+        self.assertEqual(fast_add(2, 3), 5)
+        self.assertEqual(fast_add(-2, 1), -1)
+        self.assertEqual(fast_add(2**31 - 1, 1), -2**31)   # wraps
+        self.assertEqual(fast_add.__name__, 'add')
+        self.assertRaises(TypeError, fast_add, 1)
+        self.assertRaises(TypeError, fast_add, 1, 'a')
+        # the first failed conversion stops the call
+        self.assertRaises(TypeError, fast_add, 'a', 1)
+        self.assertRaises(OverflowError, fast_add, 2**64, 1)
+        self.assertRaises(TypeError, ee.get_callable(scale), 'a', 1.0)
+        self.assertEqual(ee.get_callable(scale)(0.5, 3.0), 1.5)
+        self.assertTrue(ee.get_callable(noop)() is None)
+
+        # one trampoline per signature
+        self.assertEqual(fastcall.trampoline_for(add.type.pointee),
+                         fastcall.trampoline_for(Type.function(ti, [ti, ti])))
+        self.assertEqual(fastcall.signature_of(scale.type.pointee), 'd(f,d)')
+        self.assertRaises(TypeError, fastcall.signature_of,
+                          Type.function(ti, [Type.vector(ti, 4)]))
+
+        # the callable keeps the engine alive
+        del ee
+        self.assertEqual(fast_add(20, 22), 42)
 
 
 tests.append(TestExecutionEngine)
@@ -766,6 +1201,246 @@ tests.append(TestNativeAsm)
 
 # ---------------------------------------------------------------------------
 
+class TestObjectCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_module(self, retval):
+        m = Module.new('TestObjectCache')
+        fty = Type.function(Type.int(), [])
+        f = m.add_function(fty, name='foo')
+        bldr = Builder.new(f.append_basic_block('entry'))
+        bldr.ret(Constant.int(Type.int(), retval))
+        return m
+
+    def test_hit_and_miss(self):
+        from llvm.codecache import ObjectCache
+        cache = ObjectCache(self.tmpdir)
+        tm = le.TargetMachine.new()
+
+        first = cache.emit_object(tm, self._make_module(1))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(first, tm.emit_object(self._make_module(1)))
+
+        # a new cache on the same directory sees the entry
+        cache = ObjectCache(self.tmpdir)
+        second = cache.emit_object(tm, self._make_module(1))
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(first, second)
+
+        cache.emit_object(tm, self._make_module(2))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 2)
+
+    def test_key(self):
+        from llvm.codecache import ObjectCache
+        m = self._make_module(1)
+        tm2 = le.TargetMachine.new(opt=2)
+        tm0 = le.TargetMachine.new(opt=0)
+        self.assertEqual(ObjectCache.key_for(tm2, m),
+                         ObjectCache.key_for(tm2, self._make_module(1)))
+        self.assertNotEqual(ObjectCache.key_for(tm2, m),
+                            ObjectCache.key_for(tm0, m))
+        pic = le.TargetMachine.new(opt=2, reloc=le.RELOC_PIC)
+        large = le.TargetMachine.new(opt=2, cm=le.CM_LARGE)
+        keys = set(ObjectCache.key_for(tm, m) for tm in (tm2, pic, large))
+        self.assertEqual(len(keys), 3)
+
+    def test_eviction(self):
+        from llvm.codecache import ObjectCache
+        cache = ObjectCache(self.tmpdir)
+        tm = le.TargetMachine.new()
+        for i in range(4):
+            cache.emit_object(tm, self._make_module(i))
+        self.assertEqual(len(cache), 4)
+
+        cache.evict(max_size=cache.size // 2)
+        self.assertTrue(0 < len(cache) < 4)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+        # the limit is enforced on insertion
+        entry_size = len(cache.emit_object(tm, self._make_module(0)))
+        cache.max_size = 2 * entry_size
+        for i in range(1, 4):
+            cache.emit_object(tm, self._make_module(i))
+            self.assertTrue(cache.size <= cache.max_size)
+        self.assertEqual(len(cache), 2)
+
+tests.append(TestObjectCache)
+
+# ---------------------------------------------------------------------------
+
+class TestFunctionPointerCache(TestCase):
+
+    def _make_function(self, fname, argname, const=1, gname=None):
+        m = Module.new('TestFunctionPointerCache')
+        fty = Type.function(Type.int(), [Type.int()])
+        f = m.add_function(fty, name=fname)
+        f.args[0].name = argname
+        bldr = Builder.new(f.append_basic_block('entry'))
+        res = bldr.add(f.args[0], Constant.int(Type.int(), const), 'res')
+        if gname is not None:
+            gvar = m.add_global_variable(Type.int(), gname)
+            gvar.initializer = Constant.int(Type.int(), 0)
+            bldr.store(res, gvar)
+        bldr.ret(res)
+        return m, f
+
+    def test_fingerprint(self):
+        from llvm.codecache import fingerprint
+        _, f1 = self._make_function('foo', 'x')
+        _, f2 = self._make_function('bar', 'y')
+        _, f3 = self._make_function('foo', 'x', const=2)
+        _, f4 = self._make_function('foo', 'x', gname='g')
+        self.assertEqual(fingerprint(f1), fingerprint(f2))
+        self.assertNotEqual(fingerprint(f1), fingerprint(f3))
+        self.assertTrue(fingerprint(f4) is None)
+        self.assertEqual(len(fingerprint(f1)), 40)     # a SHA-1 digest
+
+    def test_reuse_and_eviction(self):
+        import gc
+        from llvm.codecache import FunctionPointerCache
+        cache = FunctionPointerCache()
+
+        m1, f1 = self._make_function('foo', 'x')
+        ee1 = le.ExecutionEngine.new(m1)
+        addr1, owner1 = cache.get_function_pointer(ee1, f1)
+        self.assertTrue(owner1 is ee1._ptr)
+
+        m2, f2 = self._make_function('bar', 'y')
+        ee2 = le.ExecutionEngine.new(m2)
+        addr2, owner2 = cache.get_function_pointer(ee2, f2)
+        self.assertEqual(addr1, addr2)
+        self.assertTrue(owner2 is owner1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 1)
+
+        # the owner keeps the first engine alive
+        del ee1, f1, m1, owner1
+        gc.collect()
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.lookup(f2), (addr2, owner2))
+
+        del owner2
+        gc.collect()
+        self.assertEqual(len(cache), 0)
+        addr3, owner3 = cache.get_function_pointer(ee2, f2)
+        self.assertTrue(owner3 is ee2._ptr)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_fingerprint_target(self):
+        from llvm.codecache import fingerprint
+        m1, f1 = self._make_function('foo', 'x')
+        m2, f2 = self._make_function('foo', 'x')
+        self.assertEqual(fingerprint(f1), fingerprint(f2))
+        m2.target = 'x86_64-unknown-linux-gnu'
+        m1.target = 'i386-unknown-linux-gnu'
+        self.assertNotEqual(fingerprint(f1), fingerprint(f2))
+        m1.target = m2.target
+        m1.data_layout = 'e-p:64:64:64'
+        self.assertNotEqual(fingerprint(f1), fingerprint(f2))
+
+    def test_executor_keeps_owner(self):
+        import gc
+        from llvm.codecache import FunctionPointerCache
+        from llvm_cbuilder import CExecutor
+        cache = FunctionPointerCache()
+
+        m1, f1 = self._make_function('foo', 'x')
+        exe1 = CExecutor(m1, cache=cache)
+        exe1.get_ctype_function(f1, 'int, int')
+
+        m2, f2 = self._make_function('bar', 'y')
+        exe2 = CExecutor(m2, cache=cache)
+        func = exe2.get_ctype_function(f2, 'int, int')
+        self.assertEqual(cache.hits, 1)
+
+        del exe1, f1, m1
+        gc.collect()
+        # the code of the first engine is still alive
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(func(41), 42)
+
+tests.append(TestFunctionPointerCache)
+
+# ---------------------------------------------------------------------------
+
+class TestLinkSession(TestCase):
+    runtime = """
+@counter = global i32 0
+@unused_table = global [2 x i32] [i32 1, i32 2]
+
+define internal i32 @helper(i32 %x) {
+  %y = load i32* @counter
+  %z = add i32 %x, %y
+  ret i32 %z
+}
+
+define i32 @rt_add(i32 %x) {
+  %y = call i32 @helper(i32 %x)
+  ret i32 %y
+}
+
+define i32 @rt_unused(i32 %x) {
+  %y = load i32* getelementptr ([2 x i32]* @unused_table, i32 0, i32 1)
+  ret i32 %y
+}
+"""
+
+    user = """
+declare i32 @rt_add(i32)
+
+define i32 @main(i32 %x) {
+  %y = call i32 @rt_add(i32 %x)
+  ret i32 %y
+}
+"""
+
+    def test_index(self):
+        from llvm.linker import LinkSession
+        session = LinkSession(Module.from_assembly(self.runtime))
+        self.assertEqual(session.symbols,
+                         set(['counter', 'unused_table', 'rt_add',
+                              'rt_unused']))
+        self.assertEqual(session.closure(['rt_add']),
+                         set(['rt_add', 'helper', 'counter']))
+        self.assertEqual(session.closure(['rt_unused']),
+                         set(['rt_unused', 'unused_table']))
+        self.assertEqual(session.closure(['rt_add'], exclude=['counter']),
+                         set(['rt_add', 'helper']))
+
+    def test_link_into(self):
+        from llvm.linker import LinkSession
+        runtime = Module.from_assembly(self.runtime)
+        text = str(runtime)
+        session = LinkSession(runtime)
+        for _ in range(2):
+            m = Module.from_assembly(self.user)
+            self.assertEqual(session.link_into(m),
+                             set(['rt_add', 'helper', 'counter']))
+            m.verify()
+            self.assertFalse(m.get_function_named('rt_add').is_declaration)
+            names = set(f.name for f in m.functions)
+            self.assertEqual(names, set(['main', 'rt_add', 'helper']))
+            names = set(g.name for g in m.global_variables)
+            self.assertEqual(names, set(['counter']))
+        self.assertEqual((session.hits, session.misses), (1, 1))
+        self.assertEqual(str(runtime), text)
+
+        # nothing to link
+        m = Module.from_assembly(self.runtime)
+        self.assertEqual(session.link_into(m), set())
+
+tests.append(TestLinkSession)
+
+# ---------------------------------------------------------------------------
+
 class TestUses(TestCase):
 
     def test_uses(self):
@@ -799,10 +1474,284 @@ class TestUses(TestCase):
         self.assertEqual(len(tmp2.uses), 0)
         self.assertEqual(len(tmp3.uses), 1)
 
+        # Testing lazy iteration
+        for v in [f.args[0], f.args[1], f.args[2], tmp1, tmp2, tmp3]:
+            self.assertEqual(list(v.iter_uses()), v.uses)
+        self.assertEqual(list(tmp2.iter_operands()), tmp2.operands)
+
 tests.append(TestUses)
 
 # ---------------------------------------------------------------------------
 
+class TestIteration(TestCase):
+
+    def make_module(self):
+        m = Module.new('a')
+        t = Type.int()
+        m.add_global_variable(t, 'g1')
+        m.add_global_variable(t, 'g2')
+        f = m.add_function(Type.function(t, [t]), 'f')
+        m.add_function(Type.function(t, [t]), 'g')
+        entry = f.append_basic_block('entry')
+        exit = f.append_basic_block('exit')
+        bld = Builder.new(entry)
+        tmp = bld.add(f.args[0], f.args[0], 'tmp')
+        bld.branch(exit)
+        bld.position_at_end(exit)
+        bld.ret(tmp)
+        return m, f
+
+    def test_iterators(self):
+        m, f = self.make_module()
+        self.assertEqual(list(m.iter_functions()), m.functions)
+        self.assertEqual(list(m.iter_global_variables()), m.global_variables)
+        self.assertEqual(list(f.iter_basic_blocks()), f.basic_blocks)
+        for bb in f.basic_blocks:
+            self.assertEqual(list(bb.iter_instructions()), bb.instructions)
+            self.assertTrue(bb.terminator is bb.instructions[-1])
+        empty = m.get_function_named('g')
+        self.assertEqual(list(empty.iter_basic_blocks()), [])
+
+    def test_counts(self):
+        m, f = self.make_module()
+        self.assertEqual(m.function_count, 2)
+        self.assertEqual(m.global_variable_count, 2)
+        self.assertEqual(f.basic_block_count, 2)
+        self.assertEqual(f.basic_blocks[0].instruction_count, 2)
+        self.assertEqual(f.basic_blocks[1].instruction_count, 1)
+
+    def test_erase_while_iterating(self):
+        m, f = self.make_module()
+        for gv in m.iter_global_variables():
+            gv.delete()
+        self.assertEqual(m.global_variable_count, 0)
+
+tests.append(TestIteration)
+
+# ---------------------------------------------------------------------------
+
+class TestIdentity(TestCase):
+
+    def make_function(self, m, name):
+        t = Type.int()
+        f = m.add_function(Type.function(t, [t]), name)
+        bld = Builder.new(f.append_basic_block('entry'))
+        bld.ret(f.args[0])
+        return f
+
+    def test_value_identity(self):
+        m = Module.new('a')
+        f = self.make_function(m, 'f')
+        g = self.make_function(m, 'g')
+        self.assertEqual(f, m.get_function_named('f'))
+        self.assertEqual(hash(f), hash(m.get_function_named('f')))
+        self.assertNotEqual(f, g)
+        self.assertNotEqual(f, m)
+        self.assertEqual(len(set([f, g, m.get_function_named('f')])), 2)
+        self.assertTrue(f in {f: 1})
+        self.assertTrue(f.args[0] in f.basic_blocks[0].instructions[0].operands)
+
+    def test_structurally_equal(self):
+        m1 = Module.new('a')
+        m2 = Module.new('a')
+        f1 = self.make_function(m1, 'f')
+        f2 = self.make_function(m2, 'f')
+        self.assertNotEqual(f1, f2)
+        self.assertTrue(f1.structurally_equal(f2))
+        self.assertFalse(f1.structurally_equal(self.make_function(m1, 'g')))
+        self.assertNotEqual(m1, m2)
+        self.assertTrue(m1.structurally_equal(m2))
+        self.assertEqual(m1, m1)
+
+    def test_wrapper_cache(self):
+        import gc
+        m = Module.new('a')
+        f = self.make_function(m, 'f')
+        self.assertTrue(m.get_function_named('f') is f)
+        self.assertTrue(f.module is m)
+        self.assertTrue(f.basic_blocks[0] is f.entry_basic_block)
+        before = llvmpy.capsule.countCached()
+        del f
+        gc.collect()
+        self.assertTrue(llvmpy.capsule.countCached() < before)
+
+    def test_wrapper_cache_reused_address(self):
+        # A pass deletes the add while its wrapper is alive; a load may
+        # then get its address and must not reuse that wrapper.
+        ty = Type.int()
+        m = Module.new('a')
+        for i in range(20):
+            f = m.add_function(Type.function(ty, [ty]), 'f%d' % i)
+            bldr = Builder.new(f.append_basic_block('entry'))
+            dead = bldr.add(f.args[0], f.args[0])
+            bldr.ret(f.args[0])
+            fpm = lp.FunctionPassManager.new(m)
+            fpm.add(lp.PASS_ADCE)
+            fpm.run(f)
+            bldr.position_at_beginning(f.entry_basic_block)
+            load = bldr.load(bldr.alloca(ty))
+            self.assertEqual(load.opcode_name, 'load')
+            self.assertTrue(isinstance(load._ptr, llvmpy.api.llvm.LoadInst))
+            del dead
+
+    def test_type_hash(self):
+        self.assertEqual(hash(Type.int()), hash(Type.int()))
+        self.assertEqual(len(set([Type.int(), Type.int(), Type.float()])), 2)
+
+tests.append(TestIdentity)
+
+# ---------------------------------------------------------------------------
+
+class TestWrapperSlots(TestCase):
+
+    def test_no_instance_dict(self):
+        import weakref
+        m = Module.new('a')
+        t = Type.int()
+        f = m.add_function(Type.function(t, [t]), 'f')
+        bb = f.append_basic_block('entry')
+        bld = Builder.new(bb)
+        ret = bld.ret(f.args[0])
+        for obj in [m, t, f, f.args[0], bb, bld, ret]:
+            self.assertFalse(hasattr(obj, '__dict__'), type(obj))
+            self.assertTrue(weakref.ref(obj)() is obj)
+            self.assertRaises(AttributeError, setattr, obj, 'foo', 1)
+
+    def test_subclasses_declare_slots(self):
+        for name in dir(lc):
+            cls = getattr(lc, name)
+            if isinstance(cls, type) and issubclass(cls, llvm.Wrapper):
+                self.assertTrue('__slots__' in cls.__dict__, cls)
+
+tests.append(TestWrapperSlots)
+
+# ---------------------------------------------------------------------------
+
+class TestDowncast(TestCase):
+
+    def test_concrete_class(self):
+        from llvmpy import api
+        m = Module.new('a')
+        t = Type.int()
+        f = m.add_function(Type.function(t, [t]), 'f')
+        bld = Builder.new(f.append_basic_block('entry'))
+        add = bld.add(f.args[0], f.args[0])
+        ret = bld.ret(add)
+        self.assertTrue(type(f._ptr) is api.llvm.Function)
+        self.assertTrue(type(f.args[0]._ptr) is api.llvm.Argument)
+        self.assertTrue(type(add._ptr) is api.llvm.BinaryOperator)
+        self.assertTrue(type(ret._ptr) is api.llvm.ReturnInst)
+        self.assertTrue(type(Type.function(t, [t])._ptr)
+                        is api.llvm.FunctionType)
+
+    def test_downcast_table(self):
+        from llvmpy import api
+        m = Module.new('a')
+        t = Type.int()
+        f = m.add_function(Type.function(t, [t]), 'f')
+        value = f._ptr._downcast(api.llvm.Function)
+        self.assertTrue(value is f._ptr)
+        constant = m._ptr.getOrInsertFunction('f', f.type.pointee._ptr)
+        self.assertTrue(constant._downcast(api.llvm.Function) is f._ptr)
+        self.assertRaises(TypeError, f._ptr._downcast, api.llvm.Module)
+
+tests.append(TestDowncast)
+
+# ---------------------------------------------------------------------------
+
+class TestBuilderBatch(TestCase):
+
+    def make_function(self, name):
+        m = Module.new('batch')
+        ti = Type.int()
+        f = m.add_function(Type.function(ti, [ti, ti]), name)
+        return f, Builder.new(f.append_basic_block('entry'))
+
+    def test_emit_batch(self):
+        f, bld = self.make_function('f')
+        a, b = f.args
+        code = [(lc.OPCODE_ADD, 0, 1),                  # 2 = a + b
+                (lc.OPCODE_MUL, 2, 0),                  # 3 = 2 * a
+                (lc.OPCODE_ICMP, lc.ICMP_SGT, 3, 1),    # 4 = 3 > b
+                (lc.OPCODE_ZEXT, 4, 0),                 # 5 = zext 4
+                (lc.OPCODE_SELECT, 4, 5, -3)]           # 6 = 4 ? 5 : 3
+        res, = bld.emit_batch(code, values=[a, b], types=[Type.int()],
+                              results=[-1])
+        bld.ret(res)
+        f.verify()
+
+        g, bld = self.make_function('g')
+        a, b = g.args
+        mul = bld.mul(bld.add(a, b), a)
+        cmp = bld.icmp(lc.ICMP_SGT, mul, b)
+        bld.ret(bld.select(cmp, bld.zext(cmp, Type.int()), mul))
+
+        self.assertEqual(f.basic_blocks[0].instruction_count, 6)
+        self.assertTrue(isinstance(res, lc.Instruction))
+        self.assertEqual(res.opcode, lc.OPCODE_SELECT)
+        self.assertEqual(str(f).replace('@f', '@g'), str(g))
+
+    def test_emit_batch_memory(self):
+        f, bld = self.make_function('f')
+        ti = Type.int()
+        zero = Constant.int(ti, 0)
+        code = [(lc.OPCODE_ALLOCA, 0),                  # 2
+                (lc.OPCODE_GETELEMENTPTR, 2, 1),        # 3
+                (lc.OPCODE_STORE, 0, 3),                # 4
+                (lc.OPCODE_LOAD, 2)]                    # 5
+        ptr, val = bld.emit_batch(code, values=[f.args[0], zero],
+                                  types=[ti], results=[2, 5])
+        bld.ret(val)
+        f.verify()
+        self.assertEqual(ptr.type, Type.pointer(ti))
+        self.assertEqual(val.opcode, lc.OPCODE_LOAD)
+
+    def test_emit_batch_errors(self):
+        f, bld = self.make_function('f')
+        values = list(f.args)
+        self.assertRaises(IndexError, bld.emit_batch,
+                          [(lc.OPCODE_ADD, 0, 2)], values)
+        self.assertRaises(ValueError, bld.emit_batch,
+                          [(lc.OPCODE_ADD, 0)], values)
+        self.assertRaises(ValueError, bld.emit_batch,
+                          [(lc.OPCODE_RET, 0)], values)
+        self.assertRaises(IndexError, bld.emit_batch, [], values,
+                          results=[2])
+        self.assertEqual(bld.emit_batch([], values), [])
+
+    def test_emit_batch_operand_types(self):
+        f, bld = self.make_function('f')
+        ti = Type.int()
+        values = list(f.args) + [Constant.real(Type.double(), 1),
+                                 Constant.null(Type.pointer(Type.int(8)))]
+        bad = [[(lc.OPCODE_ADD, 0, 2)],             # int + double
+               [(lc.OPCODE_FADD, 0, 1)],            # fadd of ints
+               [(lc.OPCODE_SITOFP, 2, 0)],          # double to int
+               [(lc.OPCODE_ICMP, lc.ICMP_EQ, 0, 2)],
+               [(lc.OPCODE_FCMP, lc.FCMP_OEQ, 0, 1)],
+               [(lc.OPCODE_SELECT, 0, 0, 1)],       # i32 condition
+               [(lc.OPCODE_LOAD, 0)],
+               [(lc.OPCODE_STORE, 0, 3)],           # i32 into i8*
+               [(lc.OPCODE_GETELEMENTPTR, 0, 1)],
+               [(lc.OPCODE_GETELEMENTPTR, 3, 2)],   # double index
+               [(lc.OPCODE_CALL, 0, 1)],
+               [(lc.OPCODE_CALL, 4, 0)]]            # wrong arity
+        values.append(f)
+        for code in bad:
+            self.assertRaises(TypeError, bld.emit_batch, code, values,
+                              [ti])
+        self.assertRaises(ValueError, bld.emit_batch,
+                          [(lc.OPCODE_ICMP, lc.FCMP_OEQ, 0, 1)], values)
+        self.assertRaises(ValueError, bld.emit_batch,
+                          [(lc.OPCODE_FCMP, lc.ICMP_EQ, 2, 2)], values)
+        self.assertRaises(ValueError, bld.emit_batch,
+                          [(lc.OPCODE_ICMP, 100, 0, 1)], values)
+        self.assertEqual(f.basic_blocks[0].instruction_count, 0)
+
+tests.append(TestBuilderBatch)
+
+# ---------------------------------------------------------------------------
+
 class TestMetaData(TestCase):
     # test module metadata
     def test_metadata(self):
@@ -1,3 +1,3 @@
 from .builder import *
 from .executor import CExecutor
-
+from .elementwise import Elementwise, ElementwiseLoop
@@ -1,7 +1,3 @@
-#
-# TODO: Add support for vector.
-#
-
 import contextlib
 import llvm.core as lc
 import llvm.ee as le
@@ -21,13 +17,14 @@ class FunctionAlreadyExists(NameError):
 def _is_int(ty):
     return isinstance(ty, lc.IntegerType)
 
+_REAL_KINDS = frozenset([lc.TYPE_FLOAT,
+                         lc.TYPE_DOUBLE,
+                         lc.TYPE_X86_FP80,
+                         lc.TYPE_FP128,
+                         lc.TYPE_PPC_FP128])
+
 def _is_real(ty):
-    tys = [ lc.Type.float(),
-            lc.Type.double(),
-            lc.Type.x86_fp80(),
-            lc.Type.fp128(),
-            lc.Type.ppc_fp128() ]
-    return any(ty == x for x in tys)
+    return ty.kind in _REAL_KINDS
 
 def _is_vector(ty, of=None):
     if isinstance(ty, lc.VectorType):
@@ -41,8 +38,17 @@ def _is_pointer(ty):
     return isinstance(ty, lc.PointerType)
 
 def _is_block_terminated(bb):
-    instrs = bb.instructions
-    return len(instrs) > 0 and instrs[-1].is_terminator
+    return bb.terminator is not None
+
+# data layout string -> TargetData
+_target_data_cache = {}
+
+def _target_data(layout):
+    try:
+        return _target_data_cache[layout]
+    except KeyError:
+        td = _target_data_cache[layout] = le.TargetData.new(layout)
+        return td
 
 def _is_struct(ty):
     return isinstance(ty, lc.StructType)
@@ -93,42 +99,55 @@ class _IfElse(object):
     def __init__(self, parent, cond):
         self.parent = parent
         self.cond = cond
-        self._to_close = []
+        self._bbcond = None
+        self._bbelse = None
+        self._ends = []
 
     @contextlib.contextmanager
     def then(self):
-        self._bbif = self.parent.function.append_basic_block('if.then')
-        self._bbelse = self.parent.function.append_basic_block('if.else')
-
+        if self._bbcond is not None:
+            raise RuntimeError("ifelse.then() can only be used once")
         builder = self.parent.builder
-        builder.cbranch(self.cond.value, self._bbif, self._bbelse)
-
+        # The conditional branch is emitted by close(), when it is known
+        # whether the false edge goes to an else block or to the end.
+        self._bbcond = builder.basic_block
+        self._bbif = self.parent.function.append_basic_block('if.then')
         builder.position_at_end(self._bbif)
 
         yield
 
-        self._to_close.extend([self._bbif, self._bbelse, builder.basic_block])
+        self._ends.append(builder.basic_block)
 
     @contextlib.contextmanager
     def otherwise(self):
+        if self._bbcond is None:
+            raise RuntimeError("ifelse.otherwise() must follow ifelse.then()")
+        if self._bbelse is not None:
+            raise RuntimeError("ifelse.otherwise() can only be used once")
         builder = self.parent.builder
+        self._bbelse = self.parent.function.append_basic_block('if.else')
         builder.position_at_end(self._bbelse)
         yield
-        self._to_close.append(builder.basic_block)
+        self._ends.append(builder.basic_block)
 
     def close(self):
-        self._to_close.append(self.parent.builder.basic_block)
-        bbend = self.parent.function.append_basic_block('if.end')
+        if self._bbcond is None:
+            return
         builder = self.parent.builder
-        closed_count = 0
-        for bb in self._to_close:
-            if not _is_block_terminated(bb):
-                with _change_block_temporarily(builder, bb):
-                    builder.branch(bbend)
-                    closed_count += 1
-        builder.position_at_end(bbend)
-        if not closed_count:
-            self.parent.unreachable()
+        open_ends = [bb for bb in self._ends if not _is_block_terminated(bb)]
+        bbend = None
+        if open_ends or self._bbelse is None:
+            bbend = self.parent.function.append_basic_block('if.end')
+        with _change_block_temporarily(builder, self._bbcond):
+            builder.cbranch(self.cond.value, self._bbif,
+                            bbend if self._bbelse is None else self._bbelse)
+        for bb in open_ends:
+            with _change_block_temporarily(builder, bb):
+                builder.branch(bbend)
+        if bbend is not None:
+            builder.position_at_end(bbend)
+        # Otherwise, both branches are terminated and the builder stays at
+        # the end of the last one, which is terminated as well.
 
 class _Loop(object):
     '''while...do loop.
@@ -200,8 +219,9 @@ class CBuilder(object):
         self.declare_block = self.function.append_basic_block('decl')
         self.first_body_block = self.function.append_basic_block('body')
         self.builder = lc.Builder.new(self.first_body_block)
-        self.target_data = le.TargetData.new(self.function.module.data_layout)
+        self.target_data = _target_data(self.function.module.data_layout)
         self._auto_inline_list = []
+        self._outlined = []     # functions outlined by parallel_for_range
         # Prepare arguments. Make all function arguments behave like variables.
         self.args = []
         for arg in function.args:
@@ -292,6 +312,15 @@ class CBuilder(object):
                 z.assign(y)
         return z
 
+    def max(self, x, y):
+        z = self.var(x.type)
+        with self.ifelse( x > y ) as ifelse:
+            with ifelse.then():
+                z.assign(x)
+            with ifelse.otherwise():
+                z.assign(y)
+        return z
+
     def var(self, ty, value=None, name=''):
         '''allocate variable on the stack
 
@@ -436,6 +465,165 @@ class CBuilder(object):
                 yield loop, idx
                 idx += step
 
+    @contextlib.contextmanager
+    def parallel_for_range(self, start, stop, nthreads, shared=()):
+        '''start a parallel for-range block.
+
+        The iterations from `start` to `stop` are split into `nthreads`
+        chunks.  The body is outlined into a worker function that runs each
+        chunk on its own POSIX thread; the block ends when all the threads
+        have been joined.  The calling thread runs the first chunk.
+
+        start, stop : integers of the same type, or python int.  No
+                      iteration runs if stop < start.  Unsigned values
+                      (see IntegerValue.unsigned) are only supported when
+                      start <= stop and stop - start fits in the signed
+                      type: the chunks are computed with signed arithmetic.
+        nthreads : number of threads; python int or integer value.  A
+                   value below 1 is taken as 1.
+        shared : values of the enclosing function used by the body
+
+        Yields the index and the list of the `shared` values in the worker.
+        The body must only use these values: the other values of the
+        enclosing function do not exist in the worker.  Variables and
+        arrays are shared by reference; use the atomic operations (e.g.
+        `atomic_add`) to update them from the body.  Other values are
+        copied.
+
+        Example
+        -------
+        with cb.parallel_for_range(0, n, 4, shared=[A, total]) as (i, (A, total)):
+            cb.atomic_add(total.ref, A[i], 'acq_rel')
+        '''
+        def check_arg(x):
+            if isinstance(x, int):
+                return self.constant(types.int, x)
+            if not isinstance(x, IntegerValue):
+                raise TypeError(x, "All args must be of integer type.")
+            return x
+
+        if isinstance(nthreads, int) and nthreads < 1:
+            raise ValueError("nthreads must be at least 1")
+        start, stop = map(check_arg, (start, stop))
+        if start.type != stop.type:
+            raise TypeError("start and stop must have the same type")
+        idxty = start.type
+        dynamic = not isinstance(nthreads, int)
+        if not dynamic:
+            # the arrays below have a fixed size: allocate them once
+            count = nthreads
+            nthreads = self.constant(types.int, nthreads)
+        else:
+            nthreads = self.max(check_arg(nthreads).cast(types.int),
+                                self.constant(types.int, 1))
+            count = nthreads
+
+        # Shared values are passed to the workers in a context structure,
+        # after the bounds of the chunk.
+        shared = list(shared)
+        fields = [idxty, idxty]
+        for val in shared:
+            if isinstance(val, CVar):
+                fields.append(val.ref.type)
+            else:
+                fields.append(val.type)
+        ctxty = lc.Type.struct(fields)
+
+        # Define the worker
+        worker_type = lc.Type.function(types.void_p, [types.void_p])
+        worker = self.function.module.add_function(worker_type,
+                                     '%s.parallel_for' % self.function.name)
+        worker.linkage = lc.LINKAGE_INTERNAL
+        with self._emit_into(worker):
+            bldr = self.builder
+            ctx = bldr.bitcast(worker.args[0], types.pointer(ctxty))
+            values = [bldr.load(bldr.gep(ctx, [lc.Constant.int(types.int, 0),
+                                               lc.Constant.int(types.int, i)]))
+                      for i in range(len(fields))]
+            inner = []
+            for val, loaded in zip(shared, values[2:]):
+                if isinstance(val, CVar):
+                    inner.append(CVar(self, loaded))
+                elif isinstance(val, CArray):
+                    inner.append(CArray(self, loaded))
+                else:
+                    inner.append(CTemp(self, loaded))
+            begin, end = CTemp(self, values[0]), CTemp(self, values[1])
+            with self.for_range(begin, end) as (_, idx):
+                yield idx, inner
+            self.ret(self.constant_null(types.void_p))
+        self._outlined.append(worker)
+        worker = CFunc(self, worker)
+
+        # The arrays of a dynamic size are allocated in the current block;
+        # free them at the end, in case the block is in a loop.
+        if dynamic:
+            stacksave = self.get_intrinsic(lc.INTR_STACKSAVE, [])
+            stack = stacksave()
+
+        # An empty range must not wrap around in `stop - start`
+        stop = self.max(stop, start)
+
+        # Fill the contexts: chunk `tid` covers [begin, min(begin + chunk, stop))
+        nthreads_idx = nthreads.cast(idxty)
+        one = self.constant(idxty, 1)
+        chunk = (stop - start + nthreads_idx - one) / nthreads_idx
+        contexts = self.array(ctxty, count)
+        with self.for_range(nthreads) as (_, tid):
+            begin = start + tid.cast(idxty) * chunk
+            end = self.min(begin + chunk, stop)
+            slot = self.builder.gep(contexts.value, [tid.value])
+            values = [begin, end] + [val.ref if isinstance(val, CVar) else val
+                                     for val in shared]
+            for i, val in enumerate(values):
+                field = self.builder.gep(slot, [lc.Constant.int(types.int, 0),
+                                                lc.Constant.int(types.int, i)])
+                self.builder.store(val.value, field)
+
+        # Start the threads
+        pthread_create = self.depends(_declare_pthread_create)
+        pthread_join = self.depends(_declare_pthread_join)
+        NULL = self.constant_null(types.void_p)
+        zero = self.constant(types.int, 0)
+        threads = self.array(types.void_p, count)
+        with self.for_range(self.constant(types.int, 1), nthreads) as (_, tid):
+            arg = contexts[tid:].cast(types.void_p)
+            rc = pthread_create(threads[tid:].cast(types.void_p), NULL,
+                                worker.cast(types.void_p), arg)
+            with self.ifelse(rc != zero) as ifelse:
+                with ifelse.then():
+                    # no thread: run the chunk here
+                    worker(arg)
+                    threads[tid] = NULL
+
+        worker(contexts.cast(types.void_p))
+
+        # Join the threads
+        null_handle = self.constant(types.intp, 0)
+        with self.for_range(self.constant(types.int, 1), nthreads) as (_, tid):
+            with self.ifelse(threads[tid].cast(types.intp) != null_handle) \
+                    as ifelse:
+                with ifelse.then():
+                    pthread_join(threads[tid], NULL)
+
+        if dynamic:
+            stackrestore = self.get_intrinsic(lc.INTR_STACKRESTORE, [])
+            stackrestore(stack)
+
+    @contextlib.contextmanager
+    def _emit_into(self, function):
+        '''temporarily build `function` instead of the current function
+        '''
+        saved = self.__dict__.copy()
+        self.__dict__.update(CBuilder(function).__dict__)
+        try:
+            yield
+            self.close()
+            saved['_outlined'].extend(self._outlined)
+        finally:
+            self.__dict__.clear()
+            self.__dict__.update(saved)
+
     def position_at_end(self, bb):
         '''reposition inserter to the end of basic-block
 
@@ -465,11 +653,43 @@ class CBuilder(object):
             res = lc.Constant.int(ty, val)
         elif ty == types.float or ty == types.double:
             res = lc.Constant.real(ty, val)
+        elif _is_vector(ty):
+            if not isinstance(val, (list, tuple)):
+                val = [val] * ty.count
+            elif len(val) != ty.count:
+                raise ValueError("Expect %d values for %s, got %d"
+                                 % (ty.count, ty, len(val)))
+            res = lc.Constant.vector([self.constant(ty.element, x).value
+                                      for x in val])
         else:
             raise TypeError("Cannot auto build constant "
                             "from %s and value %s" % (ty, val))
         return CTemp(self, res)
 
+    def splat(self, val, count):
+        '''create a vector of `count` copies of `val`
+
+        val : a scalar value
+        '''
+        vecty = lc.Type.vector(val.type, count)
+        if isinstance(val.value, lc.Constant):
+            return CTemp(self, lc.Constant.vector([val.value] * count))
+        undef = lc.Constant.undef(vecty)
+        zero = lc.Constant.int(types.int32, 0)
+        vec = self.builder.insert_element(undef, val.value, zero)
+        mask = lc.Constant.null(lc.Type.vector(types.int32, count))
+        return CTemp(self, self.builder.shuffle_vector(vec, undef, mask))
+
+    def select(self, cond, true_value, false_value):
+        '''`true_value` if `cond` else `false_value`
+
+        With vectors, `cond` can be a mask (vector of i1) to select the
+        elements one by one.
+        '''
+        res = self.builder.select(cond.value, true_value.value,
+                                  false_value.value)
+        return CTemp(self, res)
+
     def constant_null(self, ty):
         '''create a zero filled constant
 
@@ -713,6 +933,15 @@ class CBuilder(object):
         ldst.set_metadata('nontemporal', md)
 
 
+def _declare_pthread_create(module):
+    fnty = lc.Type.function(types.int, [types.void_p] * 4)
+    return module.get_or_insert_function(fnty, 'pthread_create')
+
+def _declare_pthread_join(module):
+    fnty = lc.Type.function(types.int, [types.void_p] * 2)
+    return module.get_or_insert_function(fnty, 'pthread_join')
+
+
 class CFuncRef(object):
     '''create a function reference to use with `CBuilder.depends`
 
@@ -815,14 +1044,13 @@ class CDefinition(object):
         self.cbuilder = CBuilder(func)
         self.body(*self.cbuilder.args)
         self.cbuilder.close()
+        outlined = self.cbuilder._outlined
         self.cbuilder = None
 
         if optimize:
-            fpm = lp.FunctionPassManager.new(module)
-            pmb = lp.PassManagerBuilder.new()
-            pmb.opt_level = 2
-            pmb.populate(fpm)
-            fpm.run(func)
+            fpm = lp.function_pass_manager(module, opt=2)
+            for fn in [func] + outlined:
+                fpm.run(fn)
 
         return func
 
@@ -871,17 +1099,28 @@ def _get_operator_provider(ty):
         return RealValue
     elif _is_vector(ty):
         inner = _get_operator_provider(ty.element)
-        return type(str(ty), (inner, VectorIndexing), {})
+        return type(str(ty), (VectorValue, inner), {})
     elif _is_struct(ty):
         return StructValue
     else:
         assert False, (str(ty), type(ty))
 
+# (class, type) -> subclass with the operators of the type
+_value_classes = {}
+
+def _value_class(cls, ty):
+    key = cls, ty
+    try:
+        return _value_classes[key]
+    except KeyError:
+        meta = _get_operator_provider(ty)
+        base = type(str('%s_%s' % (cls.__name__, ty)), (cls, meta), {})
+        _value_classes[key] = base
+        return base
+
 class CTemp(CValue):
     def __new__(cls, parent, handle):
-        meta = _get_operator_provider(handle.type)
-        base = type(str('%s_%s' % (cls.__name__, handle.type)), (cls, meta), {})
-        return object.__new__(base)
+        return object.__new__(_value_class(cls, handle.type))
 
     def __init__(self, *args, **kws):
         super(CTemp, self).__init__(*args, **kws)
@@ -897,9 +1136,7 @@ class CTemp(CValue):
 
 class CVar(CValue):
     def __new__(cls, parent, ptr):
-        meta = _get_operator_provider(ptr.type.pointee)
-        base = type(str('%s_%s' % (cls.__name__, ptr.type.pointee)), (cls, meta), {})
-        return object.__new__(base)
+        return object.__new__(_value_class(cls, ptr.type.pointee))
 
     def __init__(self, parent, ptr):
         super(CVar, self).__init__(parent, ptr)
@@ -1004,7 +1241,7 @@ class IntegerValue(OperatorMixin):
 
     def __rshift__(self, rhs):
         if self.unsigned:
-            return self._temp(self.self.parent.builder.lshr(self.value, rhs.value))
+            return self._temp(self.parent.builder.lshr(self.value, rhs.value))
         else:
             return self._temp(self.parent.builder.ashr(self.value, rhs.value))
 
@@ -1180,10 +1417,145 @@ class VectorIndexing(OperatorMixin):
         return CTemp(self.parent, val)
 
     def __setitem__(self, idx, val):
+        self.parent.builder.store(self.insert(idx, val).value, self.ref.value)
+
+    def insert(self, idx, val):
+        '''return a copy of the vector with element `idx` replaced by `val`
+        '''
         idx = _auto_coerce_index(self.parent, idx)
         bldr = self.parent.builder
-        vec = bldr.insert_element(self.value, val.value, idx.value)
-        bldr.store(vec, self.ref.value)
+        return self._temp(bldr.insert_element(self.value, val.value,
+                                              idx.value))
+
+def _vector_operator(name):
+    def operator(self, rhs):
+        impl = getattr(super(VectorValue, self), name, None)
+        if impl is None:
+            return NotImplemented
+        return impl(self._coerce(rhs))
+    operator.__name__ = name
+    return operator
+
+class VectorValue(VectorIndexing):
+    '''operators of vector values
+
+    Arithmetic and bitwise operators work element-wise; comparisons
+    return vectors of i1 (masks) to use with `CBuilder.select`.  The right
+    operand can be a vector, a scalar value of the element type or a
+    python number; scalars are splatted.
+    '''
+
+    @property
+    def count(self):
+        return self.type.count
+
+    def _coerce(self, rhs):
+        if not isinstance(rhs, CValue):
+            rhs = self.parent.constant(self.type.element, rhs)
+        if not _is_vector(rhs.type):
+            rhs = self.parent.splat(rhs, self.type.count)
+        return rhs
+
+    def cast(self, ty, unsigned=False):
+        '''element-wise conversion to the vector type `ty`
+        '''
+        if ty == self.type:
+            return self._temp(self.value)
+        if not _is_vector(ty) or ty.count != self.type.count:
+            raise CastError(self.type, ty)
+
+        bldr = self.parent.builder
+        src, dst = self.type.element, ty.element
+        unsigned = unsigned or getattr(self, 'unsigned', False)
+        if _is_int(src) and _is_int(dst):
+            if src.width < dst.width:
+                op = bldr.zext if unsigned else bldr.sext
+            else:
+                op = bldr.trunc
+        elif _is_int(src) and _is_real(dst):
+            op = bldr.uitofp if unsigned else bldr.sitofp
+        elif _is_real(src) and _is_int(dst):
+            op = bldr.fptoui if unsigned else bldr.fptosi
+        elif _is_real(src) and _is_real(dst):
+            if self.parent.abi.size(src) > self.parent.abi.size(dst):
+                op = bldr.fptrunc
+            else:
+                op = bldr.fpext
+        else:
+            raise CastError(self.type, ty)
+        return self._temp(op(self.value, ty))
+
+    def shuffle(self, mask, other=None):
+        '''shuffle the elements of this vector and of `other`
+
+        mask : list of python int; element i of the result is element
+               mask[i] of the concatenation of the two vectors.
+               None leaves the element undefined.
+        other : [optional] vector of the same type; default to undef.
+        '''
+        i32 = types.int32
+        mask = lc.Constant.vector([lc.Constant.undef(i32) if i is None
+                                   else lc.Constant.int(i32, i)
+                                   for i in mask])
+        if other is None:
+            other = lc.Constant.undef(self.type)
+        else:
+            other = other.value
+        bldr = self.parent.builder
+        return self._temp(bldr.shuffle_vector(self.value, other, mask))
+
+    def reduce(self, combine):
+        '''horizontal reduction
+
+        combine : callable that combines two values, which are vectors or
+                  elements, into one, e.g. `lambda a, b: a + b`.
+
+        Halves the vector with shuffles while the number of elements is
+        even, and then combines the remaining elements one by one.
+        Returns an element.
+        '''
+        vec = self._temp(self.value)
+        count = self.type.count
+        while count > 1 and count % 2 == 0:
+            half = count // 2
+            vec = combine(vec.shuffle(list(range(half))),
+                          vec.shuffle(list(range(half, count))))
+            count = half
+        res = vec[0]
+        for i in range(1, count):
+            res = combine(res, vec[i])
+        return res
+
+    def sum(self):
+        return self.reduce(lambda a, b: a + b)
+
+    def product(self):
+        return self.reduce(lambda a, b: a * b)
+
+    def min(self):
+        select = self.parent.select
+        return self.reduce(lambda a, b: select(a < b, a, b))
+
+    def max(self):
+        select = self.parent.select
+        return self.reduce(lambda a, b: select(a > b, a, b))
+
+    def any(self):
+        '''true if any element of the mask is true
+        '''
+        return self.reduce(lambda a, b: a | b)
+
+    def all(self):
+        '''true if all elements of the mask are true
+        '''
+        return self.reduce(lambda a, b: a & b)
+
+for _name in ['__add__', '__sub__', '__mul__', '__div__', '__truediv__',
+              '__floordiv__', '__mod__', '__lshift__', '__rshift__',
+              '__and__', '__or__', '__xor__',
+              '__lt__', '__le__', '__eq__', '__ne__', '__gt__', '__ge__']:
+    setattr(VectorValue, _name, _vector_operator(_name))
+del _name
 
 class PointerValue(PointerIndexing, PointerCasting):
 
@@ -1311,8 +1683,6 @@ class CArray(CValue, PointerIndexing, PointerCasting):
     def vector_load(self, count, align=0):
         parent = self.parent
         builder = parent.builder
-        values = [self[i] for i in range(count)]
-
         vecty = types.vector(self.type.pointee, count)
         vec = builder.load(builder.bitcast(self.value, types.pointer(vecty)),
                            align=align)
@@ -0,0 +1,293 @@
+'''
+Element-wise application of scalar functions to arrays.
+
+ElementwiseLoop defines a loop that calls a scalar function on every
+element of 1-d strided arrays.  The loop has the signature of a NumPy ufunc
+inner loop:
+
+    void loop(char **args, npy_intp *dimensions, npy_intp *steps, void *data)
+
+`args` holds the address of the first element of each input array,
+followed by the output array if the scalar function returns a value;
+`steps` holds their strides in bytes and `dimensions[0]` is the number of
+elements.  `data` is unused.
+
+Elementwise compiles such a loop and calls it on Python objects that
+support the buffer protocol (array.array, ctypes arrays, NumPy arrays...),
+so that a whole array is processed in one native call.
+'''
+
+import sys
+import array
+import ctypes
+import numbers
+
+import llvm.core as lc
+import llvm.ee as le
+import llvm.passes as lp
+from .builder import CDefinition, CFuncRef, _is_int, _is_real
+from . import shortnames as types
+
+_LOOP_PROTOTYPE = ctypes.CFUNCTYPE(None,
+                                   ctypes.POINTER(ctypes.c_void_p),
+                                   ctypes.POINTER(ctypes.c_ssize_t),
+                                   ctypes.POINTER(ctypes.c_ssize_t),
+                                   ctypes.c_void_p)
+
+_INT_CTYPES = {8: ctypes.c_int8, 16: ctypes.c_int16,
+               32: ctypes.c_int32, 64: ctypes.c_int64}
+
+_INT_FORMATS = frozenset('cbBhHiIlLqQnN')
+_REAL_FORMATS = frozenset('fd')
+_NATIVE_ORDER = '<' if sys.byteorder == 'little' else '>'
+
+try:
+    _buffer = buffer        # Python 2
+except NameError:
+    _buffer = memoryview
+
+
+def _check_type(ty):
+    if _is_int(ty) and ty.width in _INT_CTYPES:
+        return
+    if ty == types.float or ty == types.double:
+        return
+    raise TypeError("element-wise loops do not support %s" % ty)
+
+def _ctype_of(ty):
+    if _is_int(ty):
+        return _INT_CTYPES[ty.width]
+    return ctypes.c_float if ty == types.float else ctypes.c_double
+
+
+class ElementwiseLoop(CDefinition):
+    '''Loop that calls the function `scalar` for each element of its
+    array arguments.  See the module documentation for the signature.
+
+    The loop is defined in the module of `scalar`.  When all the strides
+    are equal to the size of the elements, the loop indexes typed pointers
+    so that the loop vectorizer can handle it.
+    '''
+    _retty_ = types.void
+    _argtys_ = [('args', types.pointer(types.char_p)),
+                ('dimensions', types.npy_intp_p),
+                ('steps', types.npy_intp_p),
+                ('data', types.void_p)]
+
+    def specialize(self, scalar):
+        fnty = scalar.type.pointee
+        for ty in fnty.args:
+            _check_type(ty)
+        if fnty.return_type != types.void:
+            _check_type(fnty.return_type)
+        self.scalar = scalar
+        self._name_ = 'elementwise.%s' % scalar.name
+
+    def body(self, args, dimensions, steps, data):
+        fnty = self.scalar.type.pointee
+        operands = list(fnty.args)
+        has_output = fnty.return_type != types.void
+        if has_output:
+            operands.append(fnty.return_type)
+        nin = len(fnty.args)
+        scalar = self.depends(CFuncRef(self.scalar))
+        inline = not self.scalar.is_declaration
+
+        n = self.var_copy(dimensions[0])
+        bases = [self.var_copy(args[i]) for i in range(len(operands))]
+        strides = [self.var_copy(steps[i]) for i in range(len(operands))]
+
+        contiguous = self.constant(lc.Type.int(1), 1)
+        for ty, stride in zip(operands, strides):
+            itemsize = self.constant(types.npy_intp, self.abi.abi_size(ty))
+            contiguous = contiguous & (stride == itemsize)
+
+        with self.ifelse(contiguous) as ifelse:
+            with ifelse.then():
+                ptrs = [self.var_copy(base.cast(types.pointer(ty)))
+                        for base, ty in zip(bases, operands)]
+                with self.for_range(n) as (loop, i):
+                    result = scalar(*[ptr[i] for ptr in ptrs[:nin]],
+                                    inline=inline)
+                    if has_output:
+                        ptrs[nin][i] = result
+            with ifelse.otherwise():
+                with self.for_range(n) as (loop, i):
+                    ptrs = [base[i * stride:].cast(types.pointer(ty))
+                            for base, stride, ty
+                            in zip(bases, strides, operands)]
+                    result = scalar(*[ptr.load() for ptr in ptrs[:nin]],
+                                    inline=inline)
+                    if has_output:
+                        ptrs[nin].store(result)
+        self.ret()
+
+
+def _buffer_info(obj, ty, writable):
+    '''Return the address, the stride, the length of the 1-d array `obj`
+    and an object that must be kept alive while the address is used.
+    '''
+    itemsize = ctypes.sizeof(_ctype_of(ty))
+    iface = getattr(obj, '__array_interface__', None)
+    if iface is not None:
+        # NumPy arrays, which may have any stride
+        typestr = iface['typestr']
+        kinds = 'iu' if _is_int(ty) else 'f'
+        if (len(iface['shape']) != 1 or typestr[1] not in kinds
+                or int(typestr[2:]) != itemsize
+                or typestr[0] not in ('|', '=', _NATIVE_ORDER)):
+            raise TypeError("expect a 1-d array of %s, got %s of shape %s"
+                            % (ty, typestr, iface['shape']))
+        addr, readonly = iface['data']
+        if writable and readonly:
+            raise TypeError("output array is read-only")
+        stride = (iface.get('strides') or (itemsize,))[0]
+        return addr, stride, iface['shape'][0], obj
+
+    formats = _INT_FORMATS if _is_int(ty) else _REAL_FORMATS
+    try:
+        view = memoryview(obj)
+    except (NameError, TypeError):
+        # Python 2.6 has no memoryview, and array.array and other types
+        # only have the old buffer protocol before Python 3
+        return _old_buffer_info(obj, ty, writable, itemsize, formats)
+    fmt = view.format.lstrip('@=')
+    if view.ndim != 1 or view.itemsize != itemsize or fmt not in formats:
+        raise TypeError("expect a 1-d array of %s, got format %r of "
+                        "%d dimension(s)" % (ty, view.format, view.ndim))
+    if view.strides[0] != itemsize:
+        raise ValueError("only contiguous buffers are supported; "
+                         "use NumPy arrays for strided data")
+    nbytes = len(view) * itemsize
+    if view.readonly:
+        if writable:
+            raise TypeError("output array is read-only")
+        buf = (ctypes.c_char * nbytes).from_buffer_copy(view)
+    else:
+        buf = (ctypes.c_char * nbytes).from_buffer(view)
+    return ctypes.addressof(buf), itemsize, len(view), buf
+
+def _old_buffer_info(obj, ty, writable, itemsize, formats):
+    if isinstance(obj, array.array):
+        if obj.itemsize != itemsize or obj.typecode not in formats:
+            raise TypeError("expect a 1-d array of %s, got typecode %r"
+                            % (ty, obj.typecode))
+        addr, n = obj.buffer_info()
+        return addr, itemsize, n, obj
+
+    # untyped buffers, like bytearray or mmap
+    try:
+        nbytes = len(_buffer(obj))
+    except TypeError:
+        raise TypeError("expect a 1-d array of %s, got %s"
+                        % (ty, type(obj).__name__))
+    if nbytes % itemsize:
+        raise TypeError("buffer size %d is not a multiple of the size of %s"
+                        % (nbytes, ty))
+    try:
+        buf = (ctypes.c_char * nbytes).from_buffer(obj)
+    except TypeError:
+        if writable:
+            raise TypeError("output array is read-only")
+        buf = (ctypes.c_char * nbytes).from_buffer_copy(obj)
+    return ctypes.addressof(buf), itemsize, nbytes // itemsize, buf
+
+def _new_array(ty, n):
+    if _is_real(ty):
+        typecode = 'f' if ty == types.float else 'd'
+    else:
+        itemsize = ctypes.sizeof(_ctype_of(ty))
+        for typecode in 'bhilq':
+            try:
+                if array.array(typecode).itemsize == itemsize:
+                    break
+            except ValueError:      # 'q' needs Python 3.3
+                pass
+        else:
+            raise TypeError("no array typecode for %s" % ty)
+    return array.array(typecode, [0]) * n
+
+
+class Elementwise(object):
+    '''Apply a scalar function element-wise to 1-d arrays.
+
+    Usage:
+
+        square = Elementwise(fn)        # fn is a double (double)
+        out = square(array.array('d', [1, 2, 3]))
+        square(numpy_array, out=numpy_array)
+
+    fn --- The scalar llvm.core.Function.  Its arguments and return value
+    must be integers of 8, 16, 32 or 64 bits, float or double.  The loop is
+    defined in the module of `fn`.
+    engine --- The ExecutionEngine of that module, if any.  Default to a
+    new engine for the module.
+    vectorize --- Whether to run the loop vectorizer on the loop.
+
+    Arguments are arrays of the types of the arguments of `fn`, or Python
+    numbers, which are used for every element.  The output array `out`
+    receives the results.  If it is not given, a new array.array is
+    returned.  All the arrays must have the same length.
+    '''
+
+    def __init__(self, fn, engine=None, vectorize=True):
+        module = fn.module
+        self.function = fn
+        self.loop = ElementwiseLoop(fn)(module)
+        if vectorize:
+            tm = le.TargetMachine.new(opt=3)
+            fpm = lp.build_pass_managers(tm, opt=3, loop_vectorize=True,
+                                         pm=False, mod=module).fpm
+            fpm.run(self.loop)
+        if engine is None:
+            engine = le.EngineBuilder.new(module).opt(3).create()
+        self.engine = engine
+        fnty = fn.type.pointee
+        self._intypes = list(fnty.args)
+        self._outtype = fnty.return_type
+        if self._outtype == types.void:
+            self._outtype = None
+        self._cfunc = _LOOP_PROTOTYPE(engine.get_pointer_to_function(self.loop))
+
+    def __call__(self, *args, **kws):
+        out = kws.pop('out', None)
+        if kws:
+            raise TypeError("unexpected keyword argument %r" % kws.popitem()[0])
+        if len(args) != len(self._intypes):
+            raise TypeError("expect %d arrays, got %d"
+                            % (len(self._intypes), len(args)))
+
+        operands = []           # (address, stride)
+        keepalive = []
+        lengths = set()
+        for obj, ty in zip(args, self._intypes):
+            if isinstance(obj, numbers.Real):
+                value = _ctype_of(ty)(obj)
+                keepalive.append(value)
+                operands.append((ctypes.addressof(value), 0))
+            else:
+                addr, stride, n, keep = _buffer_info(obj, ty, False)
+                keepalive.append(keep)
+                operands.append((addr, stride))
+                lengths.add(n)
+
+        if self._outtype is not None:
+            if out is None:
+                out = _new_array(self._outtype, max(lengths or [1]))
+            addr, stride, n, keep = _buffer_info(out, self._outtype, True)
+            keepalive.append(keep)
+            operands.append((addr, stride))
+            lengths.add(n)
+        elif out is not None:
+            raise TypeError("%s returns void" % self.function.name)
+
+        if len(lengths) > 1:
+            raise ValueError("arrays have different lengths: %s"
+                             % sorted(lengths))
+        n = lengths.pop() if lengths else 1
+
+        data = (ctypes.c_void_p * len(operands))(*[a for a, _ in operands])
+        steps = (ctypes.c_ssize_t * len(operands))(*[s for _, s in operands])
+        dims = (ctypes.c_ssize_t * 1)(n)
+        self._cfunc(data, dims, steps, None)
+        return out
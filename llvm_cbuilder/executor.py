@@ -35,11 +35,21 @@ MAP_CTYPES = {
 class CExecutor(object):
     '''a convenient class for creating ctype functions from LLVM modules
     '''
-    def __init__(self, mod_or_engine):
+    def __init__(self, mod_or_engine, cache=None):
+        '''
+        cache : Optional. A llvm.codecache.FunctionPointerCache (e.g.
+                llvm.codecache.function_pointer_cache) for reusing the
+                native code of identical functions compiled by other
+                engines.
+        '''
         if isinstance(mod_or_engine, Module):
             self.engine = le.EngineBuilder.new(mod_or_engine).opt(3).create()
         else:
             self.engine = mod_or_engine
+        self.cache = cache
+        # Engines that own the native code of the functions returned, when
+        # the cache provided code compiled by another engine.
+        self._owners = {}
 
     def get_ctype_function(self, fn, *typeinfo):
         '''create a ctype function from a LLVM function
@@ -62,6 +72,27 @@ class CExecutor(object):
             retty = typeinfo[0]
             argtys = typeinfo[1:]
         prototype = ct.CFUNCTYPE(retty, *argtys)
-        fnptr = self.engine.get_pointer_to_function(fn)
-        return prototype(fnptr)
+        addr, _ = self._get_pointer(fn)
+        return prototype(addr)
+
+    def get_fast_function(self, fn):
+        '''create a builtin function from a LLVM function
+
+        The argument and return types are taken from the signature of
+        `fn`.  Calls are much cheaper than through a ctype function.
+        See llvm.fastcall for the supported types.
+        '''
+        from llvm.fastcall import make_callable
+        addr, owner = self._get_pointer(fn)
+        return make_callable(self.engine, fn, addr=addr, owner=owner)
+
+    def _get_pointer(self, fn):
+        '''Return the address of `fn` and the engine that owns its code.
+        The owner is kept alive as long as this executor.
+        '''
+        if self.cache is not None:
+            addr, owner = self.cache.get_function_pointer(self.engine, fn)
+            self._owners[id(owner)] = owner
+            return addr, owner
+        return self.engine.get_pointer_to_function(fn), self.engine
 
@@ -37,5 +37,5 @@ npy_intp_p = pointer(npy_intp)
 
 # vector
 def vector(ty, ct):
-    return Type.vector(ty, 4)
+    return Type.vector(ty, ct)
 
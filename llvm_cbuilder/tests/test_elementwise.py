@@ -0,0 +1,91 @@
+from llvm.core import *
+from llvm_cbuilder import *
+import llvm_cbuilder.shortnames as C
+import array
+import unittest
+
+class Axpy(CDefinition):
+    _name_ = 'axpy'
+    _retty_ = C.double
+    _argtys_ = [('a', C.double),
+                ('x', C.float),
+                ('y', C.double),]
+
+    def body(self, a, x, y):
+        self.ret(a * x.cast(C.double) + y)
+
+class Clip(CDefinition):
+    _name_ = 'clip'
+    _retty_ = C.int
+    _argtys_ = [('x', C.int64),
+                ('hi', C.int64),]
+
+    def body(self, x, hi):
+        res = self.var(C.int64, x)
+        with self.ifelse(x > hi) as ifelse:
+            with ifelse.then():
+                res.assign(hi)
+        self.ret(res.cast(C.int))
+
+class TestElementwise(unittest.TestCase):
+    def test_arrays(self):
+        mod = Module.new(__name__)
+        ew = Elementwise(Axpy()(mod))
+        self.assertTrue(ew.loop.name in [f.name for f in mod.functions])
+        mod.verify()
+
+        x = array.array('f', [1, 2, 3, 4, 5])
+        y = array.array('d', [10, 20, 30, 40, 50])
+        out = ew(2.0, x, y)
+        self.assertEqual(out.typecode, 'd')
+        self.assertEqual(list(out), [12, 24, 36, 48, 60])
+
+        # reuse an output array
+        a = array.array('d', [1, 2, 3, 4, 5])
+        res = ew(a, x, y, out=y)
+        self.assertTrue(res is y)
+        self.assertEqual(list(y), [11, 24, 39, 56, 75])
+
+    def test_integers(self):
+        mod = Module.new(__name__)
+        ew = Elementwise(Clip()(mod), vectorize=False)
+        x = array.array('q', range(-3, 10))
+        out = array.array('i', [0] * len(x))
+        ew(x, 5, out=out)
+        self.assertEqual(list(out), [min(v, 5) for v in range(-3, 10)])
+
+    def test_errors(self):
+        mod = Module.new(__name__)
+        ew = Elementwise(Axpy()(mod))
+        x = array.array('f', [1, 2, 3])
+        self.assertRaises(TypeError, ew, 1.0, x)
+        self.assertRaises(TypeError, ew, 1.0, array.array('d', [1]), 1.0)
+        self.assertRaises(ValueError, ew, 1.0, x,
+                          array.array('d', [1, 2]))
+        self.assertRaises(TypeError, ew, 1.0, x, 1.0, out=b'123')
+
+    def test_old_buffer(self):
+        # the path taken for array.array before Python 3
+        from llvm_cbuilder.elementwise import _old_buffer_info
+        y = array.array('d', [1, 2, 3])
+        addr, stride, n, keep = _old_buffer_info(y, C.double, True, 8, 'fd')
+        self.assertEqual((addr, stride, n), (y.buffer_info()[0], 8, 3))
+        self.assertTrue(keep is y)
+        self.assertRaises(TypeError, _old_buffer_info, array.array('f'),
+                          C.double, False, 8, 'fd')
+
+    def test_strided(self):
+        try:
+            import numpy as np
+        except ImportError:
+            return
+        mod = Module.new(__name__)
+        ew = Elementwise(Axpy()(mod))
+        x = np.arange(10, dtype=np.float32)
+        y = np.ones(10)
+        out = np.zeros(5)
+        ew(3.0, x[::2], y[1::2], out=out)
+        self.assertEqual(list(out), list(3.0 * x[::2] + 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+from llvm.core import *
+from llvm_cbuilder import *
+import llvm_cbuilder.shortnames as C
+import unittest, logging
+
+class Abs(CDefinition):
+    _name_ = 'abs'
+    _retty_ = C.int
+    _argtys_ = [('x', C.int),]
+
+    def body(self, x):
+        zero = self.constant(C.int, 0)
+        with self.ifelse(x < zero) as ifelse:
+            with ifelse.then():
+                x.assign(-x)
+        self.ret(x)
+
+class Sign(CDefinition):
+    _name_ = 'sign'
+    _retty_ = C.int
+    _argtys_ = [('x', C.int),]
+
+    def body(self, x):
+        zero = self.constant(C.int, 0)
+        with self.ifelse(x < zero) as ifelse:
+            with ifelse.then():
+                self.ret(self.constant(C.int, -1))
+            with ifelse.otherwise():
+                with self.ifelse(x == zero) as inner:
+                    with inner.then():
+                        self.ret(zero)
+                    with inner.otherwise():
+                        self.ret(self.constant(C.int, 1))
+
+class TestIfElse(unittest.TestCase):
+    def block_names(self, fn):
+        return [bb.name for bb in fn.basic_blocks]
+
+    def test_then_only(self):
+        mod = Module.new(__name__)
+        lfunc = Abs().define(mod, optimize=False)
+        logging.debug(lfunc)
+        mod.verify()
+        # no empty else block
+        self.assertEqual(self.block_names(lfunc),
+                         ['decl', 'body', 'if.then', 'if.end'])
+
+        exe = CExecutor(mod)
+        func = exe.get_ctype_function(lfunc, 'int, int')
+        for x in (-5, 0, 7):
+            self.assertEqual(func(x), abs(x))
+
+    def test_terminated_branches(self):
+        mod = Module.new(__name__)
+        lfunc = Sign().define(mod, optimize=False)
+        logging.debug(lfunc)
+        mod.verify()
+        # both branches return: no end block
+        self.assertTrue('if.end' not in self.block_names(lfunc))
+        for bb in lfunc.basic_blocks:
+            self.assertTrue(bb.terminator is not None)
+
+        exe = CExecutor(mod)
+        func = exe.get_ctype_function(lfunc, 'int, int')
+        for x in (-5, 0, 7):
+            self.assertEqual(func(x), (x > 0) - (x < 0))
+
+    def test_misuse(self):
+        mod = Module.new(__name__)
+        cb = CBuilder.new_function(mod, 'misuse', C.void, [C.int])
+        cond = cb.args[0] == cb.constant(C.int, 0)
+        with cb.ifelse(cond) as ifelse:
+            self.assertRaises(RuntimeError, ifelse.otherwise().__enter__)
+            with ifelse.then():
+                pass
+            self.assertRaises(RuntimeError, ifelse.then().__enter__)
+            with ifelse.otherwise():
+                pass
+            self.assertRaises(RuntimeError, ifelse.otherwise().__enter__)
+        cb.ret()
+        cb.close()
+        mod.verify()
+
+if __name__ == '__main__':
+    unittest.main()
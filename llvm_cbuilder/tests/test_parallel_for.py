@@ -0,0 +1,98 @@
+from llvm.core import *
+from llvm.passes import *
+from llvm.ee import *
+from llvm_cbuilder import *
+import llvm_cbuilder.shortnames as C
+from ctypes import c_int, POINTER
+import unittest, logging
+import sys
+
+# logging.basicConfig(level=logging.DEBUG)
+
+NUM_OF_THREAD = 4
+
+class ParallelSquare(CDefinition):
+    '''Square the elements of A in parallel and return their sum
+    '''
+    _name_ = 'parallel_square'
+    _retty_ = C.int
+    _argtys_ = [('A', C.pointer(C.int)),
+                ('n', C.int),
+                ('nthreads', C.int),]
+
+    def body(self, A, n, nthreads):
+        total = self.var(C.int, 0)
+        with self.parallel_for_range(0, n, nthreads,
+                                     shared=[A, total]) as (i, (A, total)):
+            A[i] = A[i] * A[i]
+            self.atomic_add(total.ref, A[i], 'acq_rel')
+        self.ret(total)
+
+class TestParallelFor(unittest.TestCase):
+    @unittest.skipIf(sys.platform == 'win32', "pthreads not supported on Windows")
+    def test_parallel_for(self):
+        mod = Module.new(__name__)
+        lfunc = ParallelSquare()(mod)
+        logging.debug(mod)
+        mod.verify()
+
+        exe = CExecutor(mod)
+        func = exe.get_ctype_function(lfunc, c_int, POINTER(c_int), c_int, c_int)
+
+        for n in (0, 1, 3, 4, 10, 1000):
+            for nthreads in (-1, 0, 1, 3, NUM_OF_THREAD, 16):
+                A = (c_int * max(n, 1))(*range(n))
+                total = func(A, n, nthreads)
+                self.assertEqual(list(A[:n]), [x * x for x in range(n)])
+                self.assertEqual(total, sum(x * x for x in range(n)))
+
+    @unittest.skipIf(sys.platform == 'win32', "pthreads not supported on Windows")
+    def test_static_threads(self):
+        mod = Module.new(__name__)
+        cb = CBuilder.new_function(mod, 'count', C.int64, [C.int64])
+        n = cb.args[0]
+        count = cb.var(C.int64, 0)
+        with cb.parallel_for_range(cb.constant(C.int64, 0), n, NUM_OF_THREAD,
+                                   shared=[count]) as (i, (count,)):
+            cb.atomic_add(count.ref, cb.constant(C.int64, 1), 'acq_rel')
+        self.assertRaises(ValueError, cb.parallel_for_range(0, 10, 0).__enter__)
+        cb.ret(count)
+        cb.close()
+        mod.verify()
+        workers = [f for f in mod.functions if '.parallel_for' in f.name]
+        self.assertEqual(len(workers), 1)
+        self.assertEqual(workers[0].linkage, LINKAGE_INTERNAL)
+        # a fixed number of threads only allocates in the entry block
+        for bb in cb.function.basic_blocks[1:]:
+            self.assertNotIn('alloca', [i.opcode_name for i in bb.instructions])
+
+        exe = CExecutor(mod)
+        func = exe.get_ctype_function(cb.function, 'int64, int64')
+        self.assertEqual(func(12345), 12345)
+
+    @unittest.skipIf(sys.platform == 'win32', "pthreads not supported on Windows")
+    def test_empty_range(self):
+        mod = Module.new(__name__)
+        for unsigned in (False, True):
+            name = 'count_u' if unsigned else 'count_s'
+            cb = CBuilder.new_function(mod, name, C.int64, [C.int64, C.int64])
+            start, stop = cb.args
+            start.unsigned = stop.unsigned = unsigned
+            count = cb.var(C.int64, 0)
+            with cb.parallel_for_range(start, stop, NUM_OF_THREAD,
+                                       shared=[count]) as (i, (count,)):
+                cb.atomic_add(count.ref, cb.constant(C.int64, 1), 'acq_rel')
+            cb.ret(count)
+            cb.close()
+        mod.verify()
+
+        exe = CExecutor(mod)
+        for name in ('count_s', 'count_u'):
+            func = exe.get_ctype_function(mod.get_function_named(name),
+                                          'int64, int64, int64')
+            self.assertEqual(func(3, 10), 7)
+            self.assertEqual(func(10, 3), 0)
+            self.assertEqual(func(5, 5), 0)
+
+if __name__ == '__main__':
+    unittest.main()
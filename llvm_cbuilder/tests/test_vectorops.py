@@ -0,0 +1,106 @@
+from llvm.core import *
+from llvm_cbuilder import *
+import llvm_cbuilder.shortnames as C
+from ctypes import c_float, c_int, POINTER
+import unittest, logging
+
+floatv4 = C.vector(C.float, 4)
+intv8 = C.vector(C.int, 8)
+
+class ClampSum(CDefinition):
+    '''Out = 2 * min(A, B) clamped to [0, 10]; returns the sum of Out.
+    '''
+    _name_ = 'clamp_sum'
+    _retty_ = C.float
+    _argtys_ = [('A', C.pointer(C.float)),
+                ('B', C.pointer(C.float)),
+                ('Out', C.pointer(C.float)),]
+
+    def body(self, A, B, Out):
+        a = A[0:].vector_load(4, align=1)
+        b = B[0:].vector_load(4, align=1)
+        res = self.select(a < b, a, b) * 2.0
+        res = self.select(res > self.constant(C.float, 10), self.splat(
+                          self.constant(C.float, 10), 4), res)
+        res = self.select(res < 0.0, self.constant_null(floatv4), res)
+        Out[0:].vector_store(res, align=1)
+        self.ret(res.sum())
+
+class IntVectorOps(CDefinition):
+    '''Out = reversed(A) + A as floats; returns max(A) + min(A) * 1000
+    + any(A > 5) * 100 + all(A >= 0) * 10
+    '''
+    _name_ = 'int_vector_ops'
+    _retty_ = C.int
+    _argtys_ = [('A', C.pointer(C.int)),
+                ('Out', C.pointer(C.float)),]
+
+    def body(self, A, Out):
+        a = A[0:].vector_load(8, align=1)
+        rev = a.shuffle(list(reversed(range(8))))
+        fsum = (rev + a).cast(C.vector(C.float, 8))
+        Out[0:].vector_store(fsum, align=1)
+
+        anygt = (a > 5).any().cast(C.int, unsigned=True)
+        allge = (a >= self.constant(C.int, 0)).all().cast(C.int, unsigned=True)
+        res = a.max() + a.min() * self.constant(C.int, 1000)
+        res = res + anygt * self.constant(C.int, 100)
+        res = res + allge * self.constant(C.int, 10)
+        self.ret(res)
+
+class TestVectorOps(unittest.TestCase):
+    def test_types(self):
+        self.assertEqual(C.vector(C.int, 8).count, 8)
+        self.assertEqual(C.vector(C.double, 2).element, C.double)
+
+    def test_real_vector(self):
+        mod = Module.new(__name__)
+        lfunc = ClampSum()(mod)
+        logging.debug(mod)
+        mod.verify()
+
+        exe = CExecutor(mod)
+        float_p = POINTER(c_float)
+        func = exe.get_ctype_function(lfunc, c_float, float_p, float_p,
+                                      float_p)
+        A = (c_float * 4)(1, -2, 8, 4)
+        B = (c_float * 4)(3, 1, 9, 3.5)
+        Out = (c_float * 4)()
+        total = func(A, B, Out)
+        self.assertEqual(list(Out), [2, 0, 10, 7])
+        self.assertEqual(total, 19)
+
+    def test_int_vector(self):
+        mod = Module.new(__name__)
+        lfunc = IntVectorOps()(mod)
+        logging.debug(mod)
+        mod.verify()
+
+        exe = CExecutor(mod)
+        func = exe.get_ctype_function(lfunc, c_int, POINTER(c_int),
+                                      POINTER(c_float))
+        values = [3, 1, 4, 1, 5, 9, 2, 6]
+        A = (c_int * 8)(*values)
+        Out = (c_float * 8)()
+        res = func(A, Out)
+        self.assertEqual(list(Out), [x + y for x, y
+                                     in zip(values, reversed(values))])
+        self.assertEqual(res, 9 + 1 * 1000 + 100 + 10)
+
+        values = [-3, 1, 4, 1, 5, 0, 2, 5]
+        A = (c_int * 8)(*values)
+        self.assertEqual(func(A, Out), 5 - 3 * 1000)
+
+    def test_constants(self):
+        mod = Module.new(__name__)
+        cb = CBuilder.new_function(mod, 'constants', C.void, [])
+        vec = cb.constant(intv8, list(range(8)))
+        self.assertEqual(vec.type, intv8)
+        self.assertEqual(cb.constant(floatv4, 1.5).type, floatv4)
+        self.assertRaises(ValueError, cb.constant, floatv4, [1, 2])
+        self.assertRaises(CastError, vec.cast, floatv4)
+        cb.ret()
+        cb.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 #include <Python.h>
+#include <map>
+#include <string>
 #include <python3adapt.h>
 #include <capsulethunk.h>
 #include <llvm_binding/capsule_context.h>
@@ -69,6 +71,243 @@ PyObject* getClassName(PyObject* self, PyObject* args) {
     }
 }
 
+// ---------------
+// Identity table
+// ---------------
+// Maps (address, Python class) to a weak reference to the wrapper object,
+// so that an LLVM object is represented by a single wrapper per class.
+// Entries of dead wrappers are removed lazily: when they are looked up,
+// or by a sweep of the whole table when it has doubled in size.
+
+typedef std::pair<void*, PyObject*> IdentityKey;
+typedef std::map<IdentityKey, PyObject*> IdentityTable;
+
+static IdentityTable TheIdentityTable;
+static size_t IdentityTableSweepSize = 1024;
+
+static
+void sweepIdentityTable() {
+    IdentityTable::iterator it = TheIdentityTable.begin();
+    while (it != TheIdentityTable.end()) {
+        if (PyWeakref_GET_OBJECT(it->second) == Py_None) {
+            Py_DECREF(it->second);
+            TheIdentityTable.erase(it++);
+        } else {
+            ++it;
+        }
+    }
+    IdentityTableSweepSize = 2 * TheIdentityTable.size();
+    if (IdentityTableSweepSize < 1024) {
+        IdentityTableSweepSize = 1024;
+    }
+}
+
+static
+void* getCapsulePointer(PyObject* obj) {
+    return PyCapsule_GetPointer(obj, PyCapsule_GetName(obj));
+}
+
+static
+PyObject* getCached(PyObject* self, PyObject* args) {
+    PyObject *obj, *cls;
+    if (!PyArg_ParseTuple(args, "OO", &obj, &cls)) {
+        return NULL;
+    }
+    void* pointer = getCapsulePointer(obj);
+    if (!pointer) return NULL;
+
+    IdentityTable::iterator it;
+    it = TheIdentityTable.find(IdentityKey(pointer, cls));
+    if (it != TheIdentityTable.end()) {
+        PyObject* cached = PyWeakref_GET_OBJECT(it->second);
+        if (cached != Py_None) {
+            Py_INCREF(cached);
+            return cached;
+        }
+        Py_DECREF(it->second);
+        TheIdentityTable.erase(it);
+    }
+    Py_RETURN_NONE;
+}
+
+static
+PyObject* setCached(PyObject* self, PyObject* args) {
+    PyObject *obj, *cls, *wrapper;
+    if (!PyArg_ParseTuple(args, "OOO", &obj, &cls, &wrapper)) {
+        return NULL;
+    }
+    void* pointer = getCapsulePointer(obj);
+    if (!pointer) return NULL;
+
+    PyObject* ref = PyWeakref_NewRef(wrapper, NULL);
+    if (!ref) return NULL;
+
+    std::pair<IdentityTable::iterator, bool> res;
+    res = TheIdentityTable.insert(std::make_pair(IdentityKey(pointer, cls),
+                                                 ref));
+    if (!res.second) {
+        Py_DECREF(res.first->second);
+        res.first->second = ref;
+    }
+    if (TheIdentityTable.size() >= IdentityTableSweepSize) {
+        sweepIdentityTable();
+    }
+    Py_RETURN_NONE;
+}
+
+static
+PyObject* dropCached(PyObject* self, PyObject* args) {
+    PyObject* obj;
+    if (!PyArg_ParseTuple(args, "O", &obj)) {
+        return NULL;
+    }
+    void* pointer = getCapsulePointer(obj);
+    if (!pointer) return NULL;
+
+    IdentityTable::iterator it;
+    it = TheIdentityTable.lower_bound(IdentityKey(pointer, NULL));
+    while (it != TheIdentityTable.end() && it->first.first == pointer) {
+        Py_DECREF(it->second);
+        TheIdentityTable.erase(it++);
+    }
+    Py_RETURN_NONE;
+}
+
+static
+PyObject* countCached(PyObject* self, PyObject* args) {
+    if (!PyArg_ParseTuple(args, "")) {
+        return NULL;
+    }
+    sweepIdentityTable();
+    return PyLong_FromSize_t(TheIdentityTable.size());
+}
+
+// ----------
+// Ownership
+// ----------
+// A tracked PyCapsule counts as a reference to its address.  When the last
+// tracked capsule of an address is destroyed, the destructor registered
+// for (address, capsule name), if any, is called to delete the object.
+
+typedef std::map<void*, Py_ssize_t> RefCountMap;
+typedef std::pair<void*, std::string> OwnerKey;
+typedef std::map<OwnerKey, PyObject*> DtorMap;
+
+static RefCountMap TheRefCounts;
+static DtorMap TheDtors;
+
+static
+void callDtor(PyObject* dtor, void* pointer, const char* name) {
+    // The dying capsule cannot be handed to Python; use a temporary one.
+    PyObject *type, *value, *traceback;
+    PyErr_Fetch(&type, &value, &traceback);
+    PyObject* tmp = PyCapsule_New(pointer, name, NULL);
+    if (tmp) {
+        PyObject* res = PyObject_CallFunctionObjArgs(dtor, tmp, NULL);
+        Py_DECREF(tmp);
+        if (res) {
+            Py_DECREF(res);
+        } else {
+            PyErr_WriteUnraisable(dtor);
+        }
+    } else {
+        PyErr_WriteUnraisable(dtor);
+    }
+    PyErr_Restore(type, value, traceback);
+}
+
+static
+void destroyTrackedCapsule(PyObject* cap) {
+    const char* name = PyCapsule_GetName(cap);
+    void* pointer = PyCapsule_GetPointer(cap, name);
+
+    RefCountMap::iterator it = TheRefCounts.find(pointer);
+    Assert(it != TheRefCounts.end() && "RefCt drop below 0");
+    if (it != TheRefCounts.end() && --it->second == 0) {
+        TheRefCounts.erase(it);
+        DtorMap::iterator dt = TheDtors.find(OwnerKey(pointer, name));
+        if (dt != TheDtors.end()) {
+            PyObject* dtor = dt->second;
+            TheDtors.erase(dt);
+            callDtor(dtor, pointer, name);
+            Py_DECREF(dtor);
+        }
+    }
+    pycapsule_dtor_free_context(cap);
+}
+
+static
+PyObject* track(PyObject* self, PyObject* args) {
+    PyObject* obj;
+    if (!PyArg_ParseTuple(args, "O", &obj)) {
+        return NULL;
+    }
+    if (PyCapsule_GetDestructor(obj) != destroyTrackedCapsule) {
+        void* pointer = getCapsulePointer(obj);
+        if (!pointer) return NULL;
+        if (0 != PyCapsule_SetDestructor(obj, destroyTrackedCapsule)) {
+            return NULL;
+        }
+        TheRefCounts[pointer] += 1;
+    }
+    Py_RETURN_NONE;
+}
+
+static
+PyObject* getDtor(PyObject* self, PyObject* args) {
+    PyObject* obj;
+    if (!PyArg_ParseTuple(args, "O", &obj)) {
+        return NULL;
+    }
+    const char* name = PyCapsule_GetName(obj);
+    void* pointer = getCapsulePointer(obj);
+    if (!pointer) return NULL;
+
+    DtorMap::iterator it = TheDtors.find(OwnerKey(pointer, name));
+    if (it == TheDtors.end()) {
+        Py_RETURN_NONE;
+    }
+    Py_INCREF(it->second);
+    return it->second;
+}
+
+static
+PyObject* setDtor(PyObject* self, PyObject* args) {
+    PyObject *obj, *dtor;
+    if (!PyArg_ParseTuple(args, "OO", &obj, &dtor)) {
+        return NULL;
+    }
+    const char* name = PyCapsule_GetName(obj);
+    void* pointer = getCapsulePointer(obj);
+    if (!pointer) return NULL;
+
+    OwnerKey key(pointer, name);
+    DtorMap::iterator it = TheDtors.find(key);
+    if (it != TheDtors.end()) {
+        Py_DECREF(it->second);
+        TheDtors.erase(it);
+    }
+    if (dtor != Py_None) {
+        Py_INCREF(dtor);
+        TheDtors[key] = dtor;
+    }
+    Py_RETURN_NONE;
+}
+
+static
+PyObject* getRefCount(PyObject* self, PyObject* args) {
+    PyObject* obj;
+    if (!PyArg_ParseTuple(args, "O", &obj)) {
+        return NULL;
+    }
+    void* pointer = getCapsulePointer(obj);
+    if (!pointer) return NULL;
+
+    RefCountMap::iterator it = TheRefCounts.find(pointer);
+    Py_ssize_t refct = it == TheRefCounts.end() ? 0 : it->second;
+    return PyLong_FromSsize_t(refct);
+}
+
 
 static PyMethodDef core_methods[] = {
 #define declmethod(func) { #func , ( PyCFunction )func , METH_VARARGS , NULL }
@@ -76,6 +315,14 @@ static PyMethodDef core_methods[] = {
     declmethod(getPointer),
     declmethod(check),
     declmethod(getClassName),
+    declmethod(getCached),
+    declmethod(setCached),
+    declmethod(dropCached),
+    declmethod(countCached),
+    declmethod(track),
+    declmethod(getDtor),
+    declmethod(setDtor),
+    declmethod(getRefCount),
     { NULL },
 #undef declmethod
 };
@@ -1,6 +1,6 @@
-from weakref import WeakKeyDictionary, WeakValueDictionary, ref
-from collections import defaultdict
 import logging
+from ._capsule import getCached, setCached, dropCached, countCached
+from ._capsule import track, getDtor, setDtor, getRefCount
 logger = logging.getLogger(__name__)
 
 def set_debug(enabled):
@@ -17,33 +17,15 @@ def set_debug(enabled):
     else:
         logger.setLevel(logging.WARNING)
 
-def _capsule_weakref_dtor(item):
-    addr = item.pointer
-    name = item.name
-    _addr2refct[addr] -= 1
-    refct = _addr2refct[addr]
-    assert refct >= 0, "RefCt drop below 0"
-    if refct == 0:
-        dtor = _addr2dtor.pop((name, addr), None)
-        if dtor is not None:
-            logger.debug('Destroy %s %s', name, hex(addr))
-            dtor(item.capsule)
-
 class Capsule(object):
-    "Wraps PyCapsule so that we can build weakref of it."
+    "Wraps PyCapsule and counts it as a reference to its address."
 
     from ._capsule import check, getClassName, getName, getPointer
 
     def __init__(self, capsule):
         assert Capsule.valid(capsule)
         self.capsule = capsule
-
-        weak = WeakRef(self, _capsule_weakref_dtor)
-        weak.pointer = self.pointer
-        weak.capsule = capsule
-        weak.name = self.name
-        _capsule2weak[self] = weak
-        _addr2refct[self.pointer] += 1
+        track(capsule)
 
     @property
     def classname(self):
@@ -81,43 +63,45 @@ class Capsule(object):
     def __ne__(self, other):
         return not (self == other)
 
-class WeakRef(ref):
-    pass
-
-_addr2refct = defaultdict(lambda: 0)
-_capsule2weak = WeakKeyDictionary()
-_addr2dtor = {}
 _pyclasses = {}
 
-# Cache {cls: {addr: obj}}
-# NOTE: The same 'addr' may appear in multiple class bins.
-_cache = defaultdict(WeakValueDictionary)
+# Ownership is kept in the _capsule extension:
+#   track(cap) counts `cap` as a reference to its address until the PyCapsule
+#       is destroyed.
+#   getDtor(cap), setDtor(cap, dtor) access the destructor registered for
+#       the name and the address of `cap`; None if the object is not owned.
+#   getRefCount(cap) is the number of tracked capsules of the address.
+# When the last tracked capsule of an address is destroyed, the registered
+# destructor is called.
+
+# The wrappers are cached in the identity table of the _capsule extension,
+# keyed by (addr, cls):
+#   getCached(cap, cls) -> wrapper or None
+#   setCached(cap, cls, wrapper)
+#   dropCached(cap) forgets all the wrappers of the address of `cap`.
+# NOTE: The same 'addr' may appear with multiple classes.
+# `cls` is compared by identity; it may be any object that stays alive,
+# e.g. llvm.core keys values with (class, value ID) tuples.
 
 def release_ownership(old):
     logger.debug('Release %s', old)
-    addr = Capsule.getPointer(old)
-    name = Capsule.getName(old)
-    if _addr2dtor.get((name, addr)) is None:
+    if getDtor(old) is None:
         clsname = Capsule.getClassName(old)
         if not _pyclasses[clsname]._has_dtor():
             return
         # Guard duplicated release
         raise Exception("Already released")
-    _addr2dtor[(name, addr)] = None
+    setDtor(old, None)
 
 
 def obtain_ownership(cap):
     cls = cap.get_class()
     if cls._has_dtor():
-        addr = cap.pointer
-        name = cap.name
-        assert _addr2dtor[addr] is None
-        _addr2dtor[(name, addr)] = cls._delete_
+        assert getDtor(cap.capsule) is None
+        setDtor(cap.capsule, cls._delete_)
 
 def has_ownership(cap):
-    addr = Capsule.getPointer(cap)
-    name = Capsule.getName(cap)
-    return _addr2dtor.get((name, addr)) is not None
+    return getDtor(cap) is not None
 
 def wrap(cap, owned=False):
     '''Wrap a PyCapsule with the corresponding Wrapper class.
@@ -128,17 +112,14 @@ def wrap(cap, owned=False):
             return list(map(wrap, cap))
         return cap     # bypass if cap is not a PyCapsule and not a list
 
-    cap = Capsule(cap)
-    cls = cap.get_class()
-    addr = cap.pointer
-    name = cap.name
-    try: # lookup cached object
-        return _cache[cls][addr]
-    except KeyError:
+    cls = _pyclasses[Capsule.getClassName(cap)]
+    obj = getCached(cap, cls)   # lookup cached object
+    if obj is None:
+        cap = Capsule(cap)
         if not owned and cls._has_dtor():
-            _addr2dtor[(name, addr)] = cls._delete_
-        obj = cap.instantiate()
-        _cache[cls][addr] = obj    # cache it
+            setDtor(cap.capsule, cls._delete_)
+        obj = cls(cap)
+        setCached(cap.capsule, cls, obj)    # cache it
     return obj
 
 def unwrap(obj):
@@ -189,20 +170,38 @@ class Wrapper(object):
     def _has_dtor(cls):
         return hasattr(cls, '_delete_')
 
+# Casters generated with the binding, registered by llvmpy.api:
+#   {(from type, to type): caster}
+_downcast_table = {}
+#   {from type: caster to the most derived class known to the binding}
+_concrete_table = {}
+
+def register_downcasts(downcasts, concretes):
+    _downcast_table.update(downcasts)
+    _concrete_table.update(concretes)
+
 def downcast(obj, cls):
-    from . import _api
     if type(obj) is cls:
         return obj
     fromty = obj._llvm_type_
     toty = cls._llvm_type_
     logger.debug("Downcast %s to %s" , fromty, toty)
-    fname = 'downcast_%s_to_%s' % (fromty, toty)
-    fname = fname.replace('::', '_')
     try:
-        caster = getattr(_api.downcast, fname)
-    except AttributeError:
+        caster = _downcast_table[fromty, toty]
+    except KeyError:
         fmt = "Downcast from %s to %s is not supported"
         raise TypeError(fmt % (fromty, toty))
+    return _cast(obj, caster)
+
+def concrete(obj):
+    '''Downcast `obj` to its most derived class known to the binding.
+    '''
+    caster = _concrete_table.get(obj._llvm_type_)
+    if caster is None:
+        return obj
+    return _cast(obj, caster)
+
+def _cast(obj, caster):
     old = unwrap(obj)
     new = caster(old)
     used_to_own = has_ownership(old)
@@ -30,18 +30,43 @@ class SubModule(object):
                 includes |= unit.includes
         return includes
 
-    def aggregate_downcast(self):
-        dclist = []
+    def aggregate_downcastables(self):
+        '''Returns [(bcls, cls)] for all classes `cls` that can be downcast
+        from `bcls`.
+        '''
+        pairs = []
         for cls in self.classes:
-            for bcls in cls.downcastables:
-                from_to = bcls.fullname, cls.fullname
-                name = 'downcast_%s_to_%s' % tuple(map(cg.mangle, from_to))
-                fn = Function(namespaces[''], name, ptr(cls), ptr(bcls))
-                dclist.append((from_to, fn))
+            for bcls in sorted(cls.downcastables, key=lambda c: c.fullname):
+                pairs.append((bcls, cls))
         for ns in self.namespaces:
-            dclist.extend(ns.aggregate_downcast())
+            pairs.extend(ns.aggregate_downcastables())
+        return pairs
+
+    def aggregate_downcast(self):
+        dclist = []
+        for bcls, cls in self.aggregate_downcastables():
+            from_to = bcls.fullname, cls.fullname
+            name = 'downcast_%s_to_%s' % tuple(map(cg.mangle, from_to))
+            fn = Function(namespaces[''], name, ptr(cls), ptr(bcls))
+            dclist.append((from_to, fn))
         return dclist
 
+    def aggregate_concrete(self):
+        '''Returns [(bcls, [cls, ...])] for all classes `bcls` that can be
+        downcast from.  The target classes are sorted from the most derived,
+        so that the first one an object is an instance of is its most
+        derived class known to the binding.
+        '''
+        targets = {}
+        for bcls, cls in self.aggregate_downcastables():
+            targets.setdefault(bcls, []).append(cls)
+        res = []
+        for bcls in sorted(targets, key=lambda c: c.fullname):
+            clslist = sorted(targets[bcls],
+                             key=lambda c: (-c.depth, c.fullname))
+            res.append((bcls, clslist))
+        return res
+
     def iter_all(self):
         for fn in self.methods:
             yield fn
@@ -309,6 +334,14 @@ class Class(SubModule, _Type):
         else:
             return self.fullname
 
+    @property
+    def depth(self):
+        "Number of ancestors along the longest inheritance path."
+        if self.bases:
+            return 1 + max(base.depth for base in self.bases)
+        else:
+            return 0
+
     @property
     def fullname(self):
         try:
@@ -407,6 +440,9 @@ class Method(object):
         self.includes = set()
         self._add_signature(return_type, *args)
         self.disowning = False
+        # Release the GIL during the call.  The context lock is still
+        # held, so the call runs alongside Python code, not LLVM code.
+        self.nogil = False
 
     def _add_signature(self, return_type, *args):
         prev_lens = set(map(len, self.signatures))
@@ -448,7 +484,15 @@ class Method(object):
         self.compile_cpp(cg.CppCodeWriter(println))
 
     def compile_cpp(self, writer):
+        if self.nogil:
+            for sig in self.signatures:
+                # PyObject* arguments and return values are handled by the
+                # callee, which must hold the GIL.
+                assert PyObjectPtr not in sig, \
+                        "%s: cannot release the GIL around a call that " \
+                        "uses PyObject*" % self
         with writer.py_function(self.c_name):
+            writer.lock_context()
             if len(self.signatures) == 1:
                 sig = self.signatures[0]
                 retty = sig[0]
@@ -470,7 +514,8 @@ class Method(object):
 
     def compile_cpp_body(self, writer, retty, argtys):
         args = writer.parse_arguments('args', ptr(self.parent), *argtys)
-        ret = writer.method_call(self.realname, retty.fullname, *args)
+        with writer.allow_threads(self.nogil):
+            ret = writer.method_call(self.realname, retty.fullname, *args)
         writer.return_value(retty.wrap(writer, ret))
 
     def compile_py(self, writer):
@@ -522,7 +567,8 @@ class CustomMethod(Method):
 
     def compile_cpp_body(self, writer, retty, argtys):
         args = writer.parse_arguments('args', ptr(self.parent), *argtys)
-        ret = writer.call(self.methodname, retty.fullname, *args)
+        with writer.allow_threads(self.nogil):
+            ret = writer.call(self.methodname, retty.fullname, *args)
         writer.return_value(retty.wrap(writer, ret))
 
 
@@ -535,7 +581,8 @@ class StaticMethod(Method):
         writer.return_value(retty.wrap(writer, ret))
 
     def compile_cpp_call(self, writer, retty, args):
-        ret = writer.call(self.fullname, retty.fullname, *args)
+        with writer.allow_threads(self.nogil):
+            ret = writer.call(self.fullname, retty.fullname, *args)
         return ret
 
     def compile_py(self, writer):
@@ -558,7 +605,8 @@ class CustomStaticMethod(StaticMethod):
 
     def compile_cpp_body(self, writer, retty, argtys):
         args = writer.parse_arguments('args', *argtys)
-        ret = writer.call(self.methodname, retty.fullname, *args)
+        with writer.allow_threads(self.nogil):
+            ret = writer.call(self.methodname, retty.fullname, *args)
         writer.return_value(retty.wrap(writer, ret))
 
 class Function(Method):
@@ -571,7 +619,8 @@ class Function(Method):
 
     def compile_cpp_body(self, writer, retty, argtys):
         args = writer.parse_arguments('args', *argtys)
-        ret = writer.call(self.fullname, retty.fullname, *args)
+        with writer.allow_threads(self.nogil):
+            ret = writer.call(self.fullname, retty.fullname, *args)
         writer.return_value(retty.wrap(writer, ret))
 
     def compile_py(self, writer):
@@ -800,6 +849,7 @@ class Attr(object):
 
     def compile_cpp(self, writer):
         # getter
+        # The accessors only copy a field: no context lock.
         with writer.py_function(self.getter_c_name):
             (this,) = writer.parse_arguments('args', ptr(self.parent))
             attr = self.name
@@ -129,6 +129,8 @@ class CodeWriterBase(object):
         return name
 
 class CppCodeWriter(CodeWriterBase):
+    nogil = False
+
     @contextlib.contextmanager
     def block(self, lead):
         self.println(lead)
@@ -176,13 +178,47 @@ class CppCodeWriter(CodeWriterBase):
 
         return unwrapped
 
+    def lock_context(self):
+        '''Hold the context lock until the end of the current block.
+
+        The lock serializes all LLVM work, see context_lock.h.
+        '''
+        guard = self.new_symbol('context_guard')
+        self.println('ContextLockGuard %s;' % guard)
+
+    @contextlib.contextmanager
+    def allow_threads(self, enabled=True):
+        '''Calls emitted in this context release the GIL if `enabled`.
+        The context lock must be held, see lock_context(): other threads
+        may run Python code meanwhile, but not LLVM code.
+        '''
+        old = self.nogil
+        self.nogil = enabled
+        yield
+        self.nogil = old
+
+    def _invoke(self, retty, stmt):
+        if not self.nogil:
+            if retty == 'void':
+                self.println(stmt + ';')
+            else:
+                return self.declare(retty, stmt)
+        else:
+            ret = None
+            if retty != 'void':
+                assert not retty.endswith('&'), \
+                        "cannot release the GIL around %s" % stmt
+                ret = self.declare(retty)
+                stmt = '%s = %s' % (ret, stmt)
+            self.println('Py_BEGIN_ALLOW_THREADS')
+            self.println(stmt + ';')
+            self.println('Py_END_ALLOW_THREADS')
+            return ret
+
     def call(self, func, retty, *args):
         arglist = ', '.join(args)
         stmt = '%(func)s(%(arglist)s)' % locals()
-        if retty == 'void':
-            self.println(stmt + ';')
-        else:
-            return self.declare(retty, stmt)
+        return self._invoke(retty, stmt)
 
     def method_call(self, func, retty, *args):
         this = args[0]
@@ -195,10 +231,7 @@ class CppCodeWriter(CodeWriterBase):
             stmt = 'new %(alloctype)s(%(arglist)s)' % locals()
         else:
             stmt = '%(this)s->%(func)s(%(arglist)s)' % locals()
-        if retty == 'void':
-            self.println('%s;' % stmt)
-        else:
-            return self.declare(retty, stmt)
+        return self._invoke(retty, stmt)
 
     def pycapsule_new(self, ptr, name, clsname):
         name_soften = mangle(name)
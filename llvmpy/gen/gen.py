@@ -46,12 +46,70 @@ def populate_headers(println):
                 'llvm_binding/conversion.h',
                 'llvm_binding/binding.h',
                 'llvm_binding/capsule_context.h',
+                'llvm_binding/context_lock.h',
                 'llvm_binding/extra.h',             # extra submodule to add
                 ]
     for inc in includes:
         println('#include "%s"' % inc)
     println()
 
+concrete_head = '''
+static
+PyObject* %(name)s(PyObject* self, PyObject* args)
+{
+    PyObject* obj;
+    if (!PyArg_ParseTuple(args, "O", &obj)) {
+        return NULL;
+    }
+    void* ptr = PyCapsule_GetPointer(obj, "%(capsule)s");
+    if (!ptr) {
+        return NULL;
+    }
+    %(fromty)s* val = typecast< %(fromty)s >::from(ptr);'''
+
+concrete_case = '''\
+    if (llvm::isa< %(toty)s >(val)) {
+        return pycapsule_new(llvm::cast< %(toty)s >(val), "%(capsule)s",
+                             "%(toty)s");
+    }'''
+
+concrete_tail = '''\
+    return pycapsule_new(val, "%(capsule)s", "%(fromty)s");
+}
+'''
+
+def concrete_name(cls):
+    return 'concrete_%s' % codegen.mangle(cls.fullname)
+
+def generate_concrete(println, fromcls, clslist):
+    '''Generate the function that downcasts an object of class `fromcls` to
+    its most derived class in `clslist`.
+    '''
+    name = concrete_name(fromcls)
+    fromty = fromcls.fullname
+    capsule = fromcls.capsule_name
+    println(concrete_head % locals())
+    for cls in clslist:
+        toty = cls.fullname
+        capsule = cls.capsule_name
+        println(concrete_case % locals())
+    capsule = fromcls.capsule_name
+    println(concrete_tail % locals())
+
+def generate_downcast_table(println, downcast_fns, concrete_fns):
+    '''Register the casters to llvmpy.capsule, so that a downcast is a
+    single lookup.
+    '''
+    println()
+    println('capsule.register_downcasts({')
+    for ((fromty, toty), fn) in downcast_fns:
+        println('    (%r, %r): _api.downcast.%s,' % (fromty, toty, fn.name))
+    println('}, {')
+    for fromcls, _ in concrete_fns:
+        println('    %r: _api.downcast.%s,' % (fromcls.fullname,
+                                              concrete_name(fromcls)))
+    println('})')
+
 def main():
     outputfilename = sys.argv[1]
     entry_modname = sys.argv[2]
@@ -83,6 +141,11 @@ static
 
             fn.generate_cpp(println)
 
+        # print the lookup of the most derived class
+        concrete_fns = rootns.aggregate_concrete()
+        for fromcls, clslist in concrete_fns:
+            generate_concrete(println, fromcls, clslist)
+
         println('static')
         println('PyMethodDef downcast_methodtable[] = {')
         fmt = '{ "%(name)s", (PyCFunction)%(func)s, METH_VARARGS, NULL },'
@@ -90,6 +153,9 @@ static
             name = fn.name
             func = fn.c_name
             println(fmt % locals())
+        for fromcls, _ in concrete_fns:
+            name = func = concrete_name(fromcls)
+            println(fmt % locals())
         println('{ NULL }')
         println('};')
         println()
@@ -101,6 +167,9 @@ static
 
     # Generate Python source
     rootns.generate_py(rootdir='.', name='api')
+    with open(os.path.join('api', '__init__.py'), 'a') as pyfile:
+        println = codegen.wrap_println_from_file(pyfile)
+        generate_downcast_table(println, downcast_fns, concrete_fns)
 
 
 if __name__ == '__main__':
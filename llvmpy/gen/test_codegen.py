@@ -0,0 +1,61 @@
+'''
+Tests of the C++ code emitted by the binding generator.
+
+Run from this directory: LLVMPY_LLVM_VERSION=3.3 python -m pytest test_codegen.py
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('LLVMPY_LLVM_VERSION', '3.3')
+
+from binding import *
+
+
+ns = Namespace('codegen_test')
+
+Worker = ns.Class()
+
+@Worker
+class Worker:
+    _include_ = 'worker.h'
+
+    run = Method(cast(Bool, bool))
+    run.nogil = True
+
+    size = Method(cast(Int, int))
+
+    count = Attr(getter=cast(Int, int), setter=cast(int, Int))
+
+
+def emit(unit):
+    lines = []
+    def println(s=''):
+        lines.append(s)
+    unit.generate_cpp(println)
+    return '\n'.join(lines)
+
+def methods():
+    return dict((m.name, m) for m in Worker.methods)
+
+def test_nogil_method():
+    code = emit(methods()['run'])
+    assert 'ContextLockGuard' in code
+    begin = code.index('Py_BEGIN_ALLOW_THREADS')
+    end = code.index('Py_END_ALLOW_THREADS')
+    # the guard is taken with the GIL held, before the GIL is released
+    assert code.index('ContextLockGuard') < begin
+    assert begin < code.index('->run()') < end
+    # the result is converted with the GIL held
+    assert end < code.index('py_bool_from')
+
+def test_method():
+    code = emit(methods()['size'])
+    assert 'ContextLockGuard' in code
+    assert 'ALLOW_THREADS' not in code
+
+def test_attribute():
+    code = emit(Worker.attrs[0])
+    assert 'ContextLockGuard' not in code
+    assert 'ALLOW_THREADS' not in code
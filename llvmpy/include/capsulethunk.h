@@ -47,7 +47,9 @@ void pycobject_pycapsule_dtor(void *p, void *desc){
     FakePyCapsule_Desc *fpc_desc = static_cast<FakePyCapsule_Desc*>(desc);
     Assert(fpc_desc->parent);
     Assert(PyCObject_Check(fpc_desc->parent));
-    fpc_desc->dtor(static_cast<PyObject*>(fpc_desc->parent));
+    if (fpc_desc->dtor) {
+        fpc_desc->dtor(static_cast<PyObject*>(fpc_desc->parent));
+    }
     delete fpc_desc;
 }
 
@@ -96,6 +98,21 @@ int PyCapsule_SetContext(PyObject *p, void *context)
     return 0;
 }
 
+static
+PyCapsule_Destructor PyCapsule_GetDestructor(PyObject *p)
+{
+    Assert(PyCapsule_CheckExact(p));
+    return get_pycobj_desc(p)->dtor;
+}
+
+static
+int PyCapsule_SetDestructor(PyObject *p, PyCapsule_Destructor dtor)
+{
+    Assert(PyCapsule_CheckExact(p));
+    get_pycobj_desc(p)->dtor = dtor;
+    return 0;
+}
+
 static
 const char * PyCapsule_GetName(PyObject *p)
 {
@@ -0,0 +1,71 @@
+#ifndef LLVMPY_CONTEXT_LOCK_H_
+#define LLVMPY_CONTEXT_LOCK_H_
+
+#include <Python.h>
+#include <pythread.h>
+
+// ------------
+// Context lock
+// ------------
+// The global LLVMContext is not thread-safe: types and constants are
+// uniqued in tables that any LLVM call may update.  Every method and
+// function binding holds the context lock while it runs, so a binding that
+// releases the GIL (see Method.nogil) still excludes the other threads from
+// LLVM.  Attribute accessors only copy a field and do not take the lock.
+//
+// All LLVM work is therefore serialized: two threads never run LLVM code at
+// the same time, and releasing the GIL only lets the threads that do not
+// call LLVM run meanwhile.  Every binding call pays for an (uncontended)
+// lock acquire and release.
+//
+// The lock is recursive, because a binding may call back into Python code
+// that uses LLVM.  It is only acquired with the GIL held and a thread never
+// waits for it with the GIL held, so that a thread that holds the lock can
+// always take the GIL back.  The owner and the depth are protected by the
+// GIL.
+
+static PyThread_type_lock TheContextLock = NULL;
+static unsigned long TheContextOwner = 0;
+static unsigned long TheContextDepth = 0;
+
+static
+void acquireContextLock()
+{
+    const unsigned long self = (unsigned long)PyThread_get_thread_ident();
+    if (TheContextDepth && TheContextOwner == self) {
+        ++TheContextDepth;
+        return;
+    }
+    if (!TheContextLock) {
+        TheContextLock = PyThread_allocate_lock();
+        if (!TheContextLock) {
+            Py_FatalError("llvmpy: cannot allocate the context lock");
+        }
+    }
+    if (!PyThread_acquire_lock(TheContextLock, NOWAIT_LOCK)) {
+        Py_BEGIN_ALLOW_THREADS
+        PyThread_acquire_lock(TheContextLock, WAIT_LOCK);
+        Py_END_ALLOW_THREADS
+    }
+    TheContextOwner = self;
+    TheContextDepth = 1;
+}
+
+static
+void releaseContextLock()
+{
+    if (--TheContextDepth == 0) {
+        PyThread_release_lock(TheContextLock);
+    }
+}
+
+class ContextLockGuard {
+public:
+    ContextLockGuard()  { acquireContextLock(); }
+    ~ContextLockGuard() { releaseContextLock(); }
+private:
+    ContextLockGuard(const ContextLockGuard&);
+    void operator = (const ContextLockGuard&);
+};
+
+#endif // LLVMPY_CONTEXT_LOCK_H_
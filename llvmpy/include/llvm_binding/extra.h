@@ -18,7 +18,18 @@
 #include <llvm/Intrinsics.h>
 #include <llvm/IRBuilder.h>
 #include <llvm/PassRegistry.h>
+#include <llvm/Pass.h>
+#include <llvm/PassManager.h>
+#include <llvm/CallGraphSCCPass.h>
+#include <llvm/Analysis/CallGraph.h>
+#include <llvm/Analysis/LoopPass.h>
+#include <llvm/Analysis/RegionPass.h>
+#include <llvm/Analysis/RegionInfo.h>
+#include <llvm/Support/Timer.h>
 #include <llvm/Support/Host.h>
+#include <map>
+#include <string>
+#include <vector>
 
 
 #include "auto_pyobject.h"
@@ -54,6 +65,107 @@ namespace extra{
         void operator = (const raw_svector_ostream_helper&);
     };
 
+    // A raw_ostream that writes into a fixed-size memory area.  Bytes that
+    // do not fit are dropped but still counted by tell(), so that the
+    // caller can detect the overflow and the size that was needed.
+    class raw_buffer_ostream: public raw_ostream {
+        char* Buf;
+        size_t Capacity;
+        size_t Pos;
+
+        virtual void write_impl(const char* Ptr, size_t Size)
+        {
+            if (Pos < Capacity) {
+                size_t N = std::min(Size, Capacity - Pos);
+                memcpy(Buf + Pos, Ptr, N);
+            }
+            Pos += Size;
+        }
+
+        virtual uint64_t current_pos() const
+        {
+            return Pos;
+        }
+
+    public:
+        raw_buffer_ostream(char* Buf, size_t Capacity)
+        : raw_ostream(true), Buf(Buf), Capacity(Capacity), Pos(0) {}
+
+        ~raw_buffer_ostream()
+        {
+            flush();
+        }
+    };
+
+    // Access the memory of a Python object that supports the buffer
+    // protocol (bytes, bytearray, memoryview, mmap, ...) without copying.
+    // Also accepts old-style buffers on Python 2.
+    class PyBufferView {
+        Py_buffer View;
+        bool HasView;
+        const char* Data;
+        Py_ssize_t Size;
+    public:
+        PyBufferView() : HasView(false), Data(NULL), Size(0) {}
+
+        ~PyBufferView()
+        {
+            if (HasView) {
+                PyBuffer_Release(&View);
+            }
+        }
+
+        // Returns false and sets a Python exception on failure.
+        bool acquire(PyObject* Obj, bool Writable=false)
+        {
+            int Flags = Writable ? PyBUF_WRITABLE : PyBUF_SIMPLE;
+            if (0 == PyObject_GetBuffer(Obj, &View, Flags)) {
+                HasView = true;
+                Data = static_cast<const char*>(View.buf);
+                Size = View.len;
+                return true;
+            }
+#if (PY_VERSION_HEX < 0x03000000)
+            PyErr_Clear();
+            if (Writable) {
+                void* Buf;
+                if (0 == PyObject_AsWriteBuffer(Obj, &Buf, &Size)) {
+                    Data = static_cast<const char*>(Buf);
+                    return true;
+                }
+            } else {
+                const void* Buf;
+                if (0 == PyObject_AsReadBuffer(Obj, &Buf, &Size)) {
+                    Data = static_cast<const char*>(Buf);
+                    return true;
+                }
+            }
+#endif
+            return false;
+        }
+
+        StringRef str() const
+        {
+            return StringRef(Data, Size);
+        }
+
+        char* data() const
+        {
+            return const_cast<char*>(Data);
+        }
+
+        size_t size() const
+        {
+            return Size;
+        }
+
+    private:
+        // no copy
+        PyBufferView(const PyBufferView&);
+        // no assign
+        void operator = (const PyBufferView&);
+    };
+
 }
 
 static
@@ -70,6 +182,66 @@ PyObject* make_raw_ostream_for_printing(PyObject* self, PyObject* args)
                          "llvm::raw_svector_ostream");
 }
 
+namespace extra{
+    // raw_buffer_ostream that keeps the target Python buffer alive.
+    class raw_pybuffer_ostream: public raw_buffer_ostream {
+        PyBufferView* View;
+    public:
+        explicit
+        raw_pybuffer_ostream(PyBufferView* View)
+        : raw_buffer_ostream(View->data(), View->size()), View(View) {}
+
+        ~raw_pybuffer_ostream()
+        {
+            flush();
+            delete View;
+        }
+    };
+
+    // MemoryBuffer over the memory of a Python object, which it keeps
+    // alive.  The owner of the buffer may delete it without the GIL.
+    class PyObjectMemoryBuffer: public MemoryBuffer {
+        PyObject* Obj;
+        PyBufferView* View;
+    public:
+        PyObjectMemoryBuffer(PyObject* Obj, PyBufferView* View)
+        : Obj(Obj), View(View)
+        {
+            Py_INCREF(Obj);
+            init(View->data(), View->data() + View->size(), false);
+        }
+
+        ~PyObjectMemoryBuffer()
+        {
+            PyGILState_STATE State = PyGILState_Ensure();
+            delete View;
+            Py_DECREF(Obj);
+            PyGILState_Release(State);
+        }
+
+        BufferKind getBufferKind() const
+        {
+            return MemoryBuffer_Malloc;
+        }
+    };
+}
+
+static
+PyObject* make_raw_buffer_ostream(PyObject* self, PyObject* args)
+{
+    PyObject* Obj;
+    if (!PyArg_ParseTuple(args, "O", &Obj)) {
+        return NULL;
+    }
+    extra::PyBufferView* View = new extra::PyBufferView;
+    if (!View->acquire(Obj, true)) {
+        delete View;
+        return NULL;
+    }
+    llvm::raw_ostream* OS = new extra::raw_pybuffer_ostream(View);
+    return pycapsule_new(OS, "llvm::raw_ostream", "llvm::raw_ostream");
+}
+
 static
 PyObject* make_small_vector_from_types(PyObject* self, PyObject* args)
 {
@@ -146,6 +318,7 @@ PyObject* get_llvm_version(PyObject* self, PyObject* args)
 static PyMethodDef extra_methodtable[] = {
     #define method(func) { #func, (PyCFunction)func, METH_VARARGS, NULL }
     method( make_raw_ostream_for_printing ),
+    method( make_raw_buffer_ostream ),
     method( make_small_vector_from_types ),
     method( make_small_vector_from_values ),
     method( make_small_vector_from_unsigned ),
@@ -253,6 +426,83 @@ PyObject* Function_getBasicBlockList(llvm::Function* fn)
                             "llvm::BasicBlock");
 }
 
+/*
+ * Lazy iteration over iplists.
+ * These return the first node of a list or the node following a given node,
+ * and NULL at the end of the list.
+ */
+
+template<class iplist>
+typename iplist::pointer first_in_iplist(iplist &IPL)
+{
+    if (IPL.empty()) return NULL;
+    return &IPL.front();
+}
+
+template<class iplist>
+typename iplist::pointer next_in_iplist(iplist &IPL,
+                                        typename iplist::pointer Node)
+{
+    typename iplist::iterator it(Node);
+    if (++it == IPL.end()) return NULL;
+    return &*it;
+}
+
+static
+llvm::BasicBlock* Function_getFirstBlock(llvm::Function* fn)
+{
+    return first_in_iplist(fn->getBasicBlockList());
+}
+
+static
+llvm::Function* Function_getNextFunction(llvm::Function* fn)
+{
+    return next_in_iplist(fn->getParent()->getFunctionList(), fn);
+}
+
+static
+llvm::Instruction* BasicBlock_getFirstInstruction(llvm::BasicBlock* bb)
+{
+    return first_in_iplist(bb->getInstList());
+}
+
+static
+llvm::BasicBlock* BasicBlock_getNextBlock(llvm::BasicBlock* bb)
+{
+    return next_in_iplist(bb->getParent()->getBasicBlockList(), bb);
+}
+
+static
+llvm::Instruction* Instruction_getNextInstruction(llvm::Instruction* inst)
+{
+    return next_in_iplist(inst->getParent()->getInstList(), inst);
+}
+
+static
+llvm::Function* Module_getFirstFunction(llvm::Module* mod)
+{
+    return first_in_iplist(mod->getFunctionList());
+}
+
+static
+llvm::GlobalVariable* Module_getFirstGlobal(llvm::Module* mod)
+{
+    return first_in_iplist(mod->getGlobalList());
+}
+
+static
+llvm::GlobalVariable* GlobalVariable_getNextGlobal(llvm::GlobalVariable* gv)
+{
+    return next_in_iplist(gv->getParent()->getGlobalList(), gv);
+}
+
+static
+llvm::Use* Value_getFirstUse(llvm::Value* val)
+{
+    if (val->use_empty()) return NULL;
+    return &val->use_begin().getUse();
+}
+
 /*
  * errout --- can be any file object
  *
@@ -472,7 +722,9 @@ PyObject* llvm_ParseBitCodeFile(llvm::StringRef Buf, llvm::LLVMContext& Ctx,
     Module* M;
     if (FObj) {
         std::string ErrStr;
+        Py_BEGIN_ALLOW_THREADS
         M = ParseBitcodeFile(MB, Ctx, &ErrStr);
+        Py_END_ALLOW_THREADS
         auto_pyobject buf = PyBytes_FromString(ErrStr.c_str());
         if (NULL == PyObject_CallMethod(FObj, "write", "O", *buf)){
             return NULL;
@@ -481,13 +733,91 @@ PyObject* llvm_ParseBitCodeFile(llvm::StringRef Buf, llvm::LLVMContext& Ctx,
 //            return NULL;
 //        }
     } else {
+        Py_BEGIN_ALLOW_THREADS
         M = ParseBitcodeFile(MB, Ctx);
+        Py_END_ALLOW_THREADS
     }
     delete MB;
     return pycapsule_new(M, "llvm::Module");
 }
 
 
+static
+PyObject* llvm_ParseBitCodeBuffer(PyObject* Obj, llvm::LLVMContext& Ctx,
+                                  PyObject* FObj=NULL, bool Lazy=false)
+{
+    using namespace llvm;
+    extra::PyBufferView* View = new extra::PyBufferView;
+    if (!View->acquire(Obj)) {
+        delete View;
+        return NULL;
+    }
+    Module* M;
+    std::string ErrStr;
+    if (Lazy) {
+        // The module reads function bodies from the buffer on demand;
+        // the memory buffer keeps the Python object alive as long as the
+        // module owns it.
+        MemoryBuffer* MB = new extra::PyObjectMemoryBuffer(Obj, View);
+        Py_BEGIN_ALLOW_THREADS
+        M = getLazyBitcodeModule(MB, Ctx, &ErrStr);
+        Py_END_ALLOW_THREADS
+        if (!M) {
+            delete MB;  // not owned by the module on failure
+        }
+    } else {
+        MemoryBuffer* MB = MemoryBuffer::getMemBuffer(View->str(), "", false);
+        Py_BEGIN_ALLOW_THREADS
+        M = ParseBitcodeFile(MB, Ctx, &ErrStr);
+        Py_END_ALLOW_THREADS
+        delete MB;
+        delete View;
+    }
+    if (!M && FObj) {
+        auto_pyobject buf = PyBytes_FromString(ErrStr.c_str());
+        if (NULL == PyObject_CallMethod(FObj, "write", "O", *buf)){
+            return NULL;
+        }
+    }
+    return pycapsule_new(M, "llvm::Module");
+}
+
+static
+PyObject* GlobalValue_Materialize(llvm::GlobalValue* GV, PyObject* FObj)
+{
+    std::string ErrStr;
+    bool Failed;
+    Py_BEGIN_ALLOW_THREADS
+    Failed = GV->Materialize(&ErrStr);
+    Py_END_ALLOW_THREADS
+    if (Failed) {
+        auto_pyobject buf = PyBytes_FromString(ErrStr.c_str());
+        if (NULL == PyObject_CallMethod(FObj, "write", "O", *buf)){
+            return NULL;
+        }
+        Py_RETURN_FALSE;
+    }
+    Py_RETURN_TRUE;
+}
+
+static
+PyObject* Module_MaterializeAll(llvm::Module* M, PyObject* FObj)
+{
+    std::string ErrStr;
+    bool Failed;
+    Py_BEGIN_ALLOW_THREADS
+    Failed = M->MaterializeAll(&ErrStr);
+    Py_END_ALLOW_THREADS
+    if (Failed) {
+        auto_pyobject buf = PyBytes_FromString(ErrStr.c_str());
+        if (NULL == PyObject_CallMethod(FObj, "write", "O", *buf)){
+            return NULL;
+        }
+        Py_RETURN_FALSE;
+    }
+    Py_RETURN_TRUE;
+}
+
 static
 PyObject* llvm_WriteBitcodeToFile(const llvm::Module *M, PyObject* FObj)
 {
@@ -780,6 +1110,722 @@ PyObject* IRBuilder_CreateAggregateRet(llvm::IRBuilder<>* builder,
     return pycapsule_new(inst, "llvm::Value", "llvm::ReturnInst");
 }
 
+/*
+ * Batched instruction emission: IRBuilder_CreateBatch
+ *
+ * Every instruction is a sequence of integers: the opcode followed by the
+ * operands.  Operands are indices in the table of values, or in the table
+ * of types for the type operands.  Negative indices count from the end of
+ * the table.  The result of each instruction is appended to the table of
+ * values.
+ *
+ *     binary operators    (opcode, lhs, rhs)
+ *     casts               (opcode, value, type)
+ *     icmp, fcmp          (opcode, predicate, lhs, rhs)
+ *     select              (opcode, cond, iftrue, iffalse)
+ *     alloca              (opcode, type)
+ *     load                (opcode, pointer)
+ *     store               (opcode, value, pointer)
+ *     getelementptr       (opcode, pointer, index, ...)
+ *     call                (opcode, callee, arg, ...)
+ */
+
+template<class T>
+bool batch_lookup(const std::vector<T*> &table,
+                  const std::vector<long> &inst,
+                  size_t pos, T* &out)
+{
+    if (pos >= inst.size()) {
+        PyErr_Format(PyExc_ValueError,
+                     "missing operand %d for opcode %ld",
+                     (int)pos, inst[0]);
+        return false;
+    }
+    long idx = inst[pos];
+    if (idx < 0) {
+        idx += (long)table.size();
+    }
+    if (idx < 0 || (size_t)idx >= table.size()) {
+        PyErr_Format(PyExc_IndexError, "operand index %ld out of range",
+                     inst[pos]);
+        return false;
+    }
+    out = table[idx];
+    return true;
+}
+
+static
+bool batch_lookup_rest(const std::vector<llvm::Value*> &table,
+                       const std::vector<long> &inst,
+                       size_t pos,
+                       std::vector<llvm::Value*> &out)
+{
+    for (; pos < inst.size(); ++pos) {
+        llvm::Value* val;
+        if (!batch_lookup(table, inst, pos, val)) return false;
+        out.push_back(val);
+    }
+    return true;
+}
+
+static
+bool batch_read(PyObject* item, std::vector<long> &inst)
+{
+    inst.clear();
+    auto_pyobject seq = PySequence_Fast(item, "expected a sequence of int");
+    if (!seq) return false;
+    Py_ssize_t N = PySequence_Fast_GET_SIZE(*seq);
+    for (Py_ssize_t i = 0; i < N; ++i) {
+        long val = PyInt_AsLong(PySequence_Fast_GET_ITEM(*seq, i));
+        if (val == -1 && PyErr_Occurred()) return false;
+        inst.push_back(val);
+    }
+    if (inst.empty()) {
+        PyErr_SetString(PyExc_ValueError, "empty instruction");
+        return false;
+    }
+    return true;
+}
+
+// Sets a TypeError naming the opcode and returns false if not `ok`.
+static
+bool batch_check(bool ok, unsigned opcode, const char* msg)
+{
+    if (!ok) {
+        PyErr_Format(PyExc_TypeError, "%s: %s",
+                     llvm::Instruction::getOpcodeName(opcode), msg);
+    }
+    return ok;
+}
+
+static
+bool batch_check_binop(unsigned opcode, llvm::Value* lhs, llvm::Value* rhs)
+{
+    using namespace llvm;
+    Type* ty = lhs->getType();
+    if (!batch_check(ty == rhs->getType(), opcode,
+                     "operands must have the same type")) {
+        return false;
+    }
+    switch (opcode) {
+    case Instruction::FAdd:
+    case Instruction::FSub:
+    case Instruction::FMul:
+    case Instruction::FDiv:
+    case Instruction::FRem:
+        return batch_check(ty->isFPOrFPVectorTy(), opcode,
+                           "operands must be floating-point");
+    default:
+        return batch_check(ty->isIntOrIntVectorTy(), opcode,
+                           "operands must be integers");
+    }
+}
+
+static
+bool batch_check_cmp(unsigned opcode, long pred,
+                     llvm::Value* lhs, llvm::Value* rhs)
+{
+    using namespace llvm;
+    bool isInt = opcode == Instruction::ICmp;
+    if (pred < CmpInst::FIRST_FCMP_PREDICATE ||
+        pred > CmpInst::LAST_ICMP_PREDICATE ||
+        (isInt ? !CmpInst::isIntPredicate(CmpInst::Predicate(pred))
+               : !CmpInst::isFPPredicate(CmpInst::Predicate(pred)))) {
+        PyErr_Format(PyExc_ValueError, "%s: invalid predicate %ld",
+                     Instruction::getOpcodeName(opcode), pred);
+        return false;
+    }
+    Type* ty = lhs->getType();
+    if (!batch_check(ty == rhs->getType(), opcode,
+                     "operands must have the same type")) {
+        return false;
+    }
+    if (isInt) {
+        return batch_check(ty->getScalarType()->isIntegerTy() ||
+                           ty->getScalarType()->isPointerTy(), opcode,
+                           "operands must be integers or pointers");
+    }
+    return batch_check(ty->isFPOrFPVectorTy(), opcode,
+                       "operands must be floating-point");
+}
+
+static
+bool batch_check_call(llvm::Value* callee,
+                      const std::vector<llvm::Value*> &args)
+{
+    using namespace llvm;
+    const unsigned opcode = Instruction::Call;
+    PointerType* ptrty = dyn_cast<PointerType>(callee->getType());
+    FunctionType* fnty = NULL;
+    if (ptrty) {
+        fnty = dyn_cast<FunctionType>(ptrty->getElementType());
+    }
+    if (!batch_check(fnty, opcode, "callee must be a function pointer")) {
+        return false;
+    }
+    size_t nparams = fnty->getNumParams();
+    if (!batch_check(args.size() == nparams ||
+                     (fnty->isVarArg() && args.size() > nparams), opcode,
+                     "wrong number of arguments")) {
+        return false;
+    }
+    for (size_t i = 0; i < nparams; ++i) {
+        if (!batch_check(args[i]->getType() == fnty->getParamType(i), opcode,
+                         "argument type does not match the callee")) {
+            return false;
+        }
+    }
+    return true;
+}
+
+static
+llvm::Value* batch_emit(llvm::IRBuilder<>* builder,
+                        const std::vector<long> &inst,
+                        const std::vector<llvm::Value*> &values,
+                        const std::vector<llvm::Type*> &types)
+{
+    using namespace llvm;
+    unsigned opcode = inst[0];
+    Value *lhs, *rhs, *val;
+    Type *ty;
+    std::vector<Value*> rest;
+
+    // LLVM only asserts the validity of the operands; check them first.
+    if (Instruction::isBinaryOp(opcode)) {
+        if (!batch_lookup(values, inst, 1, lhs)) return NULL;
+        if (!batch_lookup(values, inst, 2, rhs)) return NULL;
+        if (!batch_check_binop(opcode, lhs, rhs)) return NULL;
+        return builder->CreateBinOp(Instruction::BinaryOps(opcode), lhs, rhs);
+    }
+
+    if (Instruction::isCast(opcode)) {
+        if (!batch_lookup(values, inst, 1, val)) return NULL;
+        if (!batch_lookup(types, inst, 2, ty)) return NULL;
+        if (!batch_check(CastInst::castIsValid(Instruction::CastOps(opcode),
+                                               val, ty),
+                         opcode, "invalid cast")) {
+            return NULL;
+        }
+        return builder->CreateCast(Instruction::CastOps(opcode), val, ty);
+    }
+
+    const char* err;
+    switch (opcode) {
+    case Instruction::ICmp:
+    case Instruction::FCmp:
+        if (!batch_lookup(values, inst, 2, lhs)) return NULL;
+        if (!batch_lookup(values, inst, 3, rhs)) return NULL;
+        if (!batch_check_cmp(opcode, inst[1], lhs, rhs)) return NULL;
+        if (opcode == Instruction::ICmp) {
+            return builder->CreateICmp(CmpInst::Predicate(inst[1]), lhs, rhs);
+        } else {
+            return builder->CreateFCmp(CmpInst::Predicate(inst[1]), lhs, rhs);
+        }
+    case Instruction::Select:
+        if (!batch_lookup(values, inst, 1, val)) return NULL;
+        if (!batch_lookup(values, inst, 2, lhs)) return NULL;
+        if (!batch_lookup(values, inst, 3, rhs)) return NULL;
+        err = SelectInst::areInvalidOperands(val, lhs, rhs);
+        if (!batch_check(!err, opcode, err)) return NULL;
+        return builder->CreateSelect(val, lhs, rhs);
+    case Instruction::Alloca:
+        if (!batch_lookup(types, inst, 1, ty)) return NULL;
+        if (!batch_check(ty->isSized(), opcode, "type must be sized")) {
+            return NULL;
+        }
+        return builder->CreateAlloca(ty);
+    case Instruction::Load:
+        if (!batch_lookup(values, inst, 1, val)) return NULL;
+        if (!batch_check(val->getType()->isPointerTy(), opcode,
+                         "operand must be a pointer")) {
+            return NULL;
+        }
+        return builder->CreateLoad(val);
+    case Instruction::Store:
+        if (!batch_lookup(values, inst, 1, val)) return NULL;
+        if (!batch_lookup(values, inst, 2, lhs)) return NULL;
+        if (!batch_check(lhs->getType()->isPointerTy() &&
+                         lhs->getType()->getPointerElementType() ==
+                         val->getType(), opcode,
+                         "pointer must point to the type of the value")) {
+            return NULL;
+        }
+        return builder->CreateStore(val, lhs);
+    case Instruction::GetElementPtr:
+        if (!batch_lookup(values, inst, 1, val)) return NULL;
+        if (!batch_lookup_rest(values, inst, 2, rest)) return NULL;
+        for (size_t i = 0; i < rest.size(); ++i) {
+            if (!batch_check(rest[i]->getType()->isIntegerTy(), opcode,
+                             "indices must be integers")) {
+                return NULL;
+            }
+        }
+        if (!batch_check(val->getType()->isPointerTy() &&
+                         GetElementPtrInst::getIndexedType(val->getType(),
+                                                           rest),
+                         opcode, "invalid pointer or indices")) {
+            return NULL;
+        }
+        return builder->CreateGEP(val, rest);
+    case Instruction::Call:
+        if (!batch_lookup(values, inst, 1, val)) return NULL;
+        if (!batch_lookup_rest(values, inst, 2, rest)) return NULL;
+        if (!batch_check_call(val, rest)) return NULL;
+        return builder->CreateCall(val, rest);
+    }
+    PyErr_Format(PyExc_ValueError, "opcode %u is not supported in a batch",
+                 opcode);
+    return NULL;
+}
+
+static
+PyObject* IRBuilder_CreateBatch(llvm::IRBuilder<>* builder,
+                                PyObject* Values,
+                                PyObject* Types,
+                                PyObject* Code,
+                                PyObject* Wanted)
+{
+    using namespace llvm;
+    std::vector<Value*> values;
+    std::vector<Type*> types;
+    if (!extract<Value>::from_py_sequence(values, Values, "llvm::Value")) {
+        return NULL;
+    }
+    if (!extract<Type>::from_py_sequence(types, Types, "llvm::Type")) {
+        return NULL;
+    }
+
+    auto_pyobject code = PySequence_Fast(Code, "expected a sequence");
+    if (!code) return NULL;
+    Py_ssize_t N = PySequence_Fast_GET_SIZE(*code);
+    values.reserve(values.size() + N);
+    std::vector<long> inst;
+    for (Py_ssize_t i = 0; i < N; ++i) {
+        if (!batch_read(PySequence_Fast_GET_ITEM(*code, i), inst)) {
+            return NULL;
+        }
+        Value* res = batch_emit(builder, inst, values, types);
+        if (!res) return NULL;
+        values.push_back(res);
+    }
+
+    auto_pyobject wanted = PySequence_Fast(Wanted, "expected a sequence");
+    if (!wanted) return NULL;
+    Py_ssize_t M = PySequence_Fast_GET_SIZE(*wanted);
+    std::vector<long> indices;
+    if (M && !batch_read(*wanted, indices)) return NULL;
+    PyObject* result = PyList_New(M);
+    if (!result) return NULL;
+    for (Py_ssize_t i = 0; i < M; ++i) {
+        long idx = indices[i];
+        if (idx < 0) {
+            idx += (long)values.size();
+        }
+        if (idx < 0 || (size_t)idx >= values.size()) {
+            PyErr_Format(PyExc_IndexError, "value index %ld out of range",
+                         indices[i]);
+            Py_DECREF(result);
+            return NULL;
+        }
+        PyObject* cap = pycapsule_new(values[idx], "llvm::Value",
+                                      "llvm::Value");
+        if (!cap) {
+            Py_DECREF(result);
+            return NULL;
+        }
+        PyList_SET_ITEM(result, i, cap);
+    }
+    return result;
+}
+
+/*
+ * Pass profiling
+ *
+ * A profiling pass manager adds a checkpoint pass after every pass it is
+ * given.  The checkpoint has the kind of that pass (module, CGSCC,
+ * function, loop, region or basic block), so that the pass manager nests
+ * it with the pass and runs it right after the pass, on the same unit.
+ *
+ * While a run is profiled, a checkpoint charges its pass with the time
+ * since the previous checkpoint, and with the change of the instruction
+ * count of the functions of its unit.  Analyses scheduled for a pass are
+ * charged to it.  Otherwise, checkpoints do nothing.
+ */
+
+namespace extra{
+    class PassProfiler {
+    public:
+        struct Entry {
+            std::string Name;
+            TimeRecord Time;
+            long Instructions;
+
+            explicit
+            Entry(const std::string& Name) : Name(Name), Instructions(0) {}
+        };
+
+        bool Enabled;
+        std::vector<Entry> Entries;
+
+        PassProfiler() : Enabled(false), Total(0) {}
+
+        // Returns NULL if `P` does not run (immutable passes).
+        Pass* createCheckpoint(Pass* P);
+
+        void start(const Module& M)
+        {
+            reset();
+            recount(M);
+            Last = TimeRecord::getCurrentTime(true);
+            Enabled = true;
+        }
+
+        void start(const Function& F)
+        {
+            reset();
+            Total = Counts[&F] = countInstructions(F);
+            Last = TimeRecord::getCurrentTime(true);
+            Enabled = true;
+        }
+
+        // Charge the time since the previous checkpoint to entry `Index`.
+        void enter(unsigned Index)
+        {
+            TimeRecord Now = TimeRecord::getCurrentTime(false);
+            Now -= Last;
+            Entries[Index].Time += Now;
+        }
+
+        // Start the time of the next pass, after the counting.
+        void leave()
+        {
+            Last = TimeRecord::getCurrentTime(true);
+        }
+
+        void count(unsigned Index, const Function& F)
+        {
+            long N = countInstructions(F);
+            long& Old = Counts[&F];     // 0 for a new function
+            Entries[Index].Instructions += N - Old;
+            Total += N - Old;
+            Old = N;
+        }
+
+        void count(unsigned Index, const Module& M)
+        {
+            long Before = Total;
+            recount(M);     // also forgets the deleted functions
+            Entries[Index].Instructions += Total - Before;
+        }
+
+    private:
+        TimeRecord Last;
+        std::map<const Function*, long> Counts;
+        long Total;
+
+        static
+        long countInstructions(const Function& F)
+        {
+            long N = 0;
+            for (Function::const_iterator BB = F.begin(), E = F.end();
+                 BB != E; ++BB) {
+                N += BB->size();
+            }
+            return N;
+        }
+
+        void recount(const Module& M)
+        {
+            Counts.clear();
+            Total = 0;
+            for (Module::const_iterator F = M.begin(), E = M.end();
+                 F != E; ++F) {
+                Total += Counts[&*F] = countInstructions(*F);
+            }
+        }
+
+        void reset()
+        {
+            for (size_t i = 0; i < Entries.size(); ++i) {
+                Entries[i].Time = TimeRecord();
+                Entries[i].Instructions = 0;
+            }
+        }
+    };
+
+    template<class PassTy>
+    class Checkpoint: public PassTy {
+    public:
+        static char ID;
+
+        Checkpoint(PassProfiler& Profiler, unsigned Index)
+        : PassTy(ID), Profiler(Profiler), Index(Index) {}
+
+        virtual const char* getPassName() const
+        {
+            return "Pass profiler checkpoint";
+        }
+
+        virtual void getAnalysisUsage(AnalysisUsage& AU) const
+        {
+            PassTy::getAnalysisUsage(AU);
+            AU.setPreservesAll();
+        }
+
+    protected:
+        PassProfiler& Profiler;
+        unsigned Index;
+
+        void sample(const Function& F)
+        {
+            if (Profiler.Enabled) {
+                Profiler.enter(Index);
+                Profiler.count(Index, F);
+                Profiler.leave();
+            }
+        }
+    };
+
+    template<class PassTy>
+    char Checkpoint<PassTy>::ID = 0;
+
+    struct ModuleCheckpoint: public Checkpoint<ModulePass> {
+        ModuleCheckpoint(PassProfiler& Profiler, unsigned Index)
+        : Checkpoint<ModulePass>(Profiler, Index) {}
+
+        virtual bool runOnModule(Module& M)
+        {
+            if (Profiler.Enabled) {
+                Profiler.enter(Index);
+                Profiler.count(Index, M);
+                Profiler.leave();
+            }
+            return false;
+        }
+    };
+
+    struct SCCCheckpoint: public Checkpoint<CallGraphSCCPass> {
+        SCCCheckpoint(PassProfiler& Profiler, unsigned Index)
+        : Checkpoint<CallGraphSCCPass>(Profiler, Index) {}
+
+        // The functions that the pass deleted are forgotten at the next
+        // module checkpoint, or at the end of the run.
+        virtual bool runOnSCC(CallGraphSCC& SCC)
+        {
+            if (Profiler.Enabled) {
+                Profiler.enter(Index);
+                for (CallGraphSCC::iterator I = SCC.begin(), E = SCC.end();
+                     I != E; ++I) {
+                    if (Function* F = (*I)->getFunction()) {
+                        Profiler.count(Index, *F);
+                    }
+                }
+                Profiler.leave();
+            }
+            return false;
+        }
+    };
+
+    struct FunctionCheckpoint: public Checkpoint<FunctionPass> {
+        FunctionCheckpoint(PassProfiler& Profiler, unsigned Index)
+        : Checkpoint<FunctionPass>(Profiler, Index) {}
+
+        virtual bool runOnFunction(Function& F)
+        {
+            sample(F);
+            return false;
+        }
+    };
+
+    struct LoopCheckpoint: public Checkpoint<LoopPass> {
+        LoopCheckpoint(PassProfiler& Profiler, unsigned Index)
+        : Checkpoint<LoopPass>(Profiler, Index) {}
+
+        virtual bool runOnLoop(Loop* L, LPPassManager& LPM)
+        {
+            sample(*L->getHeader()->getParent());
+            return false;
+        }
+    };
+
+    struct RegionCheckpoint: public Checkpoint<RegionPass> {
+        RegionCheckpoint(PassProfiler& Profiler, unsigned Index)
+        : Checkpoint<RegionPass>(Profiler, Index) {}
+
+        virtual bool runOnRegion(Region* R, RGPassManager& RGM)
+        {
+            sample(*R->getEntry()->getParent());
+            return false;
+        }
+    };
+
+    struct BasicBlockCheckpoint: public Checkpoint<BasicBlockPass> {
+        BasicBlockCheckpoint(PassProfiler& Profiler, unsigned Index)
+        : Checkpoint<BasicBlockPass>(Profiler, Index) {}
+
+        virtual bool runOnBasicBlock(BasicBlock& BB)
+        {
+            sample(*BB.getParent());
+            return false;
+        }
+    };
+
+    Pass* PassProfiler::createCheckpoint(Pass* P)
+    {
+        if (P->getAsImmutablePass() || P->getAsPMDataManager()) {
+            return NULL;
+        }
+        unsigned Index = Entries.size();
+        Pass* C;
+        switch (P->getPassKind()) {
+        case PT_Module:
+            C = new ModuleCheckpoint(*this, Index);
+            break;
+        case PT_CallGraphSCC:
+            C = new SCCCheckpoint(*this, Index);
+            break;
+        case PT_Function:
+            C = new FunctionCheckpoint(*this, Index);
+            break;
+        case PT_Loop:
+            C = new LoopCheckpoint(*this, Index);
+            break;
+        case PT_Region:
+            C = new RegionCheckpoint(*this, Index);
+            break;
+        case PT_BasicBlock:
+            C = new BasicBlockCheckpoint(*this, Index);
+            break;
+        default:
+            return NULL;
+        }
+        Entries.push_back(Entry(P->getPassName()));
+        return C;
+    }
+
+    // The profilers of the live profiling pass managers.  Passes are not
+    // compiled with RTTI, so they cannot be found with dynamic_cast.
+    typedef std::map<const PassManagerBase*, PassProfiler*> ProfilerMap;
+    static ProfilerMap TheProfilers;
+
+    static
+    PassProfiler* findProfiler(const PassManagerBase* PM)
+    {
+        ProfilerMap::iterator it = TheProfilers.find(PM);
+        return it == TheProfilers.end() ? NULL : it->second;
+    }
+
+    // The checkpoint is created before the pass is added, since the pass
+    // manager may delete a pass that it does not need.
+    class ProfilingPassManager: public PassManager {
+        PassProfiler Profiler;
+    public:
+        ProfilingPassManager()
+        {
+            TheProfilers[this] = &Profiler;
+        }
+
+        ~ProfilingPassManager()
+        {
+            TheProfilers.erase(this);
+        }
+
+        virtual void add(Pass* P)
+        {
+            Pass* C = Profiler.createCheckpoint(P);
+            PassManager::add(P);
+            if (C) PassManager::add(C);
+        }
+    };
+
+    class ProfilingFunctionPassManager: public FunctionPassManager {
+        PassProfiler Profiler;
+    public:
+        explicit
+        ProfilingFunctionPassManager(Module* M)
+        : FunctionPassManager(M)
+        {
+            TheProfilers[this] = &Profiler;
+        }
+
+        ~ProfilingFunctionPassManager()
+        {
+            TheProfilers.erase(this);
+        }
+
+        virtual void add(Pass* P)
+        {
+            Pass* C = Profiler.createCheckpoint(P);
+            FunctionPassManager::add(P);
+            if (C) FunctionPassManager::add(C);
+        }
+    };
+}
+
+static
+llvm::PassManager* PassManager_newProfiling()
+{
+    return new extra::ProfilingPassManager;
+}
+
+static
+llvm::FunctionPassManager* FunctionPassManager_newProfiling(llvm::Module* M)
+{
+    return new extra::ProfilingFunctionPassManager(M);
+}
+
+// Returns false if the pass manager was not created for profiling.
+static
+bool PassManager_startProfile(llvm::PassManager* PM, llvm::Module& M)
+{
+    extra::PassProfiler* Profiler = extra::findProfiler(PM);
+    if (Profiler) {
+        Profiler->start(M);
+    }
+    return Profiler != NULL;
+}
+
+static
+bool FunctionPassManager_startProfile(llvm::FunctionPassManager* FPM,
+                                      llvm::Function& F)
+{
+    extra::PassProfiler* Profiler = extra::findProfiler(FPM);
+    if (Profiler) {
+        Profiler->start(F);
+    }
+    return Profiler != NULL;
+}
+
+// Stop profiling and return a list of
+// (pass name, wall time, user time, system time, instruction delta),
+// one per pass in the order of the pipeline.
+static
+PyObject* PassManagerBase_finishProfile(llvm::PassManagerBase* PM)
+{
+    extra::PassProfiler* Profiler = extra::findProfiler(PM);
+    if (!Profiler) {
+        Py_RETURN_NONE;
+    }
+    Profiler->Enabled = false;
+    const size_t N = Profiler->Entries.size();
+    PyObject* result = PyList_New(N);
+    if (!result) return NULL;
+    for (size_t i = 0; i < N; ++i) {
+        const extra::PassProfiler::Entry& E = Profiler->Entries[i];
+        PyObject* item = Py_BuildValue("(sdddl)", E.Name.c_str(),
+                                       E.Time.getWallTime(),
+                                       E.Time.getUserTime(),
+                                       E.Time.getSystemTime(),
+                                       E.Instructions);
+        if (!item) {
+            Py_DECREF(result);
+            return NULL;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+    return result;
+}
+
 static
 PyObject* DynamicLibrary_LoadLibraryPermanently(const char * Filename,
                                                 PyObject* ErrMsg = 0)
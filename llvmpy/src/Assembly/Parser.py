@@ -12,3 +12,4 @@ ParseAssemblyString = llvm.Function('ParseAssemblyString',
                                     ptr(Module), # can be None
                                     ref(SMDiagnostic),
                                     ref(LLVMContext))
+ParseAssemblyString.nogil = True
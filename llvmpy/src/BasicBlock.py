@@ -22,6 +22,10 @@ class BasicBlock:
     removePredecessor |= Method(Void, ptr(BasicBlock))
 
     getInstList = CustomMethod('BasicBlock_getInstList', PyObjectPtr)
+    getFirstInstruction = CustomMethod('BasicBlock_getFirstInstruction',
+                                       ptr(Instruction))
+    getNextBlock = CustomMethod('BasicBlock_getNextBlock', ptr(BasicBlock))
+    size = Method(cast(Size_t, int))
 
     eraseFromParent = Method()
 
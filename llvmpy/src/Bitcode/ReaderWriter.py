@@ -3,6 +3,7 @@ from ..namespace import llvm
 from ..ADT.StringRef import StringRef
 from ..Module import Module
 from ..LLVMContext import LLVMContext
+from ..Support.raw_ostream import raw_ostream
 
 llvm.includes.add('llvm/Bitcode/ReaderWriter.h')
 
@@ -14,6 +15,15 @@ ParseBitCodeFile = llvm.CustomFunction('ParseBitCodeFile',
                                        PyObjectPtr,         # file-like object
                                        ).require_only(2)
 
+ParseBitCodeBuffer = llvm.CustomFunction('ParseBitCodeBuffer',
+                                         'llvm_ParseBitCodeBuffer',
+                                         PyObjectPtr,    # returns Module*
+                                         PyObjectPtr,    # buffer object
+                                         ref(LLVMContext),
+                                         PyObjectPtr,    # file-like object
+                                         cast(bool, Bool), # lazy
+                                         ).require_only(2)
+
 WriteBitcodeToFile = llvm.CustomFunction('WriteBitcodeToFile',
                                          'llvm_WriteBitcodeToFile',
                                          PyObjectPtr,   # return None
@@ -21,6 +31,14 @@ WriteBitcodeToFile = llvm.CustomFunction('WriteBitcodeToFile',
                                          PyObjectPtr,   # file-like object
                                          )
 
+WriteBitcodeToStream = llvm.CustomFunction('WriteBitcodeToStream',
+                                           'llvm::WriteBitcodeToFile',
+                                           Void,
+                                           ptr(Module),
+                                           ref(raw_ostream),
+                                           )
+WriteBitcodeToStream.nogil = True
+
 getBitcodeTargetTriple = llvm.CustomFunction('getBitcodeTargetTriple',
                                              'llvm_getBitcodeTargetTriple',
                                              PyObjectPtr, # return str
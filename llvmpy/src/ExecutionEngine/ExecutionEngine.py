@@ -65,6 +65,7 @@ class ExecutionEngine:
     getPointerToGlobalIfAvailable = Method(cast(VoidPtr, int), ptr(GlobalValue))
     getPointerToGlobal = Method(cast(VoidPtr, int), ptr(GlobalValue))
     getPointerToFunction = Method(cast(VoidPtr, int), ptr(Function))
+    getPointerToFunction.nogil = True
     getPointerToBasicBlock = Method(cast(VoidPtr, int), ptr(BasicBlock))
     getPointerToFunctionOrStub = Method(cast(VoidPtr, int), ptr(Function))
 
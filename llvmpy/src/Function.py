@@ -31,6 +31,10 @@ class Function:
     getArgumentList = CustomMethod('Function_getArgumentList', PyObjectPtr)
     getBasicBlockList = CustomMethod('Function_getBasicBlockList', PyObjectPtr)
     getEntryBlock = Method(ref(BasicBlock))
+    getFirstBlock = CustomMethod('Function_getFirstBlock', ptr(BasicBlock))
+    getNextFunction = CustomMethod('Function_getNextFunction', ptr(Function))
+    size = Method(cast(Size_t, int))
+    arg_size = Method(cast(Size_t, int))
 
     copyAttributesFrom = Method(Void, ptr(GlobalValue))
 
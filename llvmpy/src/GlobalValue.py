@@ -42,6 +42,10 @@ class GlobalValue:
     copyAttributesFrom = Method(Void, ptr(GlobalValue))
     destroyConstant = Method()
     isDeclaration = Method(cast(Bool, bool))
+    isMaterializable = Method(cast(Bool, bool))
+    Materialize = CustomMethod('GlobalValue_Materialize',
+                               PyObjectPtr,  # return bool
+                               PyObjectPtr)  # file-like object for errors
     removeFromParent = Method()
     eraseFromParent = Method()
     eraseFromParent.disowning = True
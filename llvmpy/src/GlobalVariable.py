@@ -43,6 +43,9 @@ class GlobalVariable:
     hasUniqueInitializer = Method(cast(Bool, bool))
     hasDefinitiveInitializer = Method(cast(Bool, bool))
 
+    getNextGlobal = CustomMethod('GlobalVariable_getNextGlobal',
+                                 ptr(GlobalVariable))
+
 #    isExternallyInitialized = Method(cast(Bool, bool))
 #    setExternallyinitialized = Method(Void, cast(bool, Bool))
 
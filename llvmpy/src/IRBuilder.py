@@ -49,6 +49,13 @@ class IRBuilder:
                                       PyObjectPtr,      # list of Value
                                       cast(int, Unsigned))
 
+    CreateBatch = CustomMethod('IRBuilder_CreateBatch',
+                               PyObjectPtr,     # returns list of Value
+                               PyObjectPtr,     # list of Value
+                               PyObjectPtr,     # list of Type
+                               PyObjectPtr,     # instructions
+                               PyObjectPtr)     # indices of returned values
+
     CreateBr = Method(ptr(BranchInst), ptr(BasicBlock))
 
 
@@ -112,6 +112,8 @@ class Instruction:
 
     getNextNode = Method(ptr(Instruction))
     getPrevNode = Method(ptr(Instruction))
+    getNextInstruction = CustomMethod('Instruction_getNextInstruction',
+                                      ptr(Instruction))
 
 # LLVM 3.3
 #    hasUnsafeAlgebra = Method(cast(Bool, bool))
@@ -48,6 +48,8 @@ class Module:
 
     # Function Iteration
     list_functions = CustomMethod('Module_list_functions', PyObjectPtr)
+    getFirstFunction = CustomMethod('Module_getFirstFunction', ptr(Function))
+    size = Method(cast(Size_t, int))
 
     # GlobalVariabe Accessors
     getGlobalVariable = Method(ptr(GlobalVariable),
@@ -59,6 +61,8 @@ class Module:
 
     # GlobalVariable Iteration
     list_globals = CustomMethod('Module_list_globals', PyObjectPtr)
+    getFirstGlobal = CustomMethod('Module_getFirstGlobal', ptr(GlobalVariable))
+    global_size = Method(cast(Size_t, int))
 
     # Named MetaData Accessors
     getNamedMetadata = Method(ptr(NamedMDNode), cast(str, StringRef))
@@ -84,4 +88,9 @@ class Module:
 
     dropAllReferences = Method()
 
+    # Materialization
+    MaterializeAll = CustomMethod('Module_MaterializeAll',
+                                  PyObjectPtr,  # return bool
+                                  PyObjectPtr)  # file-like object for errors
+
     getTypeByName = Method(ptr(StructType), cast(str, StringRef))
@@ -18,18 +18,38 @@ class PassManagerBase:
 
     add = Method(Void, ownedptr(Pass))
 
+    # Stop profiling; see PassManager.newProfiling.
+    finishProfile = CustomMethod('PassManagerBase_finishProfile',
+                                 PyObjectPtr)  # list of tuples or None
+
 @PassManager
 class PassManager:
     new = Constructor()
 
+    # A pass manager that can profile its passes.
+    newProfiling = CustomStaticMethod('PassManager_newProfiling',
+                                      ptr(PassManager))
+
     run = Method(cast(Bool, bool), ref(Module))
+    run.nogil = True
+
+    startProfile = CustomMethod('PassManager_startProfile',
+                                cast(Bool, bool), ref(Module))
 
 
 @FunctionPassManager
 class FunctionPassManager:
     new = Constructor(ptr(Module))
 
+    newProfiling = CustomStaticMethod('FunctionPassManager_newProfiling',
+                                      ptr(FunctionPassManager),
+                                      ptr(Module))
+
     run = Method(cast(Bool, bool), ref(Function))
+    run.nogil = True
+
+    startProfile = CustomMethod('FunctionPassManager_startProfile',
+                                cast(Bool, bool), ref(Function))
 
     doInitialization = Method(cast(Bool, bool))
     doFinalization = Method(cast(Bool, bool))
@@ -1,5 +1,6 @@
 from binding import *
 from ..namespace import llvm
+from ..ADT.StringRef import StringRef
 
 llvm.includes.add('llvm/Support/SourceMgr.h')
 
@@ -8,3 +9,7 @@ class SMDiagnostic:
     new = Constructor()
     delete = Destructor()
 
+    getLineNo = Method(cast(Int, int))
+    getColumnNo = Method(cast(Int, int))
+    getMessage = Method(cast(StringRef, str))
+
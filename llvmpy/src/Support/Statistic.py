@@ -0,0 +1,14 @@
+from binding import *
+from ..namespace import llvm
+from .raw_ostream import raw_ostream
+
+llvm.includes.add('llvm/ADT/Statistic.h')
+
+EnableStatistics = llvm.Function('EnableStatistics', Void)
+
+AreStatisticsEnabled = llvm.Function('AreStatisticsEnabled',
+                                     cast(Bool, bool))
+
+PrintStatistics = llvm.Function('PrintStatistics',
+                                Void,
+                                ref(raw_ostream))
@@ -8,6 +8,7 @@ class raw_ostream:
     _include_ = "llvm/Support/raw_ostream.h"
     delete = Destructor()
     flush = Method()
+    tell = Method(cast(Uint64, int))
 
 @llvm.Class(raw_ostream)
 class raw_svector_ostream:
@@ -18,3 +19,15 @@ class raw_svector_ostream:
     bytes = Method(cast(bytes, StringRef))
     bytes.realname = 'str'
 
+
+@llvm.Class(raw_ostream)
+class raw_fd_ostream:
+    _include_ = "llvm/Support/raw_ostream.h"
+    _base_ = raw_ostream
+
+    new = Constructor(cast(int, Int),    # file descriptor
+                      cast(bool, Bool),  # close the fd on destruction
+                      )
+    close = Method()
+    has_error = Method(cast(Bool, bool))
+    clear_error = Method()
@@ -50,5 +50,3 @@ class TargetMachine:
                                  CodeGenFileType,
                                  cast(bool, Bool)
                                  ).require_only(3)
-
-
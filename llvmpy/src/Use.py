@@ -0,0 +1,9 @@
+from binding import *
+from .namespace import llvm
+from .Value import Value, User, Use
+
+@Use
+class Use:
+    get = Method(ptr(Value))
+    getUser = Method(ptr(User))
+    getNext = Method(ptr(Use))
@@ -20,6 +20,7 @@ ConstantVector = llvm.Class(Constant)
 ConstantDataSequential = llvm.Class(Constant)
 ConstantDataArray = llvm.Class(ConstantDataSequential)
 ConstantExpr = llvm.Class(Constant)
+Use = llvm.Class()
 
 from .Support.raw_ostream import raw_ostream
 from .Assembly.AssemblyAnnotationWriter import AssemblyAnnotationWriter
@@ -57,6 +58,7 @@ class Value:
     replaceAllUsesWith = Method(Void, ptr(Value))
 
     list_use = CustomMethod('Value_use_iterator_to_list', PyObjectPtr)
+    getFirstUse = CustomMethod('Value_getFirstUse', ptr(Use))
 
     hasOneUse = Method(cast(Bool, bool))
     hasNUses = Method(cast(Bool, bool), cast(int, Unsigned))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Benchmark of defining a large function with llvm_cbuilder.
+#
+# The function has about `nstmts` statements: assignments, if-else blocks
+# and loops, as in generated kernels.  The number of basic blocks is
+# printed too; if-else blocks without an else branch add no empty block.
+#
+#   python bench_cbuilder.py [number of statements]
+
+import sys
+import time
+
+from llvm.core import Module
+from llvm_cbuilder import CDefinition
+import llvm_cbuilder.shortnames as C
+
+
+class Kernel(CDefinition):
+    _name_ = 'kernel'
+    _retty_ = C.double
+    _argtys_ = [('x', C.double),
+                ('n', C.int),]
+
+    def specialize(self, nstmts):
+        self.nstmts = nstmts
+
+    def body(self, x, n):
+        acc = self.var(C.double, 0.0)
+        one = self.constant(C.double, 1.0)
+        # 8 statements per iteration
+        for _ in range(self.nstmts // 8):
+            acc += x * one
+            with self.ifelse(acc > x) as ifelse:
+                with ifelse.then():
+                    acc -= one
+                with ifelse.otherwise():
+                    acc += one
+            with self.ifelse(acc < one) as ifelse:
+                with ifelse.then():
+                    acc += x
+            with self.for_range(n) as (loop, i):
+                acc += x
+        self.ret(acc)
+
+
+def bench(title, func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        ts = time.time()
+        func()
+        te = time.time()
+        if best is None or te - ts < best:
+            best = te - ts
+    print('%-40s %10.3f ms' % (title, best * 1000))
+
+
+def define(nstmts, optimize):
+    module = Module.new('bench')
+    return Kernel(nstmts).define(module, optimize=optimize)
+
+
+def main(nstmts=10000):
+    fn = define(nstmts, optimize=False)
+    print('%d statements, %d basic blocks, %d instructions'
+          % (nstmts, len(fn.basic_blocks),
+             sum(bb.instruction_count for bb in fn.basic_blocks)))
+
+    bench('define', lambda: define(nstmts, optimize=False))
+    bench('define and optimize', lambda: define(nstmts, optimize=True))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# Benchmark of calling a small JIT-compiled function from Python through
+# ExecutionEngine.run_function, a ctypes function pointer and the
+# trampoline returned by ExecutionEngine.get_callable.
+#
+#   python bench_fastcall.py [number of calls]
+
+import sys
+import time
+import ctypes
+
+from llvm.core import Module, Type, Builder
+import llvm.ee as le
+
+
+def build():
+    m = Module.new('bench')
+    t = Type.int(64)
+    f = m.add_function(Type.function(t, [t, t]), 'add')
+    bld = Builder.new(f.append_basic_block('entry'))
+    bld.ret(bld.add(*f.args))
+    return m, f
+
+
+def bench(title, call, ncalls):
+    ts = time.time()
+    for i in range(ncalls):
+        call(i)
+    te = time.time()
+    print('%-20s %10.3f us per call' % (title, (te - ts) * 1e6 / ncalls))
+
+
+def main(ncalls=100000):
+    m, f = build()
+    ee = le.ExecutionEngine.new(m)
+    t = Type.int(64)
+
+    one = le.GenericValue.int(t, 1)
+    bench('run_function',
+          lambda i: ee.run_function(f, [le.GenericValue.int(t, i), one])
+                      .as_int(),
+          ncalls)
+
+    cfunc = ctypes.CFUNCTYPE(ctypes.c_int64, ctypes.c_int64,
+                             ctypes.c_int64)(ee.get_pointer_to_function(f))
+    bench('ctypes', lambda i: cfunc(i, 1), ncalls)
+
+    fast = ee.get_callable(f)
+    bench('get_callable', lambda i: fast(i, 1), ncalls)
+
+    bench('builtin (max)', lambda i: max(i, 1), ncalls)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -37,7 +37,8 @@ class TestCloneModule(unittest.TestCase):
 
         self.assertTrue(id(cloned) != id(my_module))
         self.assertTrue(str(cloned) == str(my_module))
-        self.assertTrue(cloned == my_module)
+        self.assertTrue(cloned.structurally_equal(my_module))
+        self.assertTrue(cloned != my_module)
 
 
 
@@ -1,5 +1,6 @@
 from llvm.core import *
 from llvm.passes import *
+from llvm.passes import PASS_DOT_DOM_ONLY, PASS_INLINE
 from llvm.ee import *
 import llvm
 import unittest
@@ -10,6 +10,7 @@ from llvm import *
 from llvm.core import *
 from llvm.ee import *
 from llvm.passes import *
+from llvm.passes import PASS_ADCE
 
 ti = Type.int()
 